@@ -1,4 +1,8 @@
-from app import app
+import os
+
+from app import create_app
+
+app = create_app(os.getenv('FLASK_CONFIG') or 'default')
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -1,21 +1,57 @@
+import os
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_migrate import Migrate
-from flask_bcrypt import Bcrypt
-
-app = Flask(__name__)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///tingo-app.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = 'gfshfskljh89yr9whbbhyr6t7aabzbh'
+from config import config
+from app.startup import StartupReport
 
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
-migrate = Migrate(app, db)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
+db = SQLAlchemy()
+migrate = Migrate()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
 login_manager.login_message_category = "Info"
 
 
-from app import views 
\ No newline at end of file
+def create_app(config_name=None):
+    report = StartupReport()
+
+    with report.phase('config'):
+        app = Flask(__name__)
+        app.config.from_object(config[config_name or os.environ.get('FLASK_CONFIG') or 'default'])
+
+    with report.phase('extensions'):
+        from app import database
+        database.configure(app)
+        db.init_app(app)
+        migrate.init_app(app, db, include_object=database.include_object)
+        login_manager.init_app(app)
+        from app import cache
+        cache.init_app(app)
+        from app import instrumentation
+        instrumentation.init_app(app)
+        from app import writebehind
+        writebehind.init_app(app)
+
+    with report.phase('models'):
+        # Imported for the mapper and session events they register.
+        from app import models, aggregation, analytics, counters, feed, geo, identity, \
+            orderbook, search, sync
+
+    with report.phase('blueprints'):
+        from app.views import main as main_blueprint
+        app.register_blueprint(main_blueprint)
+
+        from app.api import api as api_blueprint
+        app.register_blueprint(api_blueprint)
+
+        from app.assets import static_assets as assets_blueprint
+        app.register_blueprint(assets_blueprint)
+
+        from app.commands import commands as commands_blueprint
+        app.register_blueprint(commands_blueprint)
+
+    report.finish(app)
+    return app
@@ -0,0 +1,217 @@
+from collections import defaultdict
+
+from sqlalchemy import and_, delete, event, func, insert, select
+
+from app import db
+from app.database import upsert
+from app.models import CooperativeLot, Product, User, cooperative_members
+
+
+LOT_KEYS = ['cooperative_id', 'product_type', 'product_variety']
+
+lots = CooperativeLot.__table__
+members = cooperative_members
+products = Product.__table__
+users = User.__table__
+
+
+def _lot_set(stored, new):
+    return {'quantity': stored.quantity + new.quantity,
+            'listed_value': stored.listed_value + new.listed_value}
+
+
+def _apply(connection, deltas):
+    """Add ``deltas``, ``{(owner_id, type, variety): (quantity, value)}``,
+    to the lots of every cooperative each owner belongs to."""
+    deltas = {key: delta for key, delta in deltas.items() if any(delta)}
+    if not deltas:
+        return
+    cooperatives = defaultdict(list)
+    for user_id, cooperative_id in connection.execute(
+            select(members.c.user_id, members.c.cooperative_id)
+            .where(members.c.user_id.in_({owner for owner, _, _ in deltas}))):
+        cooperatives[user_id].append(cooperative_id)
+    rows = defaultdict(lambda: [0, 0])
+    for (owner, product_type, variety), (quantity, value) in deltas.items():
+        for cooperative_id in cooperatives[owner]:
+            row = rows[cooperative_id, product_type, variety]
+            row[0] += quantity
+            row[1] += value
+    if rows:
+        upsert(connection, lots, [
+            {'cooperative_id': cooperative_id, 'product_type': product_type,
+             'product_variety': variety, 'quantity': quantity, 'listed_value': value}
+            for (cooperative_id, product_type, variety), (quantity, value) in sorted(rows.items())],
+            LOT_KEYS, _lot_set)
+
+
+def adjust_lots(owner_id, product_ids, sign, connection=None):
+    """Add (``sign`` 1) or remove (-1) ``product_ids`` from the lots of
+    ``owner_id``'s cooperatives. For Core writes that move products between
+    owners; ORM writes are handled by the events below."""
+    connection = connection or db.session.connection()
+    groups = connection.execute(
+        select(products.c.product_type, products.c.product_variety,
+               func.count(), func.sum(products.c.price))
+        .where(products.c.id.in_(product_ids), products.c.is_available.is_(True))
+        .group_by(products.c.product_type, products.c.product_variety)).all()
+    _apply(connection, {(owner_id, product_type, variety): (sign * count, sign * value)
+                        for product_type, variety, count, value in groups})
+
+
+def _member_supply(connection, cooperative_id, user_id, sign):
+    groups = connection.execute(
+        select(products.c.product_type, products.c.product_variety,
+               func.count(), func.sum(products.c.price))
+        .where(products.c.owner_supplier == user_id, products.c.is_available.is_(True))
+        .group_by(products.c.product_type, products.c.product_variety)).all()
+    if groups:
+        upsert(connection, lots, [
+            {'cooperative_id': cooperative_id, 'product_type': product_type,
+             'product_variety': variety, 'quantity': sign * count,
+             'listed_value': sign * value}
+            for product_type, variety, count, value in groups], LOT_KEYS, _lot_set)
+
+
+def join(cooperative_id, user_id, connection=None):
+    """Make ``user_id`` a member and pool their listings. Only that member's
+    products are read, however large the cooperative."""
+    connection = connection or db.session.connection()
+    if connection.execute(select(members.c.user_id).where(
+            members.c.cooperative_id == cooperative_id,
+            members.c.user_id == user_id)).first() is not None:
+        return False
+    connection.execute(insert(members).values(cooperative_id=cooperative_id, user_id=user_id))
+    _member_supply(connection, cooperative_id, user_id, 1)
+    return True
+
+
+def leave(cooperative_id, user_id, connection=None):
+    connection = connection or db.session.connection()
+    removed = connection.execute(delete(members).where(
+        members.c.cooperative_id == cooperative_id, members.c.user_id == user_id))
+    if removed.rowcount:
+        _member_supply(connection, cooperative_id, user_id, -1)
+    return bool(removed.rowcount)
+
+
+# A user's cooperative column is their primary membership.
+
+@event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, target):
+    if target.cooperative is not None:
+        join(target.cooperative, target.id, connection)
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    history = db.inspect(target).attrs.cooperative.history
+    for cooperative_id in history.deleted or ():
+        if cooperative_id is not None:
+            leave(cooperative_id, target.id, connection)
+    for cooperative_id in history.added or ():
+        if cooperative_id is not None:
+            join(cooperative_id, target.id, connection)
+
+
+# Listing changes apply their difference to the lots.
+
+LISTING_ATTRS = ('owner_supplier', 'product_type', 'product_variety', 'price', 'is_available')
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    return value
+
+
+# Load the old value on set even when the attribute was expired, so the
+# update knows which lot the listing counted towards.
+for attr in LISTING_ATTRS:
+    event.listen(getattr(Product, attr), 'set', _keep_old_value,
+                 active_history=True, retval=True)
+
+
+def _contribution(values, sign):
+    owner, product_type, variety, price, available = values
+    if owner is None or available is False or price is None:
+        return {}
+    return {(owner, product_type, variety): (sign, sign * price)}
+
+
+def _merge(*contributions):
+    merged = defaultdict(lambda: (0, 0))
+    for contribution in contributions:
+        for key, (quantity, value) in contribution.items():
+            merged[key] = (merged[key][0] + quantity, merged[key][1] + value)
+    return merged
+
+
+def _current(target):
+    return tuple(getattr(target, attr) for attr in LISTING_ATTRS)
+
+
+def _previous(target):
+    attrs = db.inspect(target).attrs
+    values = []
+    for attr in LISTING_ATTRS:
+        history = attrs[attr].history
+        values.append(history.deleted[0] if history.deleted else getattr(target, attr))
+    return tuple(values)
+
+
+@event.listens_for(Product, 'after_insert')
+def _product_inserted(mapper, connection, target):
+    _apply(connection, _contribution(_current(target), 1))
+
+
+@event.listens_for(Product, 'after_update')
+def _product_updated(mapper, connection, target):
+    previous, current = _previous(target), _current(target)
+    if previous != current:
+        _apply(connection, _merge(_contribution(previous, -1), _contribution(current, 1)))
+
+
+@event.listens_for(Product, 'after_delete')
+def _product_deleted(mapper, connection, target):
+    _apply(connection, _contribution(_current(target), -1))
+
+
+# Reads and repair.
+
+def lot_products(cooperative_id, product_type, product_variety, limit=None):
+    """The member listings that make up a lot, cheapest first."""
+    statement = select(Product).join(
+        members, members.c.user_id == Product.owner_supplier).where(
+        members.c.cooperative_id == cooperative_id,
+        Product.product_type == product_type,
+        Product.product_variety == product_variety,
+        Product.is_available.is_(True)).order_by(Product.price, Product.id)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return db.session.execute(statement).scalars().all()
+
+
+def backfill_members():
+    """Add a membership for every user's primary cooperative that lacks one."""
+    missing = select(users.c.cooperative, users.c.id).where(
+        users.c.cooperative.isnot(None),
+        ~select(members.c.user_id).where(and_(
+            members.c.cooperative_id == users.c.cooperative,
+            members.c.user_id == users.c.id)).exists())
+    return db.session.execute(insert(members).from_select(
+        ['cooperative_id', 'user_id'], missing)).rowcount
+
+
+def rebuild_lots():
+    """Recompute every lot from the members' listings in one grouped
+    statement. Returns the number of lots."""
+    db.session.execute(delete(lots))
+    pooled = select(members.c.cooperative_id, products.c.product_type,
+                    products.c.product_variety, func.count(), func.sum(products.c.price)) \
+        .select_from(members.join(products, products.c.owner_supplier == members.c.user_id)) \
+        .where(products.c.is_available.is_(True)) \
+        .group_by(members.c.cooperative_id, products.c.product_type,
+                  products.c.product_variety)
+    count = db.session.execute(insert(lots).from_select(
+        LOT_KEYS + ['quantity', 'listed_value'], pooled)).rowcount
+    db.session.commit()
+    return count
@@ -0,0 +1,248 @@
+from datetime import date, datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, case, delete, event, func, insert, null, select
+
+from app import db
+from app.database import read_session, upsert
+from app.models import CooperativeSupply, PriceRollup, Product, Transaction, User
+
+
+PRICE_KEYS = ['product_type', 'product_variety', 'location', 'day']
+SUPPLY_KEYS = ['cooperative_id', 'product_type']
+
+rollups = PriceRollup.__table__
+supply = CooperativeSupply.__table__
+products = Product.__table__
+users = User.__table__
+transactions = Transaction.__table__
+
+
+# Incremental updates, run inside the transaction that lists or trades.
+
+def _price_set(connection):
+    if connection.dialect.name == 'postgresql':
+        least, greatest = func.least, func.greatest
+    else:
+        least, greatest = func.min, func.max
+
+    def set_(stored, new):
+        return {
+            'listings': stored.listings + new.listings,
+            'price_min': least(func.coalesce(stored.price_min, new.price_min),
+                               func.coalesce(new.price_min, stored.price_min)),
+            'price_max': greatest(func.coalesce(stored.price_max, new.price_max),
+                                  func.coalesce(new.price_max, stored.price_max)),
+            'price_sum': stored.price_sum + new.price_sum,
+            # Only the batch rebuild computes medians; a new listing makes
+            # the stored one wrong, so drop it rather than serve it.
+            'price_median': case((new.listings > 0, null()), else_=stored.price_median),
+            'sales': stored.sales + new.sales,
+            'sales_value': stored.sales_value + new.sales_value,
+        }
+    return set_
+
+
+def _supply_set(stored, new):
+    return {'listings': stored.listings + new.listings,
+            'listed_value': stored.listed_value + new.listed_value}
+
+
+@event.listens_for(Product, 'after_insert')
+def product_listed(mapper, connection, target):
+    upsert(connection, rollups, [{
+        'product_type': target.product_type, 'product_variety': target.product_variety,
+        'location': target.location, 'day': (target.timestamp or datetime.utcnow()).date(),
+        'listings': 1, 'price_min': target.price, 'price_max': target.price,
+        'price_sum': target.price, 'sales': 0, 'sales_value': 0}],
+        PRICE_KEYS, _price_set(connection))
+    if target.owner_supplier is not None:
+        adjust_supply(target.owner_supplier, [target.id], 1, connection)
+
+
+def record_sales(product_ids, connection=None):
+    """Count ``product_ids`` as sold today at their current prices."""
+    connection = connection or db.session.connection()
+    groups = connection.execute(
+        select(products.c.product_type, products.c.product_variety, products.c.location,
+               func.count(), func.sum(products.c.price))
+        .where(products.c.id.in_(product_ids))
+        .group_by(products.c.product_type, products.c.product_variety,
+                  products.c.location)).all()
+    today = datetime.utcnow().date()
+    if groups:
+        upsert(connection, rollups, [
+            {'product_type': product_type, 'product_variety': variety, 'location': location,
+             'day': today, 'listings': 0, 'price_min': None, 'price_max': None,
+             'price_sum': 0, 'sales': count, 'sales_value': value}
+            for product_type, variety, location, count, value in groups],
+            PRICE_KEYS, _price_set(connection))
+
+
+def adjust_supply(user_id, product_ids, sign, connection=None):
+    """Add (``sign`` 1) or remove (-1) ``product_ids`` from the supply of
+    ``user_id``'s cooperative."""
+    connection = connection or db.session.connection()
+    groups = connection.execute(
+        select(users.c.cooperative, products.c.product_type,
+               func.count(), func.sum(products.c.price))
+        .select_from(products.join(users, users.c.id == user_id))
+        .where(and_(products.c.id.in_(product_ids), users.c.cooperative.isnot(None)))
+        .group_by(users.c.cooperative, products.c.product_type)).all()
+    if groups:
+        upsert(connection, supply, [
+            {'cooperative_id': cooperative_id, 'product_type': product_type,
+             'listings': sign * count, 'listed_value': sign * value}
+            for cooperative_id, product_type, count, value in groups],
+            SUPPLY_KEYS, _supply_set)
+
+
+# Batch rebuilds over streamed chunks; need requirements-analytics.txt.
+
+def _pandas():
+    try:
+        import pandas
+    except ImportError:
+        raise RuntimeError('The analytics batch jobs need pandas and numpy; '
+                           'install requirements-analytics.txt.')
+    return pandas
+
+
+def _chunks(statement, chunk_size):
+    result = db.session.execute(statement.execution_options(stream_results=True))
+    yield from result.partitions(chunk_size)
+
+
+def _merge(partials, keys, pd):
+    if not partials:
+        return None
+    return pd.concat(partials).groupby(keys, sort=True).sum()
+
+
+def _medians(histogram, keys):
+    """Exact median per group from (group, price) -> count histograms."""
+    frame = histogram.rename('n').reset_index()
+    frame['cum'] = frame.groupby(keys)['n'].cumsum()
+    total = frame.groupby(keys)['n'].transform('sum')
+    low = frame[frame['cum'] >= (total + 1) // 2].groupby(keys)['price'].first()
+    high = frame[frame['cum'] >= total // 2 + 1].groupby(keys)['price'].first()
+    return (low + high) / 2
+
+
+def _replace(table, frame):
+    records = frame.astype(object).where(frame.notna(), None).to_dict('records')
+    db.session.execute(delete(table))
+    for start in range(0, len(records), 5000):
+        db.session.execute(insert(table), records[start:start + 5000])
+
+
+def rebuild_price_rollups(chunk_size=None):
+    """Recompute every price_rollups row, medians included, from products
+    and the ledger. Returns the number of rows written."""
+    pd = _pandas()
+    chunk_size = chunk_size or current_app.config['ANALYTICS_CHUNK_SIZE']
+
+    histograms = []
+    for rows in _chunks(select(products.c.timestamp, products.c.product_type,
+                               products.c.product_variety, products.c.location,
+                               products.c.price), chunk_size):
+        frame = pd.DataFrame(rows, columns=['timestamp'] + PRICE_KEYS[:3] + ['price'])
+        frame['day'] = pd.to_datetime(frame.pop('timestamp')).dt.normalize()
+        histograms.append(frame.groupby(PRICE_KEYS + ['price']).size())
+    histogram = _merge(histograms, PRICE_KEYS + ['price'], pd)
+
+    sales = []
+    for rows in _chunks(select(transactions.c.timestamp, products.c.product_type,
+                               products.c.product_variety, products.c.location,
+                               transactions.c.amount)
+                        .select_from(transactions.join(
+                            products, products.c.id == transactions.c.product_id))
+                        .where(transactions.c.buyer_id.isnot(None)), chunk_size):
+        frame = pd.DataFrame(rows, columns=['timestamp'] + PRICE_KEYS[:3] + ['amount'])
+        frame['day'] = pd.to_datetime(frame.pop('timestamp')).dt.normalize()
+        sales.append(frame.groupby(PRICE_KEYS)['amount'].agg(['size', 'sum'])
+                     .rename(columns={'size': 'sales', 'sum': 'sales_value'}))
+    sales = _merge(sales, PRICE_KEYS, pd)
+
+    parts = []
+    if histogram is not None:
+        listed = histogram.rename('n').reset_index()
+        listed['value'] = listed['price'] * listed['n']
+        grouped = listed.groupby(PRICE_KEYS)
+        parts.append(pd.DataFrame({
+            'listings': grouped['n'].sum(), 'price_min': grouped['price'].min(),
+            'price_max': grouped['price'].max(), 'price_sum': grouped['value'].sum(),
+            'price_median': _medians(histogram, PRICE_KEYS)}))
+    if sales is not None:
+        parts.append(sales)
+    if not parts:
+        frame = pd.DataFrame(columns=PRICE_KEYS)
+    else:
+        frame = pd.concat(parts, axis=1).reset_index()
+    for column in ('listings', 'price_sum', 'sales', 'sales_value'):
+        frame[column] = frame[column].fillna(0).astype('int64') if column in frame else 0
+    for column in ('price_min', 'price_max', 'price_median'):
+        if column not in frame:
+            frame[column] = None
+    frame['day'] = pd.to_datetime(frame['day']).dt.date
+    _replace(rollups, frame)
+    db.session.commit()
+    return len(frame)
+
+
+def rebuild_cooperative_supply(chunk_size=None):
+    """Recompute cooperative_supply from the products members hold."""
+    pd = _pandas()
+    chunk_size = chunk_size or current_app.config['ANALYTICS_CHUNK_SIZE']
+    partials = []
+    for rows in _chunks(select(users.c.cooperative, products.c.product_type,
+                               products.c.price)
+                        .select_from(products.join(
+                            users, users.c.id == products.c.owner_supplier))
+                        .where(users.c.cooperative.isnot(None)), chunk_size):
+        frame = pd.DataFrame(rows, columns=SUPPLY_KEYS + ['price'])
+        partials.append(frame.groupby(SUPPLY_KEYS)['price'].agg(['size', 'sum'])
+                        .rename(columns={'size': 'listings', 'sum': 'listed_value'}))
+    merged = _merge(partials, SUPPLY_KEYS, pd)
+    frame = pd.DataFrame(columns=SUPPLY_KEYS + ['listings', 'listed_value']) \
+        if merged is None else merged.reset_index()
+    _replace(supply, frame)
+    db.session.commit()
+    return len(frame)
+
+
+# Dashboard reads: small indexed tables only.
+
+def price_trend(product_type, product_variety=None, location=None, days=30):
+    """Daily figures for ``product_type`` over the last ``days`` days. The
+    median is only meaningful for a single variety and location, and is
+    None for days with listings made since the last rollup-analytics run."""
+    single = product_variety is not None and location is not None
+    statement = select(
+        rollups.c.day, func.sum(rollups.c.listings), func.min(rollups.c.price_min),
+        func.max(rollups.c.price_max), func.sum(rollups.c.price_sum),
+        func.max(rollups.c.price_median), func.sum(rollups.c.sales),
+        func.sum(rollups.c.sales_value)).where(
+        rollups.c.product_type == product_type,
+        rollups.c.day >= date.today() - timedelta(days=days)).group_by(
+        rollups.c.day).order_by(rollups.c.day)
+    if product_variety is not None:
+        statement = statement.where(rollups.c.product_variety == product_variety)
+    if location is not None:
+        statement = statement.where(rollups.c.location == location)
+    return [{'day': day.isoformat(), 'listings': listings, 'price_min': low,
+             'price_max': high,
+             'price_mean': round(total / listings, 2) if listings else None,
+             'price_median': median if single else None,
+             'sales': sales, 'sales_value': value}
+            for day, listings, low, high, total, median, sales, value
+            in read_session().execute(statement)]
+
+
+def cooperative_supply(cooperative_id):
+    return [{'product_type': product_type, 'listings': listings, 'listed_value': value}
+            for product_type, listings, value in read_session().execute(
+                select(supply.c.product_type, supply.c.listings, supply.c.listed_value)
+                .where(supply.c.cooperative_id == cooperative_id,
+                       supply.c.listings > 0)
+                .order_by(supply.c.listed_value.desc()))]
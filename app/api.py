@@ -0,0 +1,443 @@
+import base64
+import gzip
+import json
+import zlib
+from concurrent import futures
+from datetime import date, datetime
+
+from flask import Blueprint, abort, current_app, request, stream_with_context, url_for
+from flask_login import current_user
+from sqlalchemy import func, select
+from werkzeug.exceptions import HTTPException
+
+from app import cache, db, feed, orderbook, sync
+from app.database import read_session
+from app.exceptions import OrderError, PasswordHasherBusy, ValidationError
+from app.market import listing_page
+from app.models import BuyOrder, Comment, Cooperative, CooperativeLot, Forum, Permission, Post, \
+    Product, User, cooperative_members, registered_farmers
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+NDJSON = 'application/x-ndjson'
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(value):
+    """``value`` as compact UTF-8 JSON; orjson is used when installed and
+    gives the same output."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def _json(value, status=200):
+    return current_app.response_class(dumps(value), status=status,
+                                      mimetype='application/json')
+
+
+@api.errorhandler(HTTPException)
+def http_error(e):
+    return _json({'error': e.description}, e.code)
+
+
+@api.errorhandler(OrderError)
+@api.errorhandler(ValidationError)
+def validation_error(e):
+    return _json({'error': str(e)}, 422)
+
+
+@api.before_request
+def require_login():
+    # The API shares the site's login session.
+    if not current_user.is_authenticated:
+        return _json({'error': 'Log in first.'}, 401)
+
+
+# Request arguments: ?fields=a,b&per_page=n&cursor=...&format=ndjson
+
+def _fields():
+    fields = request.args.get('fields')
+    return set(filter(None, fields.split(','))) if fields else None
+
+
+def _sparse(data, fields):
+    if fields is None:
+        return data
+    return {key: value for key, value in data.items() if key in fields}
+
+
+def _per_page():
+    per_page = request.args.get('per_page', current_app.config['API_PER_PAGE'], type=int)
+    return max(1, min(per_page, current_app.config['API_MAX_PER_PAGE']))
+
+
+def _streaming():
+    # A query argument rather than the Accept header, so the ETag, which is
+    # built from the full path, differs between the two formats.
+    return request.args.get('format') == 'ndjson'
+
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(str(last_id).encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        abort(400, 'Invalid cursor.')
+
+
+# Serializers take a whole page, so counts are fetched once per page.
+
+def _rows_json(rows, fields):
+    return [_sparse(row.to_json(), fields) for row in rows]
+
+
+def _post_counts(user_ids):
+    if not user_ids:
+        return {}
+    return dict(read_session().execute(
+        select(Post.author_id, func.count()).where(Post.author_id.in_(user_ids))
+        .group_by(Post.author_id)).all())
+
+
+def _users_json(users, fields):
+    counts = {}
+    if fields is None or 'post_count' in fields:
+        counts = _post_counts([user.id for user in users])
+    return [_sparse(user.to_json(post_count=counts.get(user.id, 0)), fields)
+            for user in users]
+
+
+def _page(rows, next_cursor, serialize):
+    next_url = None
+    if next_cursor is not None:
+        args = dict(request.args.to_dict(), cursor=next_cursor)
+        next_url = url_for(request.endpoint, **request.view_args, **args)
+    return _json({'items': serialize(rows, _fields()), 'next_cursor': next_cursor,
+                  'next_url': next_url})
+
+
+def _stream(chunks, serialize):
+    """JSON Lines, one object per line, written a chunk at a time."""
+    fields = _fields()
+
+    def generate():
+        for rows in chunks:
+            yield b''.join(dumps(item) + b'\n' for item in serialize(rows, fields))
+    return current_app.response_class(stream_with_context(generate()), mimetype=NDJSON)
+
+
+def _id_page(query, model):
+    """One page of ``query`` in id order after the request's cursor, and
+    the cursor for the next page (or None on the last page)."""
+    per_page = _per_page()
+    after = decode_cursor(request.args.get('cursor'))
+    if after is not None:
+        query = query.filter(model.id > after)
+    rows = query.order_by(model.id).limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1].id)
+    return rows, next_cursor
+
+
+def _id_chunks(query, model):
+    """All of ``query`` after the request's cursor in keyset chunks. Each
+    chunk is expunged once written so the session does not grow."""
+    size = current_app.config['API_STREAM_CHUNK']
+    after = decode_cursor(request.args.get('cursor'))
+    while True:
+        chunk = query if after is None else query.filter(model.id > after)
+        rows = chunk.order_by(model.id).limit(size).all()
+        if not rows:
+            return
+        yield rows
+        after = rows[-1].id
+        for row in rows:
+            query.session.expunge(row)
+
+
+def _collection(query, model, serialize):
+    if _streaming():
+        return _stream(_id_chunks(query, model), serialize)
+    return _page(*_id_page(query, model), serialize)
+
+
+def _get(model, id):
+    row = read_session().get(model, id)
+    if row is None:
+        abort(404, f'No such {model.__name__.lower()}.')
+    return row
+
+
+@api.route('/products')
+@cache.conditional('products')
+def get_products():
+    """Products on the market, newest first, with the market's cursor."""
+    cursor = request.args.get('cursor')
+    if _streaming():
+        def chunks(cursor=cursor):
+            size = current_app.config['API_STREAM_CHUNK']
+            session = read_session()
+            while True:
+                rows, cursor = listing_page(cursor, per_page=size)
+                yield rows
+                for row in rows:
+                    session.expunge(row)
+                if cursor is None:
+                    return
+        return _stream(chunks(), _rows_json)
+    return _page(*listing_page(cursor, per_page=_per_page()), _rows_json)
+
+
+@api.route('/products/<int:id>')
+@cache.conditional('products')
+def get_product(id):
+    product = _get(Product, id)
+    data = dict(product.to_json(), description=product.description,
+                is_available=product.is_available,
+                supplier_url=url_for('.get_user', id=product.owner_supplier)
+                if product.owner_supplier is not None else None)
+    return _json(_sparse(data, _fields()))
+
+
+@api.route('/users/<int:id>')
+@cache.conditional('users', 'posts')
+def get_user(id):
+    return _json(_users_json([_get(User, id)], _fields())[0])
+
+
+@api.route('/users/<int:id>/posts')
+@cache.conditional('posts')
+def get_user_posts(id):
+    user = _get(User, id)
+    return _collection(read_session().query(Post).filter(Post.author_id == user.id),
+                       Post, _rows_json)
+
+
+@api.route('/users/<int:id>/farmers')
+@cache.conditional('users', 'registered_farmers', 'posts')
+def get_user_farmers(id):
+    if not current_user.can(Permission.REGISTER):
+        abort(403, 'Only agents can list registered farmers.')
+    agent = _get(User, id)
+    query = read_session().query(User).join(
+        registered_farmers, registered_farmers.c.farmer_id == User.id).filter(
+        registered_farmers.c.agent_id == agent.id)
+    return _collection(query, User, _users_json)
+
+
+@api.route('/bids', methods=['GET', 'POST'])
+def get_bids():
+    """The viewer's standing bids; POST one to have it matched against the
+    market's listings."""
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(400, 'Body must be a JSON object.')
+        numbers = {}
+        for field in ('max_price', 'quantity'):
+            try:
+                numbers[field] = int(data.get(field))
+            except (TypeError, ValueError):
+                abort(400, f'{field} must be a whole number.')
+        order = orderbook.place(current_user, data.get('product_type'),
+                                data.get('product_variety'), data.get('location'),
+                                **numbers)
+        return _json(order.to_json(), 201)
+    return _collection(BuyOrder.query.filter(BuyOrder.buyer_id == current_user.id),
+                       BuyOrder, _rows_json)
+
+
+def _own_bid(id):
+    # From the primary: a bid may have just been placed or filled.
+    order = BuyOrder.query.get(id)
+    if order is None or order.buyer_id != current_user.id:
+        abort(404, 'No such bid.')
+    return order
+
+
+@api.route('/bids/<int:id>', methods=['GET', 'DELETE'])
+def get_bid(id):
+    order = _own_bid(id)
+    if request.method == 'DELETE':
+        order = orderbook.cancel(order)
+    return _json(_sparse(order.to_json(), _fields()))
+
+
+@api.route('/cooperatives/<int:id>')
+@cache.conditional('cooperatives')
+def get_cooperative(id):
+    return _json(_sparse(_get(Cooperative, id).to_json(), _fields()))
+
+
+@api.route('/cooperatives/<int:id>/members')
+@cache.conditional('users', 'cooperative_members', 'posts')
+def get_cooperative_members(id):
+    cooperative = _get(Cooperative, id)
+    query = read_session().query(User).join(
+        cooperative_members, cooperative_members.c.user_id == User.id).filter(
+        cooperative_members.c.cooperative_id == cooperative.id)
+    return _collection(query, User, _users_json)
+
+
+@api.route('/cooperatives/<int:id>/lots')
+@cache.conditional('cooperative_lots')
+def get_cooperative_lots(id):
+    cooperative = _get(Cooperative, id)
+    lots = read_session().query(CooperativeLot).filter(
+        CooperativeLot.cooperative_id == cooperative.id, CooperativeLot.quantity > 0).order_by(
+        CooperativeLot.listed_value.desc())
+    return _json({'items': [_sparse({'product_type': lot.product_type,
+                                     'product_variety': lot.product_variety,
+                                     'quantity': lot.quantity, 'price': lot.price,
+                                     'listed_value': lot.listed_value}, _fields())
+                            for lot in lots]})
+
+
+@api.route('/forums')
+@cache.conditional('forums')
+def get_forums():
+    return _collection(read_session().query(Forum), Forum, _rows_json)
+
+
+@api.route('/forums/<int:id>')
+@cache.conditional('forums')
+def get_forum(id):
+    return _json(_sparse(_get(Forum, id).to_json(), _fields()))
+
+
+@api.route('/forums/<int:id>/posts')
+@cache.conditional('posts')
+def get_forum_posts(id):
+    forum = _get(Forum, id)
+    return _collection(read_session().query(Post).filter(Post.forum_id == forum.id),
+                       Post, _rows_json)
+
+
+@api.route('/forums/<int:id>/subscription', methods=['PUT', 'DELETE'])
+def forum_subscription(id):
+    """Follow a forum's posts and comments in the feed, or stop."""
+    forum = Forum.query.get(id)
+    if forum is None:
+        abort(404, 'No such forum.')
+    connection = db.session.connection()
+    if request.method == 'PUT':
+        feed.subscribe(connection, forum.id, current_user.id)
+    else:
+        feed.unsubscribe(connection, forum.id, current_user.id)
+    db.session.commit()
+    return _json({'forum_url': url_for('api.get_forum', id=forum.id),
+                  'subscribed': request.method == 'PUT'})
+
+
+@api.route('/feed')
+# Following a forum, joining a cooperative or gaining an agent changes
+# which timelines the feed reads.
+@cache.conditional('feed_entries', 'feed_timelines', 'feed_events', 'feed_sources',
+                   'forum_subscriptions', 'cooperative_members', 'registered_farmers')
+def get_feed():
+    """What's new for the viewer, newest first: posts and comments in the
+    forums they follow, and listings from their cooperatives' members and
+    from their agents or farmers."""
+    events, next_before = feed.read(read_session(), current_user.id,
+                                    decode_cursor(request.args.get('cursor')), _per_page())
+    return _page(events, encode_cursor(next_before) if next_before is not None else None,
+                 _rows_json)
+
+
+@api.route('/posts/<int:id>')
+@cache.conditional('posts')
+def get_post(id):
+    return _json(_sparse(_get(Post, id).to_json(), _fields()))
+
+
+@api.route('/posts/<int:id>/comments')
+@cache.conditional('comments')
+def get_post_comments(id):
+    post = _get(Post, id)
+    query = read_session().query(Comment).filter(
+        Comment.general_post_id == post.id, Comment.disabled.isnot(True))
+    return _collection(query, Comment, _rows_json)
+
+
+@api.route('/comments/<int:id>')
+@cache.conditional('comments')
+def get_comment(id):
+    return _json(_sparse(_get(Comment, id).to_json(), _fields()))
+
+
+def _request_json():
+    """The request body as JSON, gunzipped when sent with
+    Content-Encoding: gzip and never inflated past SYNC_MAX_BYTES.
+
+    Only application/json is accepted: a form or text/plain body can be
+    posted from any site without a CORS preflight."""
+    if request.mimetype != 'application/json':
+        abort(415, 'Send the body as application/json.')
+    limit = current_app.config['SYNC_MAX_BYTES']
+    if request.content_length is not None and request.content_length > limit:
+        abort(413, 'Upload too large.')
+    body = request.get_data(cache=False)
+    if request.content_encoding == 'gzip':
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = inflater.decompress(body, limit + 1)
+        except zlib.error:
+            abort(400, 'Body is not valid gzip.')
+    if len(body) > limit:
+        abort(413, 'Upload too large.')
+    try:
+        return json.loads(body or b'{}')
+    except ValueError:
+        abort(400, 'Body is not valid JSON.')
+
+
+def _gzipped(value):
+    response = _json(value)
+    response.vary.add('Accept-Encoding')
+    if 'gzip' in request.accept_encodings and \
+            response.content_length >= current_app.config['SYNC_GZIP_MIN_BYTES']:
+        response.set_data(gzip.compress(response.get_data(), 6))
+        response.content_encoding = 'gzip'
+    return response
+
+
+@api.route('/sync', methods=['GET', 'POST'])
+def sync_changes():
+    """One round trip per session: POST the queued operations with the last
+    seq seen, get back their results and every change since, gzipped.
+
+        {"since": 120, "operations": [{"key": "...", "op": "add_product", "data": {...}}]}
+    """
+    if request.method == 'POST':
+        payload = _request_json()
+        if not isinstance(payload, dict):
+            abort(400, 'Body must be a JSON object.')
+        since, operations = payload.get('since', 0), payload.get('operations') or []
+    else:
+        since, operations = request.args.get('since', 0, type=int), []
+    if not isinstance(since, int) or since < 0:
+        abort(400, 'since must be a sequence number.')
+    try:
+        results = sync.push(current_user, operations) if operations else []
+    except (PasswordHasherBusy, futures.TimeoutError):
+        abort(503, 'The server is busy, try the upload again.')
+    return _gzipped(dict(sync.pull(current_user, since), results=results))
@@ -0,0 +1,134 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import Blueprint, Response, abort, current_app, redirect, request, \
+    send_from_directory, url_for
+from werkzeug.security import safe_join
+
+from app.picture_handler import product_image_path
+
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_fingerprints = {}
+
+static_assets = Blueprint('assets', __name__)
+
+
+def fingerprint(filename):
+    """Short content hash of a static file, cached until it changes on disk."""
+    path = safe_join(current_app.static_folder, filename)
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    cached = _fingerprints.get(path)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    _fingerprints[path] = ((stat.st_mtime_ns, stat.st_size), digest.hexdigest()[:12])
+    return _fingerprints[path][1]
+
+
+@static_assets.app_template_global()
+def asset_url(filename):
+    version = fingerprint(filename)
+    if version is None:
+        return url_for('static', filename=filename)
+    return url_for('assets.asset', fingerprint=version, filename=filename)
+
+
+@static_assets.app_template_global()
+def product_image_url(image, size='card', ext='jpg'):
+    filename = product_image_path(image, size, ext)
+    if '.' in image:
+        return asset_url(filename)
+    # Pipeline output is already named after its content hash.
+    return url_for('assets.asset', fingerprint=image, filename=filename)
+
+
+def _current_fingerprint(filename):
+    name = os.path.basename(filename)
+    if filename.startswith('product_pics/') and '-' in name:
+        return name.split('-', 1)[0]
+    return fingerprint(filename)
+
+
+@static_assets.route('/assets/<fingerprint>/<path:filename>')
+def asset(fingerprint, filename):
+    if safe_join(current_app.static_folder, filename) is None:
+        abort(404)
+    current = _current_fingerprint(filename)
+    if current is None:
+        abort(404)
+    if fingerprint != current:
+        return redirect(url_for('assets.asset', fingerprint=current, filename=filename))
+
+    served, encoding = filename, None
+    for name, suffix in ENCODINGS:
+        if name in request.accept_encodings and \
+                os.path.exists(safe_join(current_app.static_folder, filename + suffix)):
+            served, encoding = filename + suffix, name
+            break
+    # Each encoding is a different body, so it needs its own strong tag.
+    etag = f'{current}-{encoding}' if encoding else current
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    accel_prefix = current_app.config['ASSETS_X_ACCEL_REDIRECT']
+    if accel_prefix:
+        # The front-end server streams the file; no bytes pass through Python.
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + served
+        response.set_etag(etag)
+    else:
+        # With USE_X_SENDFILE set, send_from_directory hands off to the
+        # server through X-Sendfile instead of reading the file.
+        response = send_from_directory(current_app.static_folder, served,
+                                       mimetype=mimetype, etag=etag)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response.make_conditional(request)
+
+
+def compress_static(force=False):
+    """Write .gz (and .br when brotli is installed) next to every
+    compressible static file whose variant is missing or older."""
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    compressors = [('.gz', lambda data: gzip.compress(data, 9, mtime=0))]
+    if brotli is not None:
+        compressors.append(('.br', brotli.compress))
+
+    written = []
+    for root, _, files in os.walk(current_app.static_folder):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            source = os.path.join(root, name)
+            data = None
+            for suffix, compress in compressors:
+                target = source + suffix
+                if not force and os.path.exists(target) and \
+                        os.path.getmtime(target) >= os.path.getmtime(source):
+                    continue
+                if data is None:
+                    with open(source, 'rb') as f:
+                        data = f.read()
+                with open(target, 'wb') as out:
+                    out.write(compress(data))
+                written.append(target)
+    return written
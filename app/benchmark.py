@@ -0,0 +1,267 @@
+import http.client
+import json
+import random
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+from flask import current_app
+from sqlalchemy import func, insert, select, update
+
+from app import db, identity, ledger, orderbook
+from app.models import BuyOrder, Product, Role, User
+from app.seed import CROPS, PASSWORD
+
+
+FLOWS = ('browse', 'search', 'purchase', 'sell', 'login', 'profile')
+TOP_UP = 10 ** 9
+
+Result = namedtuple('Result', 'flow requests p50 p95 p99 throughput queries errors')
+
+
+class TestClientDriver:
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.headers.get('X-Query-Count')
+
+    def close(self):
+        pass
+
+
+class ServerDriver:
+    """Drives the app through a real WSGI server on a local port, so the
+    numbers include HTTP parsing and the server's threading."""
+
+    def __init__(self, app):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port)
+        self.cookies = SimpleCookie()
+
+    def request(self, method, path, data=None):
+        headers = {}
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{key}={morsel.value}'
+                                          for key, morsel in self.cookies.items())
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        for cookie in response.headers.get_all('Set-Cookie') or []:
+            self.cookies.load(cookie)
+        return response.status, response.getheader('X-Query-Count')
+
+    def close(self):
+        self.connection.close()
+        self.server.shutdown()
+
+
+class Context:
+    """The benchmark user and the products it can buy and sell."""
+
+    def __init__(self, user, rng):
+        self.user = user
+        self.rng = rng
+        self.for_sale = db.session.execute(
+            select(Product.id).where(Product.owner_supplier.is_(None),
+                                     Product.is_available.is_(True))
+            .order_by(func.random()).limit(5000)).scalars().all()
+        self.owned = db.session.execute(
+            select(Product.id).where(Product.owner_supplier == user.id)).scalars().all()
+
+    def buy(self, driver):
+        if not self.for_sale:
+            raise RuntimeError('No products left on the market; seed more.')
+        product_id = self.for_sale.pop()
+        self.owned.append(product_id)
+        return driver.request('POST', '/market', {'purchased_product': product_id})
+
+    def sell(self, driver):
+        if not self.owned:
+            self.buy(driver)
+        product_id = self.owned.pop(self.rng.randrange(len(self.owned)))
+        self.for_sale.append(product_id)
+        return driver.request('POST', '/market', {'sold_product': product_id})
+
+
+def _flow(name, driver, context):
+    if name == 'browse':
+        return driver.request('GET', '/market')
+    if name == 'search':
+        return driver.request('GET', '/market?' + urlencode(
+            {'q': context.rng.choice(list(CROPS))}))
+    if name == 'purchase':
+        return context.buy(driver)
+    if name == 'sell':
+        return context.sell(driver)
+    if name == 'login':
+        return driver.request('POST', '/login',
+                              {'email': context.user.email, 'password': PASSWORD})
+    return driver.request('GET', f'/user/{context.user.firstname}')
+
+
+def _bench_user():
+    """A seeded agent, topped up so purchases never run out of money."""
+    agent = Role.query.filter_by(name='Agent').first()
+    user = User.query.filter(User.email.like('agent%@seed.tingo'),
+                             User.role_id == agent.id).order_by(User.id).first()
+    if user is None:
+        raise RuntimeError('No seeded agent found; run "flask seed" first.')
+    if user.balance < TOP_UP:
+        # Credited through the ledger so reconcile-wallets stays clean.
+        ledger.record([{'seller_id': user.id, 'amount': TOP_UP - user.balance}])
+        db.session.execute(update(User).where(User.id == user.id).values(
+            wallet=TOP_UP, identity_version=User.identity_version + 1))
+        db.session.commit()
+        identity.forget(user.id)
+    return user
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, max(0, int(round(fraction * len(samples))) - 1))]
+
+
+def run(flows=FLOWS, requests=200, warmup=10, server=False, random_seed=1):
+    """Time ``requests`` requests of each flow, one at a time, as the first
+    seeded agent. Returns one Result per flow; latencies are in ms."""
+    app = current_app._get_current_object()
+    saved = {key: app.config[key] for key in ('WTF_CSRF_ENABLED', 'INSTRUMENTATION_HEADERS')}
+    app.config.update(WTF_CSRF_ENABLED=False, INSTRUMENTATION_HEADERS=True)
+    rng = random.Random(random_seed)
+    context = Context(_bench_user(), rng)
+    driver = ServerDriver(app) if server else TestClientDriver(app)
+    results = []
+    try:
+        driver.request('POST', '/login', {'email': context.user.email, 'password': PASSWORD})
+        for name in flows:
+            for _ in range(warmup):
+                _flow(name, driver, context)
+            latencies, queries, errors = [], [], 0
+            started = time.perf_counter()
+            for _ in range(requests):
+                before = time.perf_counter()
+                status, query_count = _flow(name, driver, context)
+                latencies.append((time.perf_counter() - before) * 1000)
+                if query_count is not None:
+                    queries.append(int(query_count))
+                if status >= 400:
+                    errors += 1
+            elapsed = time.perf_counter() - started
+            latencies.sort()
+            results.append(Result(
+                name, requests, percentile(latencies, 0.50), percentile(latencies, 0.95),
+                percentile(latencies, 0.99), requests / elapsed if elapsed else 0.0,
+                sum(queries) / len(queries) if queries else None, errors))
+    finally:
+        driver.close()
+        app.config.update(saved)
+    return results
+
+
+def save(results, path):
+    with open(path, 'w') as out:
+        json.dump({'created': datetime.utcnow().isoformat(timespec='seconds'),
+                   'results': {result.flow: result._asdict() for result in results}},
+                  out, indent=2)
+
+
+def compare(results, path, tolerance=0.10):
+    """Regressions against a saved baseline: (flow, metric, baseline, now)
+    wherever p95 latency or queries per request grew, or throughput fell,
+    by more than ``tolerance``."""
+    with open(path) as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for result in results:
+        old = baseline.get(result.flow)
+        if old is None:
+            continue
+        for metric, worse in (('p95', 1), ('queries', 1), ('throughput', -1)):
+            before, now = old.get(metric), getattr(result, metric)
+            if not before or now is None:
+                continue
+            if worse * (now - before) / before > tolerance:
+                regressions.append((result.flow, metric, before, now))
+    return regressions
+
+
+def order_book(bids=1000, quantity=5, settle=True, random_seed=1):
+    """Matches (listings bought) per second. First in memory, on a synthetic
+    book of ``bids`` bids for ``quantity`` listings each; then, with
+    ``settle``, end to end through orders.checkout against the seeded
+    market, which uses up market listings."""
+    rng = random.Random(random_seed)
+    app = current_app._get_current_object()
+    max_fill = app.config['ORDER_BOOK_MAX_FILL']
+
+    book = orderbook.Book()
+    for product_id in range(bids * quantity):
+        book.add_ask(product_id, rng.randrange(50, 1000, 10))
+    for order_id in range(bids):
+        book.add_bid(orderbook.Bid(order_id, 1, rng.randrange(500, 1000, 10)), quantity)
+    matches, started = 0, time.perf_counter()
+    while book.crossed():
+        fill = book.match(max_fill)
+        if fill is None:
+            break
+        matches += len(fill.product_ids)
+    elapsed = time.perf_counter() - started
+    report = {'memory_matches': matches, 'memory_seconds': elapsed,
+              'memory_matches_per_second': matches / elapsed if elapsed else 0.0}
+    if not settle:
+        return report
+
+    user = _bench_user()
+    keys = db.session.execute(
+        select(Product.product_type, Product.product_variety, Product.location,
+               func.max(Product.price))
+        .where(Product.owner_supplier.is_(None), Product.is_available.is_(True))
+        .group_by(Product.product_type, Product.product_variety, Product.location)
+        .order_by(func.count().desc()).limit(bids)).all()
+    if not keys:
+        raise RuntimeError('No products left on the market; seed more.')
+    db.session.execute(insert(BuyOrder.__table__), [
+        {'buyer_id': user.id, 'product_type': product_type, 'product_variety': variety,
+         'location': location, 'max_price': price, 'quantity': quantity, 'filled': 0,
+         'status': 'open', 'timestamp': datetime.utcnow()}
+        for product_type, variety, location, price in keys])
+    db.session.commit()
+    # A private set of books; the fills are not queued for the matcher.
+    books = orderbook.OrderBooks(app)
+    enabled = app.config['ORDER_BOOK_ENABLED']
+    app.config['ORDER_BOOK_ENABLED'] = False
+    try:
+        started = time.perf_counter()
+        books.rebuild()
+        rebuilt = time.perf_counter()
+        fills = books.settle(list(books.books))
+        finished = time.perf_counter()
+    finally:
+        app.config['ORDER_BOOK_ENABLED'] = enabled
+    matches = sum(len(fill.product_ids) for fill in fills)
+    report.update(
+        bids=len(keys), rebuild_seconds=rebuilt - started, fills=len(fills),
+        settled_matches=matches, settle_seconds=finished - rebuilt,
+        settled_matches_per_second=matches / (finished - rebuilt) if finished > rebuilt else 0.0)
+    return report
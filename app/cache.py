@@ -0,0 +1,260 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import cached_property, wraps
+
+from flask import current_app, has_app_context, make_response, request, session
+from flask_login import current_user
+from markupsafe import Markup
+from sqlalchemy import event, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.dml import UpdateBase
+
+from app import db
+from app.database import upsert
+from app.models import CacheVersion
+
+
+PENDING_KEY = 'fragment_cache_tables'
+
+cache_versions = CacheVersion.__table__
+
+# Tables some fragment or conditional view depends on. Only writes to these
+# bump a version; the rest (the ledger, logs, queues) take no version row
+# lock as they commit.
+WATCHED_TABLES = set()
+
+
+def watch(*tables):
+    """Declare that cached output depends on ``tables``. Called at import
+    time, so every process bumps the same tables."""
+    WATCHED_TABLES.update(tables)
+
+
+def _next_version(stored, new):
+    return {'version': stored.version + 1}
+
+
+class LRUBackend:
+    """In-process fragments bounded by total size. The versions are rows in
+    cache_versions, bumped as the writing transaction commits, so a write in
+    any worker changes the keys and ETags of every worker."""
+    versions_in_database = True
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self._size -= len(value)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[0])
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def versions(self, tables):
+        stored = dict(db.session.execute(
+            select(cache_versions.c.table_name, cache_versions.c.version)
+            .where(cache_versions.c.table_name.in_(tables))).all())
+        return [stored.get(table, 0) for table in tables]
+
+    def bump(self, tables, connection=None):
+        """Count a write to ``tables``: in ``connection``'s transaction when
+        given, otherwise in one of its own."""
+        rows = [{'table_name': table, 'version': 1} for table in sorted(tables)]
+        if connection is not None:
+            upsert(connection, cache_versions, rows, ['table_name'], _next_version)
+            return
+        with db.engine.begin() as connection:
+            upsert(connection, cache_versions, rows, ['table_name'], _next_version)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class RedisBackend:
+    """Fragments and versions shared by every worker through a Redis
+    compatible server."""
+    versions_in_database = False
+
+    def __init__(self, url, ttl):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('FRAGMENT_CACHE_BACKEND = "redis" needs the redis package.')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get('fragment:' + key)
+        return None if value is None else value.decode('utf-8')
+
+    def set(self, key, value):
+        self.client.set('fragment:' + key, value.encode('utf-8'), ex=self.ttl)
+
+    def versions(self, tables):
+        return [int(value or 0) for value in
+                self.client.mget(['version:' + table for table in tables])]
+
+    def bump(self, tables):
+        pipeline = self.client.pipeline(transaction=False)
+        for table in tables:
+            pipeline.incr('version:' + table)
+        pipeline.execute()
+
+    def clear(self):
+        for key in self.client.scan_iter('fragment:*'):
+            self.client.delete(key)
+
+
+def init_app(app):
+    config = app.config
+    if config['FRAGMENT_CACHE_BACKEND'] == 'redis':
+        backend = RedisBackend(config['FRAGMENT_CACHE_URL'], config['FRAGMENT_CACHE_TTL'])
+    else:
+        backend = LRUBackend(config['FRAGMENT_CACHE_MAX_BYTES'], config['FRAGMENT_CACHE_TTL'])
+    app.extensions['fragment_cache'] = backend
+    app.add_template_global(fragment)
+
+
+def backend():
+    return current_app.extensions['fragment_cache']
+
+
+def _digest(*parts):
+    raw = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def fragment(name, tables, *parts, caller):
+    """Jinja call block that caches its body until one of ``tables`` is
+    written to:
+
+        {% call fragment('market:listing', ['products'], cursor) %}...{% endcall %}
+
+    ``parts`` must hold everything else the body depends on, and
+    ``tables`` must be watched: the view rendering it is usually a
+    :func:`conditional` on the same tables."""
+    unwatched = set(tables) - WATCHED_TABLES
+    if unwatched:
+        raise ValueError(f'Fragment {name} depends on unwatched tables '
+                         f'{", ".join(sorted(unwatched))}; declare them with cache.watch().')
+    cache = backend()
+    key = f'{name}:{_digest(cache.versions(tables), parts)}'
+    html = cache.get(key)
+    if html is None:
+        html = str(caller())
+        cache.set(key, html)
+    return Markup(html)
+
+
+class Deferred:
+    """Call ``func`` on first use of ``value``. A view passes its queries
+    this way so a fragment cache hit skips the database as well."""
+
+    def __init__(self, func, *args, **kwargs):
+        self.func, self.args, self.kwargs = func, args, kwargs
+
+    @cached_property
+    def value(self):
+        return self.func(*self.args, **self.kwargs)
+
+
+def conditional(*tables):
+    """Send an ETag built from the table versions and the viewer, and
+    answer a matching If-None-Match with 304 before the view runs."""
+    watch(*tables)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            ttl = current_app.config['FRAGMENT_CACHE_TTL']
+            # The time bucket also expires pages before their CSRF tokens do.
+            etag = _digest(backend().versions(tables), request.full_path,
+                           current_user.get_id(),
+                           getattr(current_user, 'identity_version', None),
+                           int(time.time() // ttl))
+            if etag in request.if_none_match:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapped
+    return decorator
+
+
+def _backend():
+    if has_app_context() and 'fragment_cache' in current_app.extensions:
+        return backend()
+    return None
+
+
+def _bump(tables):
+    cache = _backend()
+    if cache is not None:
+        cache.bump(sorted(tables))
+
+
+@event.listens_for(Engine, 'after_execute')
+def _track_writes(conn, clauseelement, multiparams, params, execution_options, result):
+    if not isinstance(clauseelement, UpdateBase) or \
+            not execution_options.get('cache_invalidate', True) or \
+            clauseelement.table.name not in WATCHED_TABLES:
+        return
+    if conn.in_transaction():
+        conn.info.setdefault(PENDING_KEY, set()).add(clauseelement.table.name)
+    else:
+        # Autocommitted; the commit event has already fired.
+        _bump([clauseelement.table.name])
+
+
+@event.listens_for(Engine, 'commit')
+def _bump_on_commit(conn):
+    tables = conn.info.pop(PENDING_KEY, None)
+    if not tables:
+        return
+    cache = _backend()
+    if cache is not None and cache.versions_in_database:
+        # Runs just before COMMIT, in the same transaction. Rows are locked
+        # in name order and only until the commit.
+        cache.bump(tables, conn)
+    else:
+        _bump(tables)
+
+
+@event.listens_for(Engine, 'rollback')
+def _discard_on_rollback(conn):
+    conn.info.pop(PENDING_KEY, None)
@@ -0,0 +1,227 @@
+import click
+from flask import Blueprint, current_app
+
+from app import aggregation, analytics, assets, benchmark, counters, feed, geo, importer, \
+    ledger, orderbook, search, security, seed as seeding, sync
+from app.models import User
+
+
+# Registered without a group so the commands stay top-level: flask reconcile-wallets.
+commands = Blueprint('commands', __name__, cli_group=None)
+
+
+@commands.cli.command('reconcile-wallets')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--repair', is_flag=True,
+              help='Rewrite drifted balances from the ledger.')
+def reconcile_wallets(batch_size, repair):
+    """Check cached wallet balances and points against the ledger."""
+    drifts = ledger.reconcile(batch_size=batch_size)
+    for drift in drifts:
+        click.echo(f'user {drift.user_id}: wallet {drift.wallet} '
+                   f'(ledger {drift.expected_wallet}), points {drift.points} '
+                   f'(ledger {drift.expected_points})')
+    click.echo(f'{len(drifts)} drifted balances.')
+    if repair and drifts:
+        repaired = ledger.repair(drifts)
+        click.echo(f'{len(repaired)} repaired; the rest changed since they were read.')
+
+
+@commands.cli.command('backfill-wallets')
+def backfill_wallets():
+    """Give accounts with no wallet balance the opening balance."""
+    changed = ledger.backfill_wallets()
+    click.echo(f'{len(changed)} wallets set to the opening balance.')
+
+
+@commands.cli.command('compress-assets')
+@click.option('--force', is_flag=True, help='Rewrite up-to-date variants.')
+def compress_assets(force):
+    """Precompute gzip/brotli variants of static CSS and JS."""
+    written = assets.compress_static(force=force)
+    for path in written:
+        click.echo(path)
+    click.echo(f'{len(written)} compressed files written.')
+
+
+@commands.cli.command('recompute-counters')
+def recompute_counters():
+    """Repair forum and post counters that drifted from the real rows."""
+    counters.recompute()
+    click.echo('Forum and post counters recomputed.')
+
+
+@commands.cli.command('bench-hashers')
+@click.option('--seconds', default=1.0, show_default=True)
+@click.option('--setting', 'settings', multiple=True, metavar='SCHEME[:ROUNDS]',
+              help='Setting to measure; defaults to every scheme as configured.')
+def bench_hashers(seconds, settings):
+    """Report password hashes per second for each hasher setting."""
+    parsed = []
+    for setting in settings or security.SCHEMES:
+        scheme, _, rounds = setting.partition(':')
+        parsed.append((scheme, int(rounds) if rounds
+                       else current_app.config['PASSWORD_HASH_ROUNDS'].get(scheme)))
+    for scheme, rounds, rate in security.benchmark(parsed, seconds=seconds):
+        if rate is None:
+            click.echo(f'{scheme:8} backend not installed')
+        else:
+            click.echo(f'{scheme:8} rounds={rounds or "default":<8} {rate:10.1f} hashes/s')
+
+
+@commands.cli.command('import-farmers')
+@click.argument('source', type=click.File('rb'))
+@click.option('--agent', 'agent_email', required=True,
+              help='Email of the agent registering the farmers.')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Defaults to the file extension.')
+def import_farmers(source, agent_email, fmt):
+    """Bulk-register farmers from a CSV or JSON Lines file."""
+    agent = User.query.filter_by(email=agent_email.lower()).first()
+    if agent is None:
+        raise click.BadParameter(f'No user with email {agent_email}.')
+    fmt = fmt or source.name.rsplit('.', 1)[-1].lower()
+    report = importer.import_farmers(source, fmt, agent)
+    for error in report['errors']:
+        click.echo(f'row {error["row"]}: {error["error"]}')
+    click.echo(f'{report["imported"]} farmers imported, '
+               f'{len(report["errors"])} rows rejected.')
+
+
+@commands.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Create the product full-text index and refill it from products."""
+    search.rebuild_index()
+    click.echo('Product search index rebuilt.')
+
+
+@commands.cli.command('load-places')
+@click.option('--gazetteer', type=click.Path(exists=True, dir_okay=False),
+              help='CSV of name,state,latitude,longitude; defaults to GAZETTEER_PATH.')
+def load_places(gazetteer):
+    """Load the gazetteer and point existing rows at their places."""
+    added = geo.load_gazetteer(gazetteer)
+    click.echo(f'{added} places added.')
+    for location in geo.backfill():
+        click.echo(f'unresolved location: {location}')
+
+
+@commands.cli.command('startup-report')
+def startup_report():
+    """Show how long create_app took and which heavy modules it loaded."""
+    report = current_app.extensions['startup_report']
+    for line in report.lines():
+        click.echo(line)
+
+
+@commands.cli.command('seed')
+@click.option('--scale', type=click.Choice(list(seeding.SCALES)), default='small',
+              show_default=True)
+@click.option('--random-seed', default=42, show_default=True)
+@click.option('--agents', type=int)
+@click.option('--farmers', type=int)
+@click.option('--buyers', type=int)
+@click.option('--cooperatives', type=int)
+@click.option('--products', type=int)
+@click.option('--forums', type=int)
+@click.option('--posts', type=int)
+@click.option('--comments', type=int)
+def seed(scale, random_seed, **counts):
+    """Fill the database with a synthetic marketplace for load testing."""
+    written = seeding.seed(scale, random_seed=random_seed, **counts)
+    for table, count in written.items():
+        click.echo(f'{table:20} {count:>8}')
+    click.echo(f'Seeded users log in with the password "{seeding.PASSWORD}".')
+
+
+@commands.cli.command('benchmark')
+@click.option('--flow', 'flows', multiple=True, type=click.Choice(benchmark.FLOWS),
+              help='Flow to time; defaults to all of them.')
+@click.option('--requests', 'count', default=200, show_default=True)
+@click.option('--warmup', default=10, show_default=True)
+@click.option('--server', is_flag=True,
+              help='Go through a local WSGI server instead of the test client.')
+@click.option('--save', type=click.Path(dir_okay=False), help='Write the results as a baseline.')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False),
+              help='Baseline to check the results against.')
+@click.option('--tolerance', default=0.10, show_default=True)
+def run_benchmark(flows, count, warmup, server, save, compare, tolerance):
+    """Time the market, purchase, sell, login and profile flows on seeded data."""
+    results = benchmark.run(flows or benchmark.FLOWS, requests=count, warmup=warmup,
+                            server=server)
+    click.echo(f'{"flow":10} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+               f'{"req/s":>8} {"queries":>8} {"errors":>7}')
+    for r in results:
+        queries = '-' if r.queries is None else f'{r.queries:.1f}'
+        click.echo(f'{r.flow:10} {r.p50:8.2f} {r.p95:8.2f} {r.p99:8.2f} '
+                   f'{r.throughput:8.1f} {queries:>8} {r.errors:7}')
+    if save:
+        benchmark.save(results, save)
+    if compare:
+        regressions = benchmark.compare(results, compare, tolerance=tolerance)
+        for flow, metric, before, now in regressions:
+            click.echo(f'regression: {flow} {metric} {before:.2f} -> {now:.2f}', err=True)
+        if regressions:
+            raise SystemExit(1)
+
+
+@commands.cli.command('match-orders')
+@click.option('--once', is_flag=True, help='Run one matching pass and exit.')
+def match_orders(once):
+    """Match standing bids against market listings. Run one of these."""
+    if not current_app.config['ORDER_BOOK_ENABLED']:
+        click.echo('ORDER_BOOK_ENABLED is off: changes are not queued, so only '
+                   'bids and listings present at startup are matched.', err=True)
+    books = orderbook.OrderBooks(current_app._get_current_object())
+    if once:
+        fills = books.run_once()
+        click.echo(f'{sum(len(fill.product_ids) for fill in fills)} listings bought '
+                   f'in {len(fills)} fills.')
+        return
+    books.run()
+
+
+@commands.cli.command('bench-order-book')
+@click.option('--bids', default=1000, show_default=True)
+@click.option('--quantity', default=5, show_default=True, help='Listings wanted per bid.')
+@click.option('--memory-only', is_flag=True, help='Skip the settled run, which buys market listings.')
+def bench_order_book(bids, quantity, memory_only):
+    """Time order matching in memory and settled through checkout."""
+    report = benchmark.order_book(bids, quantity, settle=not memory_only)
+    click.echo(f"in memory: {report['memory_matches']} matches, "
+               f"{report['memory_matches_per_second']:,.0f}/s")
+    if not memory_only:
+        click.echo(f"rebuild:   {report['rebuild_seconds'] * 1000:.1f}ms")
+        click.echo(f"settled:   {report['settled_matches']} matches in {report['fills']} fills "
+                   f"for {report['bids']} bids, {report['settled_matches_per_second']:,.0f}/s")
+
+
+@commands.cli.command('rollup-analytics')
+@click.option('--chunk-size', type=int, help='Rows per streamed chunk; defaults to ANALYTICS_CHUNK_SIZE.')
+def rollup_analytics(chunk_size):
+    """Rebuild the price and cooperative supply rollups from scratch."""
+    prices = analytics.rebuild_price_rollups(chunk_size)
+    supplies = analytics.rebuild_cooperative_supply(chunk_size)
+    click.echo(f'{prices} price rollups and {supplies} cooperative supply rows written.')
+
+
+@commands.cli.command('rebuild-lots')
+def rebuild_lots():
+    """Add missing cooperative memberships and recompute every lot."""
+    joined = aggregation.backfill_members()
+    count = aggregation.rebuild_lots()
+    click.echo(f'{joined} memberships added, {count} lots written.')
+
+
+@commands.cli.command('sync-backfill')
+def sync_backfill():
+    """Log every existing user and owned product for offline clients."""
+    sync.backfill()
+    click.echo('Change log backfilled.')
+
+
+@commands.cli.command('trim-feeds')
+def trim_feeds():
+    """Cut feeds and timelines to FEED_MAX_ENTRIES; run it from cron."""
+    deleted = feed.trim()
+    click.echo(f'{deleted} feed rows deleted.')
@@ -0,0 +1,105 @@
+from datetime import datetime
+
+from sqlalchemy import func, select, update
+
+from app import db
+from app.models import Comment, Forum, Post
+
+
+forums = Forum.__table__
+posts = Post.__table__
+comments = Comment.__table__
+
+
+def _bump_forum(connection, forum_id, posts_delta=0, comments_delta=0,
+                activity=None):
+    values = {'post_count': forums.c.post_count + posts_delta,
+              'comment_count': forums.c.comment_count + comments_delta}
+    if activity is not None:
+        values['last_activity'] = activity
+    connection.execute(update(forums).where(forums.c.id == forum_id)
+                       .values(**values))
+
+
+def post_inserted(mapper, connection, target):
+    if target.forum_id is not None:
+        _bump_forum(connection, target.forum_id, posts_delta=1,
+                    activity=target.last_activity)
+
+
+def post_updated(mapper, connection, target):
+    history = db.inspect(target).attrs.forum_id.history
+    if not history.has_changes():
+        return
+    comment_count = target.comment_count or 0
+    for forum_id in history.deleted:
+        if forum_id is not None:
+            _bump_forum(connection, forum_id, -1, -comment_count)
+    for forum_id in history.added:
+        if forum_id is not None:
+            _bump_forum(connection, forum_id, 1, comment_count,
+                        activity=target.last_activity)
+
+
+def post_deleted(mapper, connection, target):
+    if target.forum_id is not None:
+        _bump_forum(connection, target.forum_id, -1,
+                    -(target.comment_count or 0))
+
+
+def _post_forum(post_id):
+    return select(posts.c.forum_id).where(posts.c.id == post_id) \
+        .scalar_subquery()
+
+
+def comment_inserted(mapper, connection, target):
+    if target.general_post_id is None:
+        return
+    activity = target.timestamp or datetime.utcnow()
+    connection.execute(
+        update(posts).where(posts.c.id == target.general_post_id)
+        .values(comment_count=posts.c.comment_count + 1,
+                last_activity=activity))
+    connection.execute(
+        update(forums).where(forums.c.id == _post_forum(target.general_post_id))
+        .values(comment_count=forums.c.comment_count + 1,
+                last_activity=activity))
+
+
+def comment_deleted(mapper, connection, target):
+    if target.general_post_id is None:
+        return
+    connection.execute(
+        update(posts).where(posts.c.id == target.general_post_id)
+        .values(comment_count=posts.c.comment_count - 1))
+    connection.execute(
+        update(forums).where(forums.c.id == _post_forum(target.general_post_id))
+        .values(comment_count=forums.c.comment_count - 1))
+
+
+db.event.listen(Post, 'after_insert', post_inserted)
+db.event.listen(Post, 'after_update', post_updated)
+db.event.listen(Post, 'after_delete', post_deleted)
+db.event.listen(Comment, 'after_insert', comment_inserted)
+db.event.listen(Comment, 'after_delete', comment_deleted)
+
+
+def recompute():
+    """Rebuild every post and forum counter from the rows themselves, one
+    correlated UPDATE per table."""
+    comment_totals = select(func.count(comments.c.id)) \
+        .where(comments.c.general_post_id == posts.c.id).scalar_subquery()
+    last_comment = select(func.max(comments.c.timestamp)) \
+        .where(comments.c.general_post_id == posts.c.id).scalar_subquery()
+    db.session.execute(update(posts).values(
+        comment_count=comment_totals,
+        last_activity=func.coalesce(last_comment, posts.c.timestamp)))
+
+    db.session.execute(update(forums).values(
+        post_count=select(func.count(posts.c.id))
+        .where(posts.c.forum_id == forums.c.id).scalar_subquery(),
+        comment_count=select(func.coalesce(func.sum(posts.c.comment_count), 0))
+        .where(posts.c.forum_id == forums.c.id).scalar_subquery(),
+        last_activity=select(func.max(posts.c.last_activity))
+        .where(posts.c.forum_id == forums.c.id).scalar_subquery()))
+    db.session.commit()
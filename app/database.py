@@ -0,0 +1,108 @@
+import sqlite3
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from app import db
+
+
+_sqlite_pragmas = {}
+
+# Tables made by raw DDL (SQLite virtual tables) or by SQLite itself, and
+# not in the metadata; names are prefixes, so the shadow tables behind
+# virtual tables match too.
+UNMANAGED_TABLES = {'sqlite_'}
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Alembic filter: autogenerate must not drop the unmanaged tables."""
+    return not (type_ == 'table' and reflected and compare_to is None
+                and name.startswith(tuple(UNMANAGED_TABLES)))
+
+
+def engine_options(app, uri):
+    """Pool settings for ``uri``: a bounded QueuePool with pre-ping; SQLite
+    connections are shared across threads and get a busy timeout."""
+    config = app.config
+    url = make_url(uri)
+    options = {'pool_pre_ping': True}
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            options.update(poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
+            return options
+        options.update(poolclass=QueuePool,
+                       connect_args={'check_same_thread': False,
+                                     'timeout': config['SQLITE_PRAGMAS']['busy_timeout'] / 1000})
+    options.update(pool_size=config['DATABASE_POOL_SIZE'],
+                   max_overflow=config['DATABASE_MAX_OVERFLOW'],
+                   pool_timeout=config['DATABASE_POOL_TIMEOUT'],
+                   pool_recycle=config['DATABASE_POOL_RECYCLE'])
+    return options
+
+
+def configure(app):
+    """Fill in engine options and the replica bind before the first engine
+    is created."""
+    options = engine_options(app, app.config['SQLALCHEMY_DATABASE_URI'])
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    if app.config['DATABASE_REPLICA_URL']:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds['replica'] = app.config['DATABASE_REPLICA_URL']
+        app.config['SQLALCHEMY_BINDS'] = binds
+    _sqlite_pragmas.update(app.config['SQLITE_PRAGMAS'])
+    app.teardown_appcontext(_remove_read_session)
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in _sqlite_pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+def read_session():
+    """Session for read-only listing queries: bound to the replica when one
+    is configured, otherwise the normal session."""
+    if not current_app.config['DATABASE_REPLICA_URL']:
+        return db.session
+    session = current_app.extensions.get('read_session')
+    if session is None:
+        # Flask-SQLAlchemy fills ``binds`` with every table mapped to the
+        # primary, and those win over ``bind``; an empty map leaves the replica.
+        session = current_app.extensions['read_session'] = db.create_scoped_session(
+            options={'bind': db.get_engine(bind='replica'), 'binds': {}})
+    return session
+
+
+def _remove_read_session(exception=None):
+    session = current_app.extensions.get('read_session')
+    if session is not None:
+        session.remove()
+
+
+def upsert(connection, table, rows, keys, set_=None):
+    """Insert ``rows`` into ``table``; where a row's ``keys`` already exist,
+    apply ``set_(table.c, excluded)`` instead, a dict of column name to new
+    value in terms of the stored row and the rejected one, or keep the
+    stored row when ``set_`` is None."""
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise NotImplementedError(f'upsert is not implemented for {dialect}.')
+    statement = insert(table)
+    if set_ is None:
+        statement = statement.on_conflict_do_nothing(index_elements=keys)
+    else:
+        statement = statement.on_conflict_do_update(
+            index_elements=keys, set_=set_(table.c, statement.excluded))
+    return connection.execute(statement, rows)
@@ -1,2 +1,10 @@
 class ValidationError(ValueError):
     pass
+
+
+class OrderError(ValueError):
+    pass
+
+
+class PasswordHasherBusy(RuntimeError):
+    pass
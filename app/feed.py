@@ -0,0 +1,229 @@
+from flask import current_app
+from sqlalchemy import and_, delete, event, func, insert, literal, or_, select, tuple_
+
+from app import db
+from app.database import upsert
+from app.models import Comment, FeedEntry, FeedEvent, FeedSource, FeedTimelineEntry, Post, \
+    Product, cooperative_members, forum_subscriptions, registered_farmers
+
+
+events = FeedEvent.__table__
+entries = FeedEntry.__table__
+sources = FeedSource.__table__
+timelines = FeedTimelineEntry.__table__
+members = cooperative_members
+posts = Post.__table__
+subscriptions = forum_subscriptions
+
+SUMMARY_LENGTH = 140
+
+# For each kind of source, who its events reach, and the inverse: which
+# sources of that kind a user follows. An 'agent' source is an agent's
+# listings as seen by their farmers; a 'farmer' source the other way round.
+AUDIENCES = {
+    'forum': lambda id: select(subscriptions.c.user_id.label('user_id'))
+    .where(subscriptions.c.forum_id == id),
+    'cooperative': lambda id: select(members.c.user_id.label('user_id'))
+    .where(members.c.cooperative_id == id),
+    'agent': lambda id: select(registered_farmers.c.farmer_id.label('user_id'))
+    .where(registered_farmers.c.agent_id == id),
+    'farmer': lambda id: select(registered_farmers.c.agent_id.label('user_id'))
+    .where(registered_farmers.c.farmer_id == id),
+}
+FOLLOWED = {
+    'forum': lambda user_id: select(subscriptions.c.forum_id)
+    .where(subscriptions.c.user_id == user_id),
+    'cooperative': lambda user_id: select(members.c.cooperative_id)
+    .where(members.c.user_id == user_id),
+    'agent': lambda user_id: select(registered_farmers.c.agent_id)
+    .where(registered_farmers.c.farmer_id == user_id),
+    'farmer': lambda user_id: select(registered_farmers.c.farmer_id)
+    .where(registered_farmers.c.agent_id == user_id),
+}
+
+
+def _summary(text):
+    text = ' '.join((text or '').split())
+    if len(text) > SUMMARY_LENGTH:
+        text = text[:SUMMARY_LENGTH - 3].rstrip() + '...'
+    return text
+
+
+def _pulled(connection, source_type, source_id):
+    """Whether the source's audience is too wide to push to. A source that
+    once was stays so, and counting stops at the limit. Two writers may
+    both find it too wide; the second insert is ignored."""
+    if connection.execute(select(sources.c.source_id).where(
+            sources.c.source_type == source_type,
+            sources.c.source_id == source_id)).first() is not None:
+        return True
+    limit = current_app.config['FEED_FANOUT_LIMIT']
+    audience = AUDIENCES[source_type](source_id).limit(limit + 1).subquery()
+    if connection.execute(select(func.count()).select_from(audience)).scalar() <= limit:
+        return False
+    upsert(connection, sources, {'source_type': source_type, 'source_id': source_id},
+           ['source_type', 'source_id'])
+    return True
+
+
+def publish(connection, kind, actor_id, subject_id, event_sources, summary=None,
+            forum_id=None):
+    """Store an event and fan it out: one INSERT ... SELECT copies its id
+    into the feed of everyone following one of ``event_sources``, except
+    the actor. Wide sources get one timeline row instead."""
+    event_id = connection.execute(insert(events).values(
+        kind=kind, actor_id=actor_id, subject_id=subject_id, forum_id=forum_id,
+        summary=_summary(summary))).inserted_primary_key[0]
+    pushed = []
+    for source_type, source_id in event_sources:
+        if _pulled(connection, source_type, source_id):
+            connection.execute(insert(timelines).values(
+                source_type=source_type, source_id=source_id, event_id=event_id))
+        else:
+            pushed.append(AUDIENCES[source_type](source_id))
+    if pushed:
+        # UNION drops the users reached through more than one source.
+        audience = (pushed[0] if len(pushed) == 1 else pushed[0].union(*pushed[1:])).subquery()
+        connection.execute(insert(entries).from_select(
+            ['user_id', 'event_id'],
+            select(audience.c.user_id, literal(event_id))
+            .where(audience.c.user_id != actor_id)))
+    return event_id
+
+
+def retract(connection, kind, subject_id):
+    # Feed entries left pointing at the event are skipped on read and
+    # dropped by trim.
+    connection.execute(delete(events).where(events.c.kind == kind,
+                                            events.c.subject_id == subject_id))
+
+
+def subscribe(connection, forum_id, user_id):
+    """Follow ``forum_id``; returns False if already following."""
+    return bool(upsert(connection, subscriptions, {'forum_id': forum_id, 'user_id': user_id},
+                       ['forum_id', 'user_id']).rowcount)
+
+
+def unsubscribe(connection, forum_id, user_id):
+    return bool(connection.execute(delete(subscriptions).where(
+        subscriptions.c.forum_id == forum_id,
+        subscriptions.c.user_id == user_id)).rowcount)
+
+
+# Content written through the ORM is published in the same transaction.
+
+@event.listens_for(Post, 'after_insert')
+def _post_inserted(mapper, connection, target):
+    if target.forum_id is None or target.author_id is None:
+        return
+    # Posting in a forum follows it, so replies come back to the author.
+    subscribe(connection, target.forum_id, target.author_id)
+    publish(connection, 'post', target.author_id, target.id, [('forum', target.forum_id)],
+            target.body, target.forum_id)
+
+
+@event.listens_for(Comment, 'after_insert')
+def _comment_inserted(mapper, connection, target):
+    if target.general_post_id is None or target.author_id is None or target.disabled:
+        return
+    forum_id = connection.execute(select(posts.c.forum_id).where(
+        posts.c.id == target.general_post_id)).scalar()
+    if forum_id is None:
+        return
+    subscribe(connection, forum_id, target.author_id)
+    publish(connection, 'comment', target.author_id, target.id, [('forum', forum_id)],
+            target.body, forum_id)
+
+
+@event.listens_for(Product, 'after_insert')
+def _product_inserted(mapper, connection, target):
+    owner_id = target.owner_supplier
+    if owner_id is None or target.is_available is False:
+        return
+    cooperatives = connection.execute(select(members.c.cooperative_id).where(
+        members.c.user_id == owner_id)).scalars().all()
+    publish(connection, 'listing', owner_id, target.id,
+            [('cooperative', cooperative_id) for cooperative_id in cooperatives]
+            + [('agent', owner_id), ('farmer', owner_id)],
+            f'{target.product_name}, {target.product_variety} {target.product_type} '
+            f'at {target.price} in {target.location}')
+
+
+@event.listens_for(Post, 'after_delete')
+def _post_deleted(mapper, connection, target):
+    retract(connection, 'post', target.id)
+
+
+@event.listens_for(Comment, 'after_delete')
+def _comment_deleted(mapper, connection, target):
+    retract(connection, 'comment', target.id)
+
+
+@event.listens_for(Product, 'after_delete')
+def _product_deleted(mapper, connection, target):
+    retract(connection, 'listing', target.id)
+
+
+# Reads.
+
+def _followed_sources(session, user_id):
+    return session.execute(select(sources.c.source_type, sources.c.source_id).where(or_(*[
+        and_(sources.c.source_type == source_type,
+             sources.c.source_id.in_(followed(user_id)))
+        for source_type, followed in FOLLOWED.items()]))).all()
+
+
+def _newest(session, table, user_id, where, before, limit):
+    # The join skips retracted events and the user's own, so a full page
+    # is never cut short after next_before has been chosen.
+    statement = select(table.c.event_id).join(events, events.c.id == table.c.event_id) \
+        .where(events.c.actor_id != user_id, *where)
+    if before is not None:
+        statement = statement.where(table.c.event_id < before)
+    return session.execute(
+        statement.order_by(table.c.event_id.desc()).limit(limit)).scalars().all()
+
+
+def read(session, user_id, before=None, limit=50):
+    """The newest events in ``user_id``'s feed older than event ``before``,
+    and the ``before`` for the next page (None on the last page).
+
+    Pushed events are one range scan of the user's feed; each wide source
+    the user follows adds one range scan of its timeline."""
+    ids = set(_newest(session, entries, user_id, [entries.c.user_id == user_id],
+                      before, limit + 1))
+    for source_type, source_id in _followed_sources(session, user_id):
+        ids.update(_newest(session, timelines, user_id,
+                           [timelines.c.source_type == source_type,
+                            timelines.c.source_id == source_id], before, limit + 1))
+    ids = sorted(ids, reverse=True)
+    next_before = ids[limit - 1] if len(ids) > limit else None
+    ids = ids[:limit]
+    rows = session.execute(select(FeedEvent).where(
+        FeedEvent.id.in_(ids))).scalars().all() if ids else []
+    return sorted(rows, key=lambda row: row.id, reverse=True), next_before
+
+
+def trim():
+    """Cut every feed and timeline to its newest FEED_MAX_ENTRIES and
+    drop events nothing refers to any more. Returns the rows deleted."""
+    keep = current_app.config['FEED_MAX_ENTRIES']
+    deleted = 0
+    for table, keys in ((entries, ['user_id']), (timelines, ['source_type', 'source_id'])):
+        ranked = select(*[table.c[key] for key in keys], table.c.event_id, func.row_number().over(
+            partition_by=[table.c[key] for key in keys],
+            order_by=table.c.event_id.desc()).label('rank')).subquery()
+        columns = keys + ['event_id']
+        deleted += db.session.execute(delete(table).where(
+            tuple_(*[table.c[column] for column in columns]).in_(
+                select(*[ranked.c[column] for column in columns])
+                .where(ranked.c.rank > keep)))).rowcount
+    oldest = db.session.execute(select(func.min(entries.c.event_id))).scalar()
+    oldest_pulled = db.session.execute(select(func.min(timelines.c.event_id))).scalar()
+    floor = min((value for value in (oldest, oldest_pulled) if value is not None), default=None)
+    statement = delete(events)
+    if floor is not None:
+        statement = statement.where(events.c.id < floor)
+    deleted += db.session.execute(statement).rowcount
+    db.session.commit()
+    return deleted
@@ -0,0 +1,194 @@
+import csv
+import math
+import re
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import DDL, and_, bindparam, case, column, select, table, text, update
+
+from app import db
+from app.database import UNMANAGED_TABLES
+from app.models import Cooperative, Place, Product, User
+
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+RTREE_TABLE = 'places_rtree'
+# Seconds an empty places table is trusted before it is read again.
+EMPTY_KEYS_TTL = 5.0
+
+places = Place.__table__
+rtree = table(RTREE_TABLE, column('id'), column('min_lat'), column('max_lat'),
+              column('min_lon'), column('max_lon'))
+LOCATED = {'products': Product, 'users': User, 'cooperatives': Cooperative}
+
+create_rtree = DDL(
+    f'CREATE VIRTUAL TABLE IF NOT EXISTS {RTREE_TABLE} '
+    'USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+db.event.listen(places, 'after_create', create_rtree.execute_if(dialect='sqlite'))
+UNMANAGED_TABLES.add(RTREE_TABLE)
+
+# Normalized location text -> place id, reloaded after GEO_KEYS_TTL
+# seconds so places loaded by another process are picked up.
+_keys = None
+_keys_loaded = 0.0
+_keys_lock = threading.Lock()
+
+
+def normalize(location):
+    location = re.sub(r'[^\w\s-]', ' ', (location or '').lower())
+    location = re.sub(r'\bstate\b', ' ', location)
+    return ' '.join(location.split())
+
+
+def _load_keys(connection):
+    global _keys, _keys_loaded
+    with _keys_lock:
+        # An empty table is soon read again: the gazetteer may not be loaded yet.
+        ttl = current_app.config['GEO_KEYS_TTL'] if _keys else EMPTY_KEYS_TTL
+        if _keys is None or time.monotonic() - _keys_loaded > ttl:
+            keys, states = {}, {}
+            rows = connection.execute(
+                select(places.c.id, places.c.key, places.c.state)
+                .order_by(places.c.id))
+            for place_id, key, state in rows:
+                keys[key] = place_id
+                # A bare state name resolves to the first place listed for it.
+                states.setdefault(normalize(state), place_id)
+            _keys = dict(states, **keys)
+            _keys_loaded = time.monotonic()
+    return _keys
+
+
+def resolve(location, connection=None):
+    """Place id for a free-text location, trying the whole string and then
+    each comma-separated part; None when nothing matches."""
+    keys = _load_keys(connection or db.session.connection())
+    candidates = [location] + (location or '').split(',')
+    for candidate in candidates:
+        place_id = keys.get(normalize(candidate))
+        if place_id is not None:
+            return place_id
+    return None
+
+
+def _set_place(mapper, connection, target):
+    if db.inspect(target).attrs.location.history.has_changes():
+        target.place_id = resolve(target.location, connection)
+
+
+for model in LOCATED.values():
+    db.event.listen(model, 'before_insert', _set_place)
+    db.event.listen(model, 'before_update', _set_place)
+
+
+def load_gazetteer(path=None):
+    """Insert new gazetteer places from CSV (name,state,latitude,longitude)
+    and rebuild the spatial index."""
+    global _keys
+    path = path or current_app.config['GAZETTEER_PATH']
+    existing = set(db.session.execute(select(places.c.key)).scalars())
+    rows = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for record in csv.DictReader(f):
+            key = normalize(record['name'])
+            if key and key not in existing:
+                existing.add(key)
+                rows.append({'name': record['name'], 'state': record['state'],
+                             'key': key,
+                             'latitude': float(record['latitude']),
+                             'longitude': float(record['longitude'])})
+    if rows:
+        db.session.execute(places.insert(), rows)
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite':
+        connection.execute(create_rtree)
+        connection.execute(text(f'DELETE FROM {RTREE_TABLE}'))
+        connection.execute(rtree.insert().from_select(
+            ['id', 'min_lat', 'max_lat', 'min_lon', 'max_lon'],
+            select(places.c.id, places.c.latitude, places.c.latitude,
+                   places.c.longitude, places.c.longitude)))
+    db.session.commit()
+    with _keys_lock:
+        _keys = None
+    return len(rows)
+
+
+def backfill():
+    """Point every product, user and cooperative at its place, resolving each
+    distinct location string once. Returns the strings left unresolved."""
+    unresolved = set()
+    for model in LOCATED.values():
+        target = model.__table__
+        locations = db.session.execute(
+            select(target.c.location).distinct()).scalars().all()
+        resolved = []
+        for location in locations:
+            place_id = resolve(location)
+            if place_id is None:
+                unresolved.add(location)
+            else:
+                resolved.append({'loc': location, 'place': place_id})
+        if resolved:
+            db.session.execute(
+                update(target).where(target.c.location == bindparam('loc'))
+                .values(place_id=bindparam('place')), resolved)
+    db.session.commit()
+    return sorted(unresolved)
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def places_within(latitude, longitude, radius_km):
+    """{place id: distance in km} for places within ``radius_km``.
+
+    A bounding box is looked up in the R*Tree (or the latitude/longitude
+    index off SQLite) and then trimmed by great-circle distance.
+    """
+    dlat = radius_km / KM_PER_DEGREE
+    dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    box = (latitude - dlat, latitude + dlat, longitude - dlon, longitude + dlon)
+    if db.session.connection().dialect.name == 'sqlite':
+        candidates = select(places.c.id, places.c.latitude, places.c.longitude) \
+            .join(rtree, rtree.c.id == places.c.id) \
+            .where(and_(rtree.c.max_lat >= box[0], rtree.c.min_lat <= box[1],
+                        rtree.c.max_lon >= box[2], rtree.c.min_lon <= box[3]))
+    else:
+        candidates = select(places.c.id, places.c.latitude, places.c.longitude) \
+            .where(and_(places.c.latitude.between(box[0], box[1]),
+                        places.c.longitude.between(box[2], box[3])))
+    result = {}
+    for place_id, lat, lon in db.session.execute(candidates):
+        distance = distance_km(latitude, longitude, lat, lon)
+        if distance <= radius_km:
+            result[place_id] = distance
+    return result
+
+
+def nearby(kind, latitude, longitude, radius_km, limit=50, **filters):
+    """Nearest ``kind`` rows ('products', 'users' or 'cooperatives') within
+    ``radius_km``, as ``(row, distance_km)`` pairs, nearest first.
+
+    Products are limited to ones still on the market; ``filters`` are
+    equality filters on the model (e.g. ``product_type='maize'``).
+    """
+    model = LOCATED[kind]
+    distances = places_within(latitude, longitude, radius_km)
+    if not distances:
+        return []
+    query = model.query.filter(model.place_id.in_(distances)).filter_by(**filters)
+    if model is Product:
+        query = query.filter(Product.owner_supplier.is_(None),
+                             Product.is_available.is_(True))
+    nearest_first = case(
+        {place_id: rank for rank, place_id in
+         enumerate(sorted(distances, key=distances.get))},
+        value=model.place_id)
+    rows = query.order_by(nearest_first, model.id).limit(limit).all()
+    return [(row, distances[row.place_id]) for row in rows]
@@ -0,0 +1,52 @@
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm import selectinload
+
+from app import db
+from app.market import LISTING_COLUMNS
+from app.models import Cooperative, Product, User, registered_farmers
+
+
+def farmers_query(agent):
+    """Farmers registered by ``agent``, with their listed products and
+    cooperative batch-loaded: one extra query per relationship for the
+    whole page instead of one per farmer."""
+    return User.query.join(
+        registered_farmers, registered_farmers.c.farmer_id == User.id).filter(
+        registered_farmers.c.agent_id == agent.id).options(
+        selectinload(User.products).load_only(*LISTING_COLUMNS),
+        selectinload(User.member).load_only(Cooperative.id, Cooperative.name,
+                                            Cooperative.location))
+
+
+def farmers_page(agent, page=1, per_page=20):
+    return farmers_query(agent).order_by(User.id.asc()).paginate(
+        page, per_page=per_page, error_out=False)
+
+
+def agents_query(farmer):
+    return User.query.join(
+        registered_farmers, registered_farmers.c.agent_id == User.id).filter(
+        registered_farmers.c.farmer_id == farmer.id).order_by(User.id.asc())
+
+
+def _listed(owner_column):
+    return and_(Product.owner_supplier == owner_column,
+                Product.is_available.is_(True))
+
+
+def agent_totals(agent_ids=None):
+    """``{agent_id: (farmers, listed products, listed value)}`` for every
+    agent, or just ``agent_ids``, from one grouped statement."""
+    farmer_id = registered_farmers.c.farmer_id
+    statement = select(
+        registered_farmers.c.agent_id,
+        func.count(func.distinct(farmer_id)),
+        func.count(Product.id),
+        func.coalesce(func.sum(Product.price), 0)).select_from(
+        registered_farmers.outerjoin(Product, _listed(farmer_id))).group_by(
+        registered_farmers.c.agent_id)
+    if agent_ids is not None:
+        statement = statement.where(registered_farmers.c.agent_id.in_(agent_ids))
+    return {agent_id: (farmers, products, value)
+            for agent_id, farmers, products, value in db.session.execute(statement)}
+
@@ -0,0 +1,130 @@
+import threading
+import time
+
+from flask import current_app, session
+from flask_login import user_logged_in, user_logged_out
+from sqlalchemy import select, update
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app import db, login_manager
+from app.models import Role, User
+
+
+SESSION_KEY = '_identity'
+users = User.__table__
+USER_COLUMNS = [column.key for column in users.columns]
+# Changes to these do not invalidate cached identities.
+VOLATILE_COLUMNS = {'last_seen', 'identity_version'}
+# Shown by base.html on every page. Every write to them bumps
+# identity_version, so they are as current as the permissions.
+DISPLAY_COLUMNS = ('firstname', 'points', 'wallet')
+
+# Process-local tier: user id -> (identity_version, checked until).
+_verified = {}
+_verified_lock = threading.Lock()
+
+
+def snapshot(user):
+    # The session cookie is signed, not encrypted, so it carries only what
+    # authorization and the page header need; the rest of the profile
+    # loads from the database when used.
+    permissions = user.role.permissions if user.role is not None else 0
+    return dict({column: getattr(user, column) for column in DISPLAY_COLUMNS},
+                id=user.id, identity_version=user.identity_version,
+                permissions=permissions or 0)
+
+
+def remember(user):
+    session[SESSION_KEY] = snapshot(user)
+    _mark_verified(user.id, user.identity_version)
+
+
+def forget(user_id=None):
+    with _verified_lock:
+        if user_id is None:
+            _verified.clear()
+        else:
+            _verified.pop(user_id, None)
+
+
+def _mark_verified(user_id, version):
+    ttl = current_app.config['IDENTITY_CACHE_TTL']
+    if ttl:
+        with _verified_lock:
+            _verified[user_id] = (version, time.monotonic() + ttl)
+
+
+def _is_current(user_id, version):
+    with _verified_lock:
+        entry = _verified.get(user_id)
+    if entry is not None and entry[1] > time.monotonic():
+        return entry[0] == version
+    current = db.session.execute(
+        select(users.c.identity_version).where(users.c.id == user_id)).scalar()
+    _mark_verified(user_id, current)
+    return current == version
+
+
+def _restore(cached):
+    user = User.__mapper__.class_manager.new_instance()
+    set_committed_value(user, 'id', cached['id'])
+    set_committed_value(user, 'identity_version', cached['identity_version'])
+    for column in DISPLAY_COLUMNS:
+        set_committed_value(user, column, cached.get(column))
+    # The other columns are marked expired and load together on first use.
+    make_transient_to_detached(user)
+    user = db.session.merge(user, load=False)
+    user._permissions = cached['permissions']
+    return user
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    user_id = int(user_id)
+    cached = session.get(SESSION_KEY)
+    if cached is not None and cached.get('id') == user_id and \
+            _is_current(user_id, cached['identity_version']):
+        return _restore(cached)
+    user = User.query.options(joinedload(User.role)).get(user_id)
+    if user is not None:
+        remember(user)
+    return user
+
+
+def _logged_in(sender, user):
+    remember(user)
+
+
+def _logged_out(sender, user):
+    session.pop(SESSION_KEY, None)
+
+
+user_logged_in.connect(_logged_in)
+user_logged_out.connect(_logged_out)
+
+
+def bump_versions(session, flush_context, instances):
+    for obj in session.dirty:
+        if not isinstance(obj, User):
+            continue
+        state = db.inspect(obj)
+        if any(state.attrs[key].history.has_changes()
+               for key in USER_COLUMNS if key not in VOLATILE_COLUMNS):
+            obj.identity_version = (obj.identity_version or 0) + 1
+            obj.__dict__.pop('_permissions', None)
+            forget(obj.id)
+
+
+def bump_role_members(session, flush_context):
+    for obj in session.dirty:
+        if isinstance(obj, Role) and \
+                db.inspect(obj).attrs.permissions.history.has_changes():
+            session.connection().execute(
+                update(users).where(users.c.role_id == obj.id)
+                .values(identity_version=users.c.identity_version + 1))
+            forget()
+
+
+db.event.listen(db.session, 'before_flush', bump_versions)
+db.event.listen(db.session, 'after_flush', bump_role_members)
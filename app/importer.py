@@ -0,0 +1,175 @@
+import csv
+import io
+import json
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import islice, repeat
+
+from flask import current_app
+from sqlalchemy import insert, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from app import db, geo, security, sync
+from app.models import Role, User, registered_farmers
+
+
+REQUIRED_FIELDS = ('email', 'password', 'firstname', 'lastname',
+                   'mobile_no', 'location')
+OPTIONAL_FIELDS = ('state_of_origin', 'country', 'about_me')
+
+users = User.__table__
+
+
+def read_rows(stream, fmt):
+    """Yield one dict per record of a binary CSV or JSON Lines stream."""
+    # Bytes that are not UTF-8 become U+FFFD and clean_record rejects the row.
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    if fmt == 'csv':
+        yield from csv.DictReader(text)
+    elif fmt == 'jsonl':
+        for line in text:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+    else:
+        raise ValueError(f'Unsupported import format: {fmt}')
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _numbered(records, report, max_rows):
+    for line, record in enumerate(records, start=1):
+        if max_rows is not None and line > max_rows:
+            report['errors'].append({'row': line, 'error': (
+                f'Only {max_rows} rows can be uploaded at once; '
+                'the rest of the file was skipped.')})
+            return
+        yield line, record
+
+
+def _hash(pool, passwords, scheme, rounds):
+    if pool is None:
+        # One at a time on the login pool, so a web upload cannot take
+        # more than one of its workers.
+        timeout = current_app.config['PASSWORD_VERIFY_TIMEOUT']
+        return [security.hash_async(password).result(timeout=timeout)
+                for password in passwords]
+    return pool.map(security.hash_password, passwords, repeat(scheme), repeat(rounds))
+
+
+def clean_record(record):
+    if not isinstance(record, dict):
+        raise ValueError('Row could not be parsed.')
+    missing = [field for field in REQUIRED_FIELDS if not record.get(field)]
+    if missing:
+        raise ValueError(f'Missing {", ".join(missing)}.')
+    row = {field: str(record[field]).strip() for field in REQUIRED_FIELDS}
+    for field in OPTIONAL_FIELDS:
+        row[field] = str(record[field]).strip() if record.get(field) else None
+    if any('\ufffd' in value for value in row.values() if value):
+        raise ValueError('Row is not valid UTF-8.')
+    row['email'] = row['email'].lower()
+    if '@' not in row['email'] or len(row['email']) > 64:
+        raise ValueError('Invalid email address.')
+    try:
+        row['mobile_no'] = int(row['mobile_no'])
+    except ValueError:
+        raise ValueError('Invalid phone number.')
+    return row
+
+
+def import_farmers(stream, fmt, agent, chunk_size=None, max_rows=None):
+    """Register every farmer in ``stream`` under ``agent``.
+
+    Rows are read and committed ``chunk_size`` at a time. Each chunk costs one
+    uniqueness query, a hashing pass on a process pool, and two bulk inserts.
+    With ``max_rows``, as for web uploads, rows past it are skipped and the
+    passwords are hashed on the login pool instead of a process pool.
+    Returns ``{'imported': n, 'errors': [{'row': line, 'error': msg}]}``.
+    """
+    config = current_app.config
+    chunk_size = chunk_size or config['IMPORT_CHUNK_SIZE']
+    scheme = config['PASSWORD_HASH_SCHEME']
+    rounds = config['PASSWORD_HASH_ROUNDS'].get(scheme)
+    role_id = db.session.execute(
+        select(Role.id).where(Role.default.is_(True))).scalar()
+
+    report = {'imported': 0, 'errors': []}
+    seen_emails, seen_mobiles = set(), set()
+    records = _numbered(read_rows(stream, fmt), report, max_rows)
+
+    with nullcontext() if max_rows is not None else \
+            ProcessPoolExecutor(max_workers=config['IMPORT_HASH_WORKERS']) as pool:
+        for chunk in _chunks(records, chunk_size):
+            rows = []
+            for line, record in chunk:
+                try:
+                    row = clean_record(record)
+                except ValueError as e:
+                    report['errors'].append({'row': line, 'error': str(e)})
+                    continue
+                if row['email'] in seen_emails:
+                    report['errors'].append({'row': line, 'error': 'Duplicate email in file.'})
+                elif row['mobile_no'] in seen_mobiles:
+                    report['errors'].append({'row': line, 'error': 'Duplicate mobile number in file.'})
+                else:
+                    seen_emails.add(row['email'])
+                    seen_mobiles.add(row['mobile_no'])
+                    rows.append((line, row))
+            if not rows:
+                continue
+
+            taken = db.session.execute(
+                select(users.c.email, users.c.mobile_no).where(or_(
+                    users.c.email.in_([row['email'] for _, row in rows]),
+                    users.c.mobile_no.in_([row['mobile_no'] for _, row in rows])))).all()
+            taken_emails = {email for email, _ in taken}
+            taken_mobiles = {mobile for _, mobile in taken}
+            accepted = []
+            for line, row in rows:
+                if row['email'] in taken_emails:
+                    report['errors'].append({'row': line, 'error': 'Email already registered.'})
+                elif row['mobile_no'] in taken_mobiles:
+                    report['errors'].append({'row': line, 'error': 'Mobile Number already registered.'})
+                else:
+                    accepted.append((line, row))
+            if not accepted:
+                continue
+
+            hashes = _hash(pool, [row.pop('password') for _, row in accepted],
+                           scheme, rounds)
+            for (_, row), password_hash in zip(accepted, hashes):
+                row['password_hash'] = password_hash
+                row['role_id'] = role_id
+                row['place_id'] = geo.resolve(row['location'])
+
+            try:
+                db.session.execute(insert(users), [row for _, row in accepted])
+                farmer_ids = db.session.execute(
+                    select(users.c.id).where(users.c.email.in_(
+                        [row['email'] for _, row in accepted]))).scalars().all()
+                db.session.execute(insert(registered_farmers), [
+                    {'farmer_id': farmer_id, 'agent_id': agent.id}
+                    for farmer_id in farmer_ids])
+                sync.record_users(db.session.connection(), farmer_ids)
+                db.session.commit()
+            except IntegrityError:
+                # Someone registered one of these since the uniqueness query.
+                db.session.rollback()
+                report['errors'].extend(
+                    {'row': line, 'error': 'Chunk not imported: an email or mobile '
+                                           'number was registered meanwhile.'}
+                    for line, _ in accepted)
+                continue
+            report['imported'] += len(accepted)
+    report['errors'].sort(key=lambda error: error['row'])
+    return report
@@ -0,0 +1,262 @@
+import hmac
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import Blueprint, Response, abort, current_app, g, has_request_context, request, \
+    before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+BYTES_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+
+log = logging.getLogger('tingo.requests')
+metrics_blueprint = Blueprint('instrumentation', __name__)
+
+
+class Histogram:
+
+    def __init__(self, name, help, buckets):
+        self.name, self.help, self.buckets = name, help, buckets
+        self._series = defaultdict(lambda: [[0] * len(buckets), 0.0, 0])
+
+    def observe(self, labels, value):
+        counts, _, _ = series = self._series[labels]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            label = _labels(labels)
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket{{{label},le="{bound}"}} {bucket_count}'
+            yield f'{self.name}_bucket{{{label},le="+Inf"}} {count}'
+            yield f'{self.name}_sum{{{label}}} {total}'
+            yield f'{self.name}_count{{{label}}} {count}'
+
+
+class Counters:
+
+    def __init__(self, name, help):
+        self.name, self.help = name, help
+        self._series = Counter()
+
+    def inc(self, labels, value=1):
+        self._series[labels] += value
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in sorted(self._series.items()):
+            yield f'{self.name}{{{_labels(labels)}}} {value}'
+
+
+def _labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+
+class Registry:
+    """Per-process request metrics in the Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counters('tingo_requests_total', 'Requests served.')
+        self.n_plus_one = Counters('tingo_n_plus_one_total',
+                                   'Requests that repeated one statement too often.')
+        self.seconds = Histogram('tingo_request_seconds', 'Request wall time.', SECONDS_BUCKETS)
+        self.queries = Histogram('tingo_request_queries', 'SQL statements per request.',
+                                 QUERY_BUCKETS)
+        self.db_seconds = Histogram('tingo_request_db_seconds', 'Time spent in SQL per request.',
+                                    SECONDS_BUCKETS)
+        self.render_seconds = Histogram('tingo_request_render_seconds',
+                                        'Time spent rendering templates per request.',
+                                        SECONDS_BUCKETS)
+        self.response_bytes = Histogram('tingo_response_bytes', 'Response body size.',
+                                        BYTES_BUCKETS)
+
+    def record(self, stats, status, size):
+        endpoint = (('endpoint', stats.endpoint),)
+        with self.lock:
+            self.requests.inc(endpoint + (('method', stats.method), ('status', status)))
+            self.seconds.observe(endpoint, stats.duration)
+            self.queries.observe(endpoint, stats.queries)
+            self.db_seconds.observe(endpoint, stats.db_time)
+            self.render_seconds.observe(endpoint, stats.render_time)
+            if size is not None:
+                self.response_bytes.observe(endpoint, size)
+            if stats.repeated:
+                self.n_plus_one.inc(endpoint)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for metric in (self.requests, self.n_plus_one, self.seconds, self.queries,
+                           self.db_seconds, self.render_seconds, self.response_bytes):
+                lines.extend(metric.lines())
+        return '\n'.join(lines) + '\n'
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.endpoint = request.endpoint or 'unknown'
+        self.method = request.method
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.statements = Counter()
+        self.repeated = []
+        self.sampler = None
+        self._render_started = []
+
+
+class Sampler:
+    """Samples one thread's stack on a timer and counts the collapsed
+    stacks, ready for flamegraph.pl or speedscope."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, 'w') as out:
+            for stack, count in self.stacks.most_common():
+                out.write(f'{stack} {count}\n')
+
+
+def init_app(app):
+    if not app.config['INSTRUMENTATION_ENABLED']:
+        return
+    app.extensions['instrumentation'] = Registry()
+    app.before_request(_start)
+    app.after_request(_finish)
+    app.teardown_request(_stop_sampler)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
+    if app.config['METRICS_ENDPOINT']:
+        app.register_blueprint(metrics_blueprint)
+
+
+@metrics_blueprint.route('/metrics')
+def metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                         f'Bearer {token}'):
+        abort(401)
+    return Response(current_app.extensions['instrumentation'].render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def _start():
+    stats = g._request_stats = RequestStats()
+    if stats.endpoint in current_app.config['PROFILE_ENDPOINTS']:
+        stats.sampler = Sampler(threading.get_ident(), current_app.config['PROFILE_INTERVAL'])
+
+
+def _finish(response):
+    stats = g.get('_request_stats')
+    if stats is None:
+        return response
+    stats.duration = time.perf_counter() - stats.started
+    threshold = current_app.config['N_PLUS_ONE_THRESHOLD']
+    stats.repeated = [(statement, count) for statement, count in stats.statements.items()
+                      if count >= threshold]
+    size = None if response.is_streamed else response.calculate_content_length()
+    current_app.extensions['instrumentation'].record(stats, response.status_code, size)
+
+    for statement, count in stats.repeated:
+        current_app.logger.warning('Possible N+1 in %s: %d x %s', stats.endpoint, count,
+                                   ' '.join(statement.split())[:200])
+    log.info(json.dumps({
+        'endpoint': stats.endpoint, 'method': stats.method, 'path': request.path,
+        'status': response.status_code, 'duration_ms': round(stats.duration * 1000, 2),
+        'queries': stats.queries, 'db_ms': round(stats.db_time * 1000, 2),
+        'render_ms': round(stats.render_time * 1000, 2), 'bytes': size,
+        'repeated_statements': len(stats.repeated)}))
+
+    if current_app.config['INSTRUMENTATION_HEADERS']:
+        response.headers['X-Query-Count'] = str(stats.queries)
+        response.headers['Server-Timing'] = (
+            f'db;dur={stats.db_time * 1000:.1f}, render;dur={stats.render_time * 1000:.1f}, '
+            f'total;dur={stats.duration * 1000:.1f}')
+    return response
+
+
+def _stop_sampler(exception=None):
+    stats = g.get('_request_stats')
+    if stats is None or stats.sampler is None:
+        return
+    stats.sampler.stop()
+    directory = current_app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    stats.sampler.write(os.path.join(
+        directory, f'{stats.endpoint}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.folded'))
+
+
+def _render_started(sender, template, context, **extra):
+    stats = g.get('_request_stats')
+    if stats is not None:
+        stats._render_started.append(time.perf_counter())
+
+
+def _render_finished(sender, template, context, **extra):
+    stats = g.get('_request_stats')
+    if stats is not None and stats._render_started:
+        stats.render_time += time.perf_counter() - stats._render_started.pop()
+
+
+def _current_stats():
+    if has_request_context():
+        return g.get('_request_stats')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_stats() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_stats()
+    started = conn.info.get('query_started')
+    if stats is None or not started:
+        return
+    stats.db_time += time.perf_counter() - started.pop()
+    stats.queries += 1
+    # Same SQL text, different parameters: the shape of a lazy load in a loop.
+    stats.statements[statement] += 1
@@ -0,0 +1,127 @@
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import func, insert, literal, select, update
+
+from app import db, identity
+from app.models import OPENING_BALANCE, Product, Transaction, User
+
+
+transactions = Transaction.__table__
+products = Product.__table__
+users = User.__table__
+
+Drift = namedtuple('Drift', 'user_id wallet expected_wallet points expected_points')
+
+# The stored wallet, with NULL (see User.balance) as the opening balance.
+balance = func.coalesce(users.c.wallet, OPENING_BALANCE)
+
+
+def record(entries):
+    """Bulk-insert ledger entries (dicts with buyer_id, seller_id,
+    product_id, amount and points) in the current transaction."""
+    entries = list(entries)
+    if entries:
+        now = datetime.utcnow()
+        for entry in entries:
+            entry.setdefault('buyer_id', None)
+            entry.setdefault('seller_id', None)
+            entry.setdefault('product_id', None)
+            entry.setdefault('points', 0)
+            entry.setdefault('timestamp', now)
+        db.session.execute(insert(transactions), entries)
+
+
+def _record_products(product_ids, buyer_id=None, seller_id=None):
+    db.session.execute(insert(transactions).from_select(
+        ['buyer_id', 'seller_id', 'product_id', 'amount', 'points', 'timestamp'],
+        select(literal(buyer_id, db.Integer), literal(seller_id, db.Integer),
+               products.c.id, products.c.price, products.c.price / 20,
+               literal(datetime.utcnow(), db.DateTime))
+        .where(products.c.id.in_(product_ids))))
+
+
+def record_purchase(buyer_id, product_ids):
+    _record_products(product_ids, buyer_id=buyer_id)
+
+
+def record_sale(seller_id, product_id):
+    _record_products([product_id], seller_id=seller_id)
+
+
+def _totals(column, low, high):
+    rows = db.session.execute(
+        select(column, func.sum(transactions.c.amount),
+               func.sum(transactions.c.points))
+        .where(column.between(low, high))
+        .group_by(column))
+    return {user_id: (amount, points) for user_id, amount, points in rows}
+
+
+def reconcile(batch_size=1000):
+    """Check every user's cached wallet and points against the ledger.
+
+    Users are walked in id order, ``batch_size`` at a time, with one grouped
+    query per side of the ledger for each batch. Returns the list of users
+    whose cached totals drifted.
+    """
+    drifts = []
+    last_id = 0
+    while True:
+        batch = db.session.execute(
+            select(users.c.id, balance, users.c.points)
+            .where(users.c.id > last_id)
+            .order_by(users.c.id)
+            .limit(batch_size)).all()
+        if not batch:
+            break
+        low, high = batch[0].id, batch[-1].id
+        debits = _totals(transactions.c.buyer_id, low, high)
+        credits = _totals(transactions.c.seller_id, low, high)
+        for user_id, wallet, points in batch:
+            debit, debit_points = debits.get(user_id, (0, 0))
+            credit, credit_points = credits.get(user_id, (0, 0))
+            expected_wallet = OPENING_BALANCE + credit - debit
+            expected_points = debit_points + credit_points
+            if wallet != expected_wallet or (points or 0) != expected_points:
+                drifts.append(Drift(user_id, wallet, expected_wallet,
+                                    points, expected_points))
+        last_id = high
+    return drifts
+
+
+def repair(drifts):
+    """Move each drifted balance to its ledger total by the difference that
+    was found, only where the balance is still the one that was read. A
+    purchase or sale committed since then is kept, and the user is left
+    for the next run. Returns the users repaired."""
+    repaired = []
+    for drift in drifts:
+        changed = db.session.execute(
+            update(users)
+            .where(users.c.id == drift.user_id, balance == drift.wallet,
+                   func.coalesce(users.c.points, 0) == (drift.points or 0))
+            .values(wallet=balance + (drift.expected_wallet - drift.wallet),
+                    points=func.coalesce(users.c.points, 0)
+                    + (drift.expected_points - (drift.points or 0)),
+                    identity_version=users.c.identity_version + 1))
+        if changed.rowcount:
+            repaired.append(drift.user_id)
+    db.session.commit()
+    for user_id in repaired:
+        identity.forget(user_id)
+    return repaired
+
+
+def backfill_wallets():
+    """Give every NULL wallet the opening balance. Returns the users changed."""
+    user_ids = db.session.execute(
+        select(users.c.id).where(users.c.wallet.is_(None))).scalars().all()
+    if user_ids:
+        db.session.execute(
+            update(users).where(users.c.id.in_(user_ids), users.c.wallet.is_(None))
+            .values(wallet=OPENING_BALANCE, identity_version=users.c.identity_version + 1))
+    db.session.commit()
+    for user_id in user_ids:
+        identity.forget(user_id)
+    return user_ids
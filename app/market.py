@@ -0,0 +1,59 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import load_only
+
+from app.database import read_session
+from app.models import Product
+
+
+LISTING_COLUMNS = ('id', 'product_name', 'product_type', 'product_variety',
+                   'location', 'price', 'timestamp')
+
+
+def encode_cursor(product):
+    raw = json.dumps([product.timestamp.isoformat(), product.id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        timestamp, product_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return datetime.fromisoformat(timestamp), int(product_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def listing_query():
+    return read_session().query(Product).options(load_only(*LISTING_COLUMNS)).filter(
+        Product.owner_supplier.is_(None),
+        Product.is_available.is_(True))
+
+
+def listing_page(cursor=None, per_page=20):
+    """Return one page of unowned products, newest first, and the cursor
+    for the next page (or None on the last page)."""
+    query = listing_query()
+    position = decode_cursor(cursor)
+    if position is not None:
+        timestamp, product_id = position
+        query = query.filter(or_(
+            Product.timestamp < timestamp,
+            and_(Product.timestamp == timestamp, Product.id < product_id)))
+    rows = query.order_by(Product.timestamp.desc(), Product.id.desc()) \
+        .limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1])
+    return rows, next_cursor
+
+
+def owned_products(user):
+    return Product.query.options(load_only(*LISTING_COLUMNS)).filter_by(
+        owner_supplier=user.id).order_by(Product.timestamp.desc()).all()
@@ -0,0 +1,84 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+ALLOWED_TAGS = {
+    'post': ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+             'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+             'h1', 'h2', 'h3', 'p'],
+    'comment': ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
+                'strong'],
+}
+CACHE_SIZE = 4096
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+# Markdown and bleach's html5lib parser keep per-document state, so each
+# thread gets its own reusable instances.
+_local = threading.local()
+
+
+def _renderers():
+    if not hasattr(_local, 'markdown'):
+        # Imported on first render so workers that never render posts
+        # do not pay for markdown and html5lib.
+        import bleach
+        from bleach.linkifier import LinkifyFilter
+        from markdown import Markdown
+
+        _local.markdown = Markdown(output_format='html')
+        _local.cleaners = {
+            profile: bleach.Cleaner(tags=tags, strip=True,
+                                    filters=[LinkifyFilter])
+            for profile, tags in ALLOWED_TAGS.items()}
+    return _local.markdown, _local.cleaners
+
+
+def _key(text, profile):
+    return hashlib.sha1(f'{profile}\0{text}'.encode('utf-8')).digest()
+
+
+def render(text, profile='post'):
+    """Markdown -> sanitized, linkified HTML, memoized on a hash of the
+    text."""
+    if text is None:
+        return None
+    key = _key(text, profile)
+    with _cache_lock:
+        html = _cache.get(key)
+        if html is not None:
+            _cache.move_to_end(key)
+            return html
+
+    markdown, cleaners = _renderers()
+    html = cleaners[profile].clean(markdown.reset().convert(text))
+
+    with _cache_lock:
+        _cache[key] = html
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return html
+
+
+def render_many(texts, profile='post'):
+    """Render a batch of texts, converting each distinct text once."""
+    texts = list(texts)
+    rendered = {}
+    for text in texts:
+        if text not in rendered:
+            rendered[text] = render(text, profile)
+    return [rendered[text] for text in texts]
+
+
+def render_bodies(targets, profile='post'):
+    """Fill ``body_html`` for a batch of posts or comments, e.g. after a
+    bulk load done with rendering deferred."""
+    for target, html in zip(targets, render_many([t.body for t in targets],
+                                                 profile)):
+        target.body_html = html
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
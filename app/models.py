@@ -1,17 +1,14 @@
-from email.policy import default
 from datetime import datetime
 import hashlib
-from werkzeug.security import generate_password_hash, check_password_hash
-from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from markdown import markdown
-import bleach
 from flask import current_app, request, url_for
-from flask_login import LoginManager, UserMixin
+from flask_login import UserMixin
+from sqlalchemy.orm.attributes import set_committed_value
 from app.exceptions import ValidationError
-from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.ext.orderinglist import ordering_list
 
-from app import db, login_manager
+from app import db, markup, security
+
+
+OPENING_BALANCE = 1000
 
 
 class Permission:
@@ -77,9 +74,45 @@ class Role(db.Model):
         return '<Role %r>' % self.name
 
 
+class Place(db.Model):
+    """A gazetteer entry that free-text locations are resolved to."""
+    __tablename__ = 'places'
+    __table_args__ = (
+        db.Index('ix_places_lat_lon', 'latitude', 'longitude'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    state = db.Column(db.String(64))
+    key = db.Column(db.String(64), unique=True, index=True)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<Place {self.name}, {self.state}>'
+
+
 registered_farmers = db.Table('registered_farmers',
-    db.Column('farmer_id', db.Integer, db.ForeignKey('users.id')),
-    db.Column('agent_id', db.Integer, db.ForeignKey('users.id'))
+    db.Column('agent_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
+    db.Column('farmer_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
+    # The primary key serves agent -> farmers; this serves farmer -> agents.
+    db.Index('ix_registered_farmers_farmer', 'farmer_id', 'agent_id')
+)
+
+
+cooperative_members = db.Table('cooperative_members',
+    db.Column('cooperative_id', db.Integer, db.ForeignKey('cooperatives.id'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
+    # The primary key serves cooperative -> members; this serves user -> cooperatives.
+    db.Index('ix_cooperative_members_user', 'user_id', 'cooperative_id')
+)
+
+
+forum_subscriptions = db.Table('forum_subscriptions',
+    db.Column('forum_id', db.Integer, db.ForeignKey('forums.id'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
+    # The primary key serves forum -> subscribers; this serves user -> forums.
+    db.Index('ix_forum_subscriptions_user', 'user_id', 'forum_id')
 )
 
 
@@ -103,15 +136,17 @@ class User(UserMixin, db.Model):
     last_seen = db.Column(db.DateTime(), default=datetime.utcnow)
     avatar_hash = db.Column(db.String(32))
     points = db.Column(db.Integer, default=0)
-    wallet = db.Column(db.Integer, default=1000)
+    wallet = db.Column(db.Integer, default=OPENING_BALANCE)
+    identity_version = db.Column(db.Integer, nullable=False, default=0)
 
     farmers = db.relationship(
                          'User', secondary=registered_farmers,
-                          primaryjoin=(registered_farmers.c.farmer_id == id),
-                          secondaryjoin=(registered_farmers.c.agent_id == id),
-                          backref=db.backref('registered_farmers', lazy='dynamic'), lazy='dynamic')
+                          primaryjoin=(registered_farmers.c.agent_id == id),
+                          secondaryjoin=(registered_farmers.c.farmer_id == id),
+                          backref=db.backref('agents', lazy='dynamic'), lazy='dynamic')
     products = db.relationship('Product', backref='supplier', lazy=True)
     cooperative = db.Column(db.Integer, db.ForeignKey('cooperatives.id'))
+    place_id = db.Column(db.Integer, db.ForeignKey('places.id'), index=True)
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     comments = db.relationship('Comment', backref='author', lazy='dynamic')
 
@@ -130,13 +165,17 @@ class User(UserMixin, db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = security.hash_password(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        ok, new_hash = security.verify_password(password, self.password_hash)
+        if new_hash is not None:
+            self.password_hash = new_hash
+        return ok
 
     @staticmethod
     def reset_password(token, new_password):
+        from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
         s = Serializer(current_app.config['SECRET_KEY'])
         try:
             data = s.loads(token.encode('utf-8'))
@@ -150,7 +189,14 @@ class User(UserMixin, db.Model):
         return True
 
     def can(self, perm):
-        return self.role is not None and self.role.has_permission(perm)
+        # Users restored from the session identity cache carry their role's
+        # permission mask, so this does not have to load the role.
+        permissions = getattr(self, '_permissions', None)
+        if permissions is None:
+            if self.role is None:
+                return False
+            permissions = self.role.permissions
+        return permissions & perm == perm
 
     def is_administrator(self):
         return self.can(Permission.ADMIN)
@@ -158,26 +204,28 @@ class User(UserMixin, db.Model):
     def is_agent(self):
         return self.can(Permission.REGISTER)
 
-    @property 
+    @property
+    def balance(self):
+        # Accounts from before wallets had a default hold NULL until
+        # flask backfill-wallets has run; they count as the opening balance.
+        return OPENING_BALANCE if self.wallet is None else self.wallet
+
+    @property
     def styled_wallet(self):
-        if len(str(self.wallet)) >= 4:
-            return f'{str(self.wallet)[:-3]},{str(self.wallet)[-3:]}NGN'
-        else:
-            return f'{self.wallet}NGN'
+        return f'{self.balance:,}NGN'
 
     def can_purchase(self, purchase_object):
-        return self.budget >= purchase_object.price
+        return self.balance >= purchase_object.price
 
     def can_sell(self, sold_object):
-        return sold_object in self.products
-
-    def add_points(self, purchase_object):
-        self.points += (purchase_object.price / 20)
-        return self.points
+        return sold_object.owner_supplier == self.id
 
     def ping(self):
-        self.last_seen = datetime.utcnow()
-        db.session.add(self)
+        from app import writebehind
+        now = datetime.utcnow()
+        writebehind.buffer().touch(self.id, now)
+        # Keep the loaded object current without making it dirty.
+        set_committed_value(self, 'last_seen', now)
 
     def gravatar_hash(self):
         return hashlib.md5(self.email.lower().encode('utf-8')).hexdigest()
@@ -188,15 +236,19 @@ class User(UserMixin, db.Model):
         return '{url}/{hash}?s={size}&d={default}&r={rating}'.format(
             url=url, hash=hash, size=size, default=default, rating=rating)
 
-    def to_json(self):
+    def to_json(self, post_count=None):
+        # The API passes counts it fetched for the whole page at once.
         json_user = {
             'url': url_for('api.get_user', id=self.id),
-            'username': self.username,
+            'firstname': self.firstname,
+            'lastname': self.lastname,
+            'location': self.location,
             'member_since': self.member_since,
             'last_seen': self.last_seen,
             'posts_url': url_for('api.get_user_posts', id=self.id),
-            'cooperative_url': url_for('api.get_cooperative', id=self.id),
-            'post_count': self.posts.count()
+            'cooperative_url': url_for('api.get_cooperative', id=self.cooperative)
+            if self.cooperative is not None else None,
+            'post_count': self.posts.count() if post_count is None else post_count
         }
         return json_user
 
@@ -204,14 +256,13 @@ class User(UserMixin, db.Model):
         return '<User %r>' % self.firstname
 
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
-    
-
 
 class Product(db.Model):
     __tablename__ = 'products'
+    __table_args__ = (
+        db.Index('ix_products_market', 'owner_supplier', 'is_available',
+                 'timestamp', 'id'),
+    )
 
     id = db.Column(db.Integer(), primary_key=True)
     product_name = db.Column(db.String(30), nullable=False)
@@ -224,22 +275,243 @@ class Product(db.Model):
     is_available = db.Column(db.Boolean(), default=True)
     owner_supplier = db.Column(db.Integer(), db.ForeignKey('users.id'))
     product_image = db.Column(db.String(20),nullable=False,default='default.JPG')
+    place_id = db.Column(db.Integer, db.ForeignKey('places.id'), index=True)
 
     def purchase(self, user):
-        self.owner_supplier = user.id 
-        user.budget -= self.price
-        db.session.commit()
+        from app import orders
+        orders.purchase(user, self.id)
 
     def sell(self, user):
-        self.owner_supplier = user.id
-        user.budget += self.price
-        db.session.commit()
+        from app import orders
+        orders.sell(user, self.id)
+
+    def to_json(self):
+        # Listing columns only, so rows loaded with LISTING_COLUMNS serialize
+        # without further queries.
+        json_product = {
+            'url': url_for('api.get_product', id=self.id),
+            'product_name': self.product_name,
+            'product_type': self.product_type,
+            'product_variety': self.product_variety,
+            'location': self.location,
+            'price': self.price,
+            'timestamp': self.timestamp,
+        }
+        return json_product
 
     def __repr__(self):
         return f'{self.product_name}, a {self.product_type} of {self.product_variety} \
                     variety available at {self.location}'
 
 
+class BuyOrder(db.Model):
+    """A standing bid for ``quantity`` market listings of one crop, variety
+    and location at ``max_price`` or less each. Matched by app.orderbook."""
+    __tablename__ = 'buy_orders'
+    __table_args__ = (
+        db.Index('ix_buy_orders_book', 'status', 'product_type', 'product_variety',
+                 'location'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    buyer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    product_type = db.Column(db.String(30), nullable=False)
+    product_variety = db.Column(db.String(30), nullable=False)
+    location = db.Column(db.String(30), nullable=False)
+    max_price = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    filled = db.Column(db.Integer, nullable=False, default=0)
+    # open, filled, cancelled, or unfunded when the buyer could not pay.
+    status = db.Column(db.String(10), nullable=False, default='open')
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_json(self):
+        json_order = {
+            'url': url_for('api.get_bid', id=self.id),
+            'product_type': self.product_type,
+            'product_variety': self.product_variety,
+            'location': self.location,
+            'max_price': self.max_price,
+            'quantity': self.quantity,
+            'filled': self.filled,
+            'status': self.status,
+            'timestamp': self.timestamp,
+        }
+        return json_order
+
+
+class OrderBookChange(db.Model):
+    """A listing or buy order that changed, queued in the writer's
+    transaction for the order book matcher, which deletes it once read."""
+    __tablename__ = 'order_book_changes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer)
+    order_id = db.Column(db.Integer)
+
+
+class Transaction(db.Model):
+    """One append-only ledger entry. The buyer is debited and the seller is
+    credited ``amount``; either side is empty when the market itself is the
+    counterparty. ``points`` are awarded to each party named on the entry."""
+    __tablename__ = 'transactions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    buyer_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    seller_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'))
+    amount = db.Column(db.Integer, nullable=False)
+    points = db.Column(db.Integer, nullable=False, default=0)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Transaction {self.id}: {self.amount}NGN>'
+
+
+class CacheVersion(db.Model):
+    """How many times a table has been written to, for the fragment cache
+    keys and ETags of every worker."""
+    __tablename__ = 'cache_versions'
+
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class PriceRollup(db.Model):
+    """Listings and sales for one crop, variety and location on one day.
+    Kept current by app.analytics; price_median is only filled in by the
+    batch rebuild and is cleared when a listing is added after it."""
+    __tablename__ = 'price_rollups'
+
+    product_type = db.Column(db.String(30), primary_key=True)
+    product_variety = db.Column(db.String(30), primary_key=True)
+    location = db.Column(db.String(30), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    listings = db.Column(db.Integer, nullable=False, default=0)
+    price_min = db.Column(db.Integer)
+    price_max = db.Column(db.Integer)
+    price_sum = db.Column(db.Integer, nullable=False, default=0)
+    price_median = db.Column(db.Float)
+    sales = db.Column(db.Integer, nullable=False, default=0)
+    sales_value = db.Column(db.Integer, nullable=False, default=0)
+
+
+class CooperativeSupply(db.Model):
+    """Products held by a cooperative's members, per crop."""
+    __tablename__ = 'cooperative_supply'
+
+    cooperative_id = db.Column(db.Integer, db.ForeignKey('cooperatives.id'), primary_key=True)
+    product_type = db.Column(db.String(30), primary_key=True)
+    listings = db.Column(db.Integer, nullable=False, default=0)
+    listed_value = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ChangeLog(db.Model):
+    """One change to a row that offline clients replicate. ``id`` is the
+    sequence number clients sync from; ``owner_id`` is the user whose
+    replica holds the row."""
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        db.Index('ix_change_log_owner', 'owner_id', 'id'),
+        # Never reuse a sequence number, even after the log is pruned.
+        {'sqlite_autoincrement': True},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(30), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    owner_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(6), nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class SyncReceipt(db.Model):
+    """The stored result of one client operation, so a retried upload is
+    answered without applying it twice."""
+    __tablename__ = 'sync_receipts'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    key = db.Column(db.String(64), primary_key=True)
+    result = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class CooperativeLot(db.Model):
+    """Member listings of one crop and variety pooled for bulk sale. Kept
+    current by app.aggregation as listings and memberships change."""
+    __tablename__ = 'cooperative_lots'
+
+    cooperative_id = db.Column(db.Integer, db.ForeignKey('cooperatives.id'), primary_key=True)
+    product_type = db.Column(db.String(30), primary_key=True)
+    product_variety = db.Column(db.String(30), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    listed_value = db.Column(db.Integer, nullable=False, default=0)
+
+    @property
+    def price(self):
+        return round(self.listed_value / self.quantity, 2) if self.quantity else None
+
+
+class FeedEvent(db.Model):
+    """Something that appears in feeds: a post, a comment or a listing,
+    with enough of it copied in to show without reading the source row."""
+    __tablename__ = 'feed_events'
+    __table_args__ = (
+        db.Index('ix_feed_events_subject', 'kind', 'subject_id'),
+        {'sqlite_autoincrement': True},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)
+    actor_id = db.Column(db.Integer, nullable=False)
+    subject_id = db.Column(db.Integer, nullable=False)
+    forum_id = db.Column(db.Integer)
+    summary = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    SUBJECT_ENDPOINTS = {'post': 'api.get_post', 'comment': 'api.get_comment',
+                         'listing': 'api.get_product'}
+
+    def to_json(self):
+        json_event = {
+            'kind': self.kind,
+            'url': url_for(self.SUBJECT_ENDPOINTS[self.kind], id=self.subject_id),
+            'actor_url': url_for('api.get_user', id=self.actor_id),
+            'forum_url': url_for('api.get_forum', id=self.forum_id)
+            if self.forum_id is not None else None,
+            'summary': self.summary,
+            'timestamp': self.timestamp,
+        }
+        return json_event
+
+
+class FeedEntry(db.Model):
+    """An event pushed into one user's feed, which is read newest first
+    along the primary key."""
+    __tablename__ = 'feed_entries'
+
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    event_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+
+class FeedSource(db.Model):
+    """A forum, cooperative or agent network with too wide an audience to
+    push to. Its events go to its timeline and readers pull them."""
+    __tablename__ = 'feed_sources'
+
+    source_type = db.Column(db.String(12), primary_key=True)
+    source_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class FeedTimelineEntry(db.Model):
+    __tablename__ = 'feed_timelines'
+
+    source_type = db.Column(db.String(12), primary_key=True)
+    source_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    event_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+
 class Cooperative(db.Model):
 
     __tablename__ = 'cooperatives'
@@ -249,7 +521,23 @@ class Cooperative(db.Model):
     purpose = db.Column(db.String(64), nullable=False, unique=True)
     products = db.Column(db.String(30), nullable=False, unique=True)
     location = db.Column(db.String(30), nullable=False)
+    place_id = db.Column(db.Integer, db.ForeignKey('places.id'), index=True)
     members = db.relationship('User', backref='member', lazy=True)
+    # Written through app.aggregation, which keeps the lots in step.
+    farmers = db.relationship('User', secondary=cooperative_members, lazy='dynamic',
+                              viewonly=True)
+
+    def to_json(self):
+        json_cooperative = {
+            'url': url_for('api.get_cooperative', id=self.id),
+            'name': self.name,
+            'purpose': self.purpose,
+            'products': self.products,
+            'location': self.location,
+            'members_url': url_for('api.get_cooperative_members', id=self.id),
+            'lots_url': url_for('api.get_cooperative_lots', id=self.id),
+        }
+        return json_cooperative
 
     def __repr__(self):
         return f'{self.name}, located at {self.location}'
@@ -260,19 +548,24 @@ class Forum(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30), unique=True)
-    length = db.Column(db.Integer, default=0)
+    post_count = db.Column(db.Integer, nullable=False, default=0)
+    comment_count = db.Column(db.Integer, nullable=False, default=0)
+    last_activity = db.Column(db.DateTime, index=True)
     description = db.Column(db.Text)
     posts = db.relationship('Post',cascade='all,delete', backref='forum',
                                     lazy='dynamic')
 
     def to_json(self):
-        json_sport = {
-            'url': url_for('api.get_sport', id=self.id),
+        json_forum = {
+            'url': url_for('api.get_forum', id=self.id),
             'name': self.name,
             'description': self.description,
-            'posts_url': url_for('api.get_posts', id=self.id),
+            'posts_url': url_for('api.get_forum_posts', id=self.id),
+            'post_count': self.post_count,
+            'comment_count': self.comment_count,
+            'last_activity': self.last_activity,
         }
-        return json_sport
+        return json_forum
 
     @staticmethod
     def from_json(json_sport):
@@ -282,13 +575,6 @@ class Forum(db.Model):
         return Forum(name=name)
 
 
-def forum_posts_append(forum, posts, initiator):
-    """Update some sport values when `Sport.teams.append` is called."""
-    forum.length += 1
-    forum.updated = datetime.utcnow()
-
-db.event.listen(Forum.name, 'append', forum_posts_append)
-
 class Post(db.Model):
     __tablename__ = 'posts'
 
@@ -296,28 +582,37 @@ class Post(db.Model):
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    forum_id = db.Column(db.Integer, db.ForeignKey('forums.id'))
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    forum_id = db.Column(db.Integer, db.ForeignKey('forums.id'), index=True)
+    comment_count = db.Column(db.Integer, nullable=False, default=0)
+    last_activity = db.Column(db.DateTime, default=datetime.utcnow)
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3', 'p']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        if current_app.config['MARKDOWN_LAZY_RENDER']:
+            target.body_html = None
+        else:
+            target.body_html = markup.render(value, 'post')
+
+    @property
+    def html(self):
+        if self.body_html is None and self.body is not None:
+            self.body_html = markup.render(self.body, 'post')
+        return self.body_html
 
     def to_json(self):
-        json_general_post = {
+        json_post = {
             'url': url_for('api.get_post', id=self.id),
             'body': self.body,
-            'body_html': self.body_html,
+            'body_html': self.html,
             'timestamp': self.timestamp,
-            'author_url': url_for('api.get_user', id=self.author_id),
+            'author_url': url_for('api.get_user', id=self.author_id)
+            if self.author_id is not None else None,
+            'forum_url': url_for('api.get_forum', id=self.forum_id)
+            if self.forum_id is not None else None,
             'comments_url': url_for('api.get_post_comments', id=self.id),
-            'comment_count': self.general_comments.count()
+            'comment_count': self.comment_count
         }
         return json_post
 
@@ -341,24 +636,31 @@ class Comment(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     disabled = db.Column(db.Boolean)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    general_post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
+    general_post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), index=True)
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
-                        'strong']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        if current_app.config['MARKDOWN_LAZY_RENDER']:
+            target.body_html = None
+        else:
+            target.body_html = markup.render(value, 'comment')
+
+    @property
+    def html(self):
+        if self.body_html is None and self.body is not None:
+            self.body_html = markup.render(self.body, 'comment')
+        return self.body_html
 
     def to_json(self):
-        json_general_comment = {
+        json_comment = {
             'url': url_for('api.get_comment', id=self.id),
-            'general_post_url': url_for('api.get_post', id=self.post_id),
+            'post_url': url_for('api.get_post', id=self.general_post_id)
+            if self.general_post_id is not None else None,
             'body': self.body,
-            'body_html': self.body_html,
+            'body_html': self.html,
             'timestamp': self.timestamp,
-            'author_url': url_for('api.get_user', id=self.author_id),
+            'author_url': url_for('api.get_user', id=self.author_id)
+            if self.author_id is not None else None,
         }
         return json_comment
 
@@ -0,0 +1,396 @@
+import heapq
+import threading
+from collections import deque, namedtuple
+
+from flask import current_app
+from sqlalchemy import case, delete, insert, select, update
+
+from app import db, orders
+from app.exceptions import OrderError
+from app.models import BuyOrder, OrderBookChange, Product, User
+
+
+buy_orders = BuyOrder.__table__
+products = Product.__table__
+changes = OrderBookChange.__table__
+
+Bid = namedtuple('Bid', 'order_id buyer_id max_price')
+Fill = namedtuple('Fill', 'order_id buyer_id product_ids')
+
+
+class Side:
+    """Price levels kept in a heap, best first, each a FIFO queue of ids.
+    Removed and repriced entries are skipped when they reach the front."""
+
+    def __init__(self, best_is_lowest):
+        self.sign = 1 if best_is_lowest else -1
+        self.heap = []
+        self.levels = {}
+
+    def add(self, price, entry_id):
+        level = self.levels.get(price)
+        if level is None:
+            level = self.levels[price] = deque()
+            heapq.heappush(self.heap, self.sign * price)
+        level.append(entry_id)
+
+    def load(self, entries):
+        """Replace the contents with ``entries``, (price, id) pairs in time
+        order, in one heapify."""
+        self.levels = {}
+        for price, entry_id in entries:
+            self.levels.setdefault(price, deque()).append(entry_id)
+        self.heap = [self.sign * price for price in self.levels]
+        heapq.heapify(self.heap)
+
+    def best(self, is_live):
+        """The best (price, level) whose front entry is live, or None."""
+        while self.heap:
+            price = self.sign * self.heap[0]
+            level = self.levels[price]
+            while level and not is_live(level[0], price):
+                level.popleft()
+            if level:
+                return price, level
+            heapq.heappop(self.heap)
+            del self.levels[price]
+        return None
+
+
+class Book:
+    """Bids and market listings for one (type, variety, location). Listings
+    are single units, so a bid's quantity is a number of listings."""
+
+    def __init__(self):
+        self.asks = Side(best_is_lowest=True)
+        self.bids = Side(best_is_lowest=False)
+        self.ask_prices = {}
+        self.open_bids = {}
+        self.remaining = {}
+
+    def _ask_live(self, product_id, price):
+        return self.ask_prices.get(product_id) == price
+
+    def _bid_live(self, order_id, price):
+        bid = self.open_bids.get(order_id)
+        return bid is not None and bid.max_price == price
+
+    def add_ask(self, product_id, price):
+        if self.ask_prices.get(product_id) != price:
+            self.ask_prices[product_id] = price
+            self.asks.add(price, product_id)
+
+    def remove_ask(self, product_id):
+        self.ask_prices.pop(product_id, None)
+
+    def add_bid(self, bid, remaining):
+        if remaining <= 0:
+            self.remove_bid(bid.order_id)
+            return
+        previous = self.open_bids.get(bid.order_id)
+        self.open_bids[bid.order_id] = bid
+        self.remaining[bid.order_id] = remaining
+        if previous is None or previous.max_price != bid.max_price:
+            self.bids.add(bid.max_price, bid.order_id)
+
+    def remove_bid(self, order_id):
+        self.open_bids.pop(order_id, None)
+        self.remaining.pop(order_id, None)
+
+    def crossed(self):
+        bid, ask = self.bids.best(self._bid_live), self.asks.best(self._ask_live)
+        return bid is not None and ask is not None and ask[0] <= bid[0]
+
+    def match(self, max_fill):
+        """Take the cheapest listings for the best bid while the prices
+        cross. Returns the Fill, or None when the book is not crossed."""
+        top = self.bids.best(self._bid_live)
+        if top is None:
+            return None
+        max_price, level = top
+        bid = self.open_bids[level[0]]
+        wanted = min(self.remaining[bid.order_id], max_fill)
+        taken = []
+        while len(taken) < wanted:
+            ask = self.asks.best(self._ask_live)
+            if ask is None or ask[0] > max_price:
+                break
+            product_id = ask[1].popleft()
+            del self.ask_prices[product_id]
+            taken.append(product_id)
+        if not taken:
+            return None
+        self.remaining[bid.order_id] -= len(taken)
+        if not self.remaining[bid.order_id]:
+            self.remove_bid(bid.order_id)
+        return Fill(bid.order_id, bid.buyer_id, taken)
+
+    def restore(self, bid, remaining, listed):
+        """Undo part of a fill that could not be settled: ``listed`` maps the
+        listings still on the market to their prices."""
+        for product_id, price in listed.items():
+            self.add_ask(product_id, price)
+        if bid is not None:
+            self.add_bid(bid, remaining)
+
+
+class OrderBooks:
+    """The order books, held by the one matcher process (flask match-orders).
+
+    Writers queue the listings and bids they change in order_book_changes,
+    in their own transaction. The matcher builds its books from the database
+    when it starts, then polls the queue, applies what it finds and settles
+    every book that crossed. Fills are guarded in SQL, so a second matcher
+    would only waste work, never oversell a listing or a bid."""
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['ORDER_BOOK_INTERVAL']
+        self.max_fill = app.config['ORDER_BOOK_MAX_FILL']
+        self.batch = app.config['ORDER_BOOK_BATCH']
+        self.books = {}
+        # product_id -> key of the book listing it, so a changed listing is
+        # found without a pass over every book. Entries for listings sold
+        # from a book go when their change arrives.
+        self.ask_keys = {}
+        self._built = False
+        self._backlog = False
+
+    def run(self, stop=None):
+        """Match until ``stop`` (a threading.Event) is set, sleeping between
+        passes only while the queue is empty."""
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                with self.app.app_context():
+                    self.run_once()
+            except Exception:
+                self.app.logger.exception('Order book matching failed; will retry.')
+                self._backlog = False
+            if not self._backlog:
+                stop.wait(self.interval)
+
+    def book(self, key):
+        book = self.books.get(key)
+        if book is None:
+            book = self.books[key] = Book()
+        return book
+
+    def rebuild(self):
+        """Load every open bid and market listing: two ordered scans, then
+        one heapify per side of each book."""
+        asks, bids = {}, {}
+        for product_id, product_type, variety, location, price in db.session.execute(
+                select(products.c.id, products.c.product_type, products.c.product_variety,
+                       products.c.location, products.c.price)
+                .where(products.c.owner_supplier.is_(None),
+                       products.c.is_available.is_(True))
+                .order_by(products.c.id)):
+            asks.setdefault((product_type, variety, location), []).append((price, product_id))
+        for order in db.session.execute(
+                select(buy_orders).where(buy_orders.c.status == 'open')
+                .order_by(buy_orders.c.id)):
+            bids.setdefault((order.product_type, order.product_variety, order.location),
+                            []).append(order)
+        self.books = {}
+        self.ask_keys = {}
+        for key in asks.keys() | bids.keys():
+            book = self.book(key)
+            book.ask_prices = {product_id: price for price, product_id in asks.get(key, ())}
+            self.ask_keys.update(dict.fromkeys(book.ask_prices, key))
+            book.asks.load(asks.get(key, ()))
+            for order in bids.get(key, ()):
+                book.open_bids[order.id] = Bid(order.id, order.buyer_id, order.max_price)
+                book.remaining[order.id] = order.quantity - order.filled
+            book.bids.load((order.max_price, order.id) for order in bids.get(key, ()))
+        self._built = True
+
+    def _apply_changes(self):
+        queued = db.session.execute(
+            select(changes.c.id, changes.c.product_id, changes.c.order_id)
+            .order_by(changes.c.id).limit(self.batch)).all()
+        self._backlog = len(queued) == self.batch
+        if queued:
+            db.session.execute(delete(changes).where(
+                changes.c.id.in_([change.id for change in queued])))
+            db.session.commit()
+        product_ids = {change.product_id for change in queued if change.product_id is not None}
+        order_ids = {change.order_id for change in queued if change.order_id is not None}
+        dirty = set()
+        if product_ids:
+            listed = {row.id: row for row in db.session.execute(
+                select(products.c.id, products.c.product_type, products.c.product_variety,
+                       products.c.location, products.c.price)
+                .where(products.c.id.in_(product_ids),
+                       products.c.owner_supplier.is_(None),
+                       products.c.is_available.is_(True)))}
+            for product_id in product_ids:
+                key = self.ask_keys.pop(product_id, None)
+                if key is not None:
+                    self.books[key].remove_ask(product_id)
+            for row in listed.values():
+                key = (row.product_type, row.product_variety, row.location)
+                self.book(key).add_ask(row.id, row.price)
+                self.ask_keys[row.id] = key
+                dirty.add(key)
+        if order_ids:
+            for order in db.session.execute(
+                    select(buy_orders).where(buy_orders.c.id.in_(order_ids))):
+                key = (order.product_type, order.product_variety, order.location)
+                book = self.book(key)
+                if order.status == 'open':
+                    book.add_bid(Bid(order.id, order.buyer_id, order.max_price),
+                                 order.quantity - order.filled)
+                    dirty.add(key)
+                else:
+                    book.remove_bid(order.id)
+        return dirty
+
+    def run_once(self):
+        """Apply queued changes and settle every crossed book. Returns the
+        fills that were written."""
+        try:
+            if not self._built:
+                self.rebuild()
+                dirty = set(self.books)
+            else:
+                dirty = self._apply_changes()
+        except Exception:
+            # Changes may have left the queue without reaching the books.
+            self._built = False
+            raise
+        return self.settle(dirty)
+
+    def settle(self, keys):
+        """Match and write fills in the books for ``keys`` until none of
+        them is crossed. Returns the fills that were written."""
+        settled = []
+        try:
+            for key in keys:
+                book = self.books[key]
+                while book.crossed():
+                    fill = book.match(self.max_fill)
+                    if fill is None:
+                        break
+                    fill = self._settle(book, fill)
+                    if fill is not None:
+                        settled.append(fill)
+        except Exception:
+            # A fill was taken out of the book but not written.
+            self._built = False
+            raise
+        return settled
+
+    @staticmethod
+    def _listed(product_ids):
+        return dict(db.session.execute(
+            select(products.c.id, products.c.price)
+            .where(products.c.id.in_(product_ids),
+                   products.c.owner_supplier.is_(None),
+                   products.c.is_available.is_(True))).all())
+
+    def _settle(self, book, fill):
+        """Write ``fill`` through orders.checkout, with the bid's progress in
+        the same transaction, and return what was bought, or None. On
+        failure the listings still on the market go back in the book. A
+        buyer who cannot pay for the fill is tried with its cheaper half,
+        down to one listing; a bid that cannot pay for that is closed."""
+        count = len(fill.product_ids)
+        filled = buy_orders.c.filled + count
+        progressed = db.session.execute(
+            update(buy_orders)
+            .where(buy_orders.c.id == fill.order_id, buy_orders.c.status == 'open',
+                   filled <= buy_orders.c.quantity)
+            .values(filled=filled,
+                    status=case((filled >= buy_orders.c.quantity, 'filled'), else_='open')))
+        if progressed.rowcount != 1:
+            # Cancelled, or filled further, since the book last saw it:
+            # nothing is bought, and the bid is reloaded as it now stands.
+            db.session.rollback()
+            book.restore(None, 0, self._listed(fill.product_ids))
+            book.remove_bid(fill.order_id)
+            order = db.session.get(BuyOrder, fill.order_id)
+            if order is not None and order.status == 'open':
+                book.add_bid(Bid(order.id, order.buyer_id, order.max_price),
+                             order.quantity - order.filled)
+            return None
+        try:
+            orders.checkout(db.session.get(User, fill.buyer_id), fill.product_ids)
+            return fill
+        except OrderError:
+            listed = self._listed(fill.product_ids)
+            order = db.session.get(BuyOrder, fill.order_id)
+            if order is None or order.status != 'open':
+                book.restore(None, 0, listed)
+                book.remove_bid(fill.order_id)
+                return None
+            bid = Bid(order.id, order.buyer_id, order.max_price)
+            if len(listed) < count:
+                book.restore(bid, order.quantity - order.filled, listed)
+                return None
+            # Everything was still for sale, so the buyer could not pay.
+            if count > 1:
+                half = count // 2
+                # The dearer half goes back; the bid keeps what it still
+                # wants beyond the half being tried.
+                book.restore(bid, order.quantity - order.filled - half,
+                             {product_id: listed[product_id]
+                              for product_id in fill.product_ids[half:]})
+                return self._settle(book, fill._replace(product_ids=fill.product_ids[:half]))
+            order.status = 'unfunded'
+            db.session.commit()
+            book.restore(None, 0, listed)
+            book.remove_bid(fill.order_id)
+            return None
+
+
+def place(buyer, product_type, product_variety, location, max_price, quantity):
+    """Post a standing bid for ``buyer``; the matcher picks it up once
+    committed."""
+    if max_price is None or max_price <= 0 or quantity is None or quantity <= 0:
+        raise OrderError('A bid needs a positive price and quantity.')
+    if not all((product_type, product_variety, location)):
+        raise OrderError('A bid needs a product type, variety and location.')
+    order = BuyOrder(buyer_id=buyer.id, product_type=product_type,
+                     product_variety=product_variety, location=location,
+                     max_price=max_price, quantity=quantity)
+    db.session.add(order)
+    db.session.flush()
+    record(db.session.connection(), order_ids=[order.id])
+    db.session.commit()
+    return order
+
+
+def cancel(order):
+    if order.status != 'open':
+        raise OrderError(f'This bid is already {order.status}.')
+    db.session.execute(update(buy_orders).where(
+        buy_orders.c.id == order.id, buy_orders.c.status == 'open').values(status='cancelled'))
+    record(db.session.connection(), order_ids=[order.id])
+    db.session.commit()
+    db.session.refresh(order)
+    return order
+
+
+# Changes reach the matcher through the queue, written in the same
+# transaction as the change itself.
+
+def record(connection, product_ids=(), order_ids=()):
+    if not current_app.config['ORDER_BOOK_ENABLED']:
+        return
+    queued = [{'product_id': product_id} for product_id in product_ids] + \
+        [{'order_id': order_id} for order_id in order_ids]
+    if queued:
+        connection.execute(insert(changes), queued)
+
+
+def touch(product_ids, connection=None):
+    """Queue ``product_ids`` as changed in the current transaction."""
+    record(connection or db.session.connection(), product_ids=product_ids)
+
+
+@db.event.listens_for(Product, 'after_insert')
+@db.event.listens_for(Product, 'after_update')
+@db.event.listens_for(Product, 'after_delete')
+def _product_changed(mapper, connection, target):
+    touch([target.id], connection)
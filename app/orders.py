@@ -0,0 +1,106 @@
+from sqlalchemy import and_, func, select, update
+
+from app import aggregation, analytics, db, identity, ledger, orderbook, sync
+from app.exceptions import OrderError
+from app.models import Product, User
+
+
+products = Product.__table__
+users = User.__table__
+
+
+def _cart_total(product_ids):
+    return select(func.coalesce(func.sum(products.c.price), 0)) \
+        .where(products.c.id.in_(product_ids)).scalar_subquery()
+
+
+def _cart_points(product_ids):
+    return select(func.coalesce(func.sum(products.c.price / 20), 0)) \
+        .where(products.c.id.in_(product_ids)).scalar_subquery()
+
+
+def _wallet(user_id):
+    return select(ledger.balance).where(users.c.id == user_id).scalar_subquery()
+
+
+def checkout(buyer, product_ids):
+    """Buy every product in ``product_ids`` for ``buyer`` in one transaction.
+
+    The products are claimed with a single compare-and-set UPDATE that only
+    matches rows still on the market and only if the buyer can afford the
+    whole cart, so two buyers can never both get the same product.
+    """
+    product_ids = sorted(set(product_ids))
+    if not product_ids:
+        raise OrderError('Your cart is empty.')
+    total = _cart_total(product_ids)
+    try:
+        claimed = db.session.execute(
+            update(products)
+            .where(and_(products.c.id.in_(product_ids),
+                        products.c.owner_supplier.is_(None),
+                        products.c.is_available.is_(True),
+                        _wallet(buyer.id) >= total))
+            .values(owner_supplier=buyer.id)
+            .execution_options(synchronize_session=False))
+        if claimed.rowcount != len(product_ids):
+            raise OrderError('Some items are no longer available or you do '
+                             'not have enough funds.')
+        charged = db.session.execute(
+            update(users)
+            .where(and_(users.c.id == buyer.id, ledger.balance >= total))
+            .values(wallet=ledger.balance - total,
+                    identity_version=users.c.identity_version + 1,
+                    points=func.coalesce(users.c.points, 0) +
+                    _cart_points(product_ids))
+            .execution_options(synchronize_session=False))
+        if charged.rowcount != 1:
+            raise OrderError('You do not have enough funds.')
+        ledger.record_purchase(buyer.id, product_ids)
+        analytics.record_sales(product_ids)
+        analytics.adjust_supply(buyer.id, product_ids, 1)
+        aggregation.adjust_lots(buyer.id, product_ids, 1)
+        sync.record(db.session.connection(), 'products', product_ids, buyer.id)
+        orderbook.touch(product_ids)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    identity.forget(buyer.id)
+    return product_ids
+
+
+def purchase(buyer, product_id):
+    return checkout(buyer, [product_id])
+
+
+def sell(seller, product_id):
+    """Put ``product_id`` back on the market and credit ``seller``."""
+    try:
+        released = db.session.execute(
+            update(products)
+            .where(and_(products.c.id == product_id,
+                        products.c.owner_supplier == seller.id))
+            .values(owner_supplier=None)
+            .execution_options(synchronize_session=False))
+        if released.rowcount != 1:
+            raise OrderError('You do not own this product.')
+        db.session.execute(
+            update(users)
+            .where(users.c.id == seller.id)
+            .values(wallet=ledger.balance + _cart_total([product_id]),
+                    identity_version=users.c.identity_version + 1,
+                    points=func.coalesce(users.c.points, 0) +
+                    _cart_points([product_id]))
+            .execution_options(synchronize_session=False))
+        ledger.record_sale(seller.id, product_id)
+        analytics.adjust_supply(seller.id, [product_id], -1)
+        aggregation.adjust_lots(seller.id, [product_id], -1)
+        sync.record(db.session.connection(), 'products', [product_id], seller.id, sync.DELETE)
+        orderbook.touch([product_id])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    identity.forget(seller.id)
+    return product_id
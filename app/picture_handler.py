@@ -1,21 +1,136 @@
+import hashlib
 import os
-from PIL import Image
-from flask import url_for,current_app
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-def add_product_pic(pic_upload,product_name):
+from flask import current_app
+from sqlalchemy import update
 
-    filename = pic_upload.filename
+from app import db
+from app.exceptions import ValidationError
+from app.models import Product
 
-    ext_type = filename.split('.')[-1]
 
-    storage_filename = str(product_name)+'.'+ext_type
+# Largest first, so each variant is scaled down from the previous one.
+SIZES = (('full', (1600, 1600)), ('card', (480, 480)), ('thumbnail', (200, 200)))
+FORMATS = (('webp', 'WEBP'), ('jpg', 'JPEG'))
+CHUNK_SIZE = 64 * 1024
 
-    filepath = os.path.join(current_app.root_path,'static\profile_pics',storage_filename)
+_executor = None
 
-    output_size = (200,200)
 
-    pic = Image.open(pic_upload)
-    pic.thumbnail(output_size)
-    pic.save(filepath)
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=current_app.config['IMAGE_WORKERS'])
+    return _executor
 
-    return storage_filename
+
+def variant_filename(key, size='card', ext='jpg'):
+    return f'{key}-{size}.{ext}'
+
+
+def product_image_path(image, size='card', ext='jpg'):
+    """Path under ``static`` for a product image key; images stored before
+    the pipeline existed are plain filenames in ``profile_pics``."""
+    if '.' in image:
+        return 'profile_pics/' + image
+    return 'product_pics/' + variant_filename(image, size, ext)
+
+
+def spool_upload(pic_upload, spool_dir):
+    """Copy an upload to a spool file in chunks and return the path with the
+    content key (the first 16 hex digits of its SHA-256)."""
+    digest = hashlib.sha256()
+    fd, path = tempfile.mkstemp(dir=spool_dir, suffix='.upload')
+    with os.fdopen(fd, 'wb') as spool:
+        for chunk in iter(lambda: pic_upload.stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            spool.write(chunk)
+    return path, digest.hexdigest()[:16]
+
+
+def render_variants(spool_path, key, output_dir):
+    """Write every size/format variant of a spooled upload. Runs in a worker
+    process."""
+    from PIL import Image
+
+    with Image.open(spool_path) as source:
+        # For JPEGs this lets the decoder scale by 1/2..1/8 while
+        # decoding, which is much cheaper than decoding full size.
+        source.draft('RGB', SIZES[0][1])
+        image = source.convert('RGB')
+    for name, size in SIZES:
+        image.thumbnail(size, reducing_gap=2.0)
+        for ext, image_format in FORMATS:
+            target = os.path.join(output_dir, variant_filename(key, name, ext))
+            partial = target + '.part'
+            image.save(partial, image_format, quality=82)
+            os.replace(partial, target)
+
+
+def _set_image(product_id, key):
+    db.session.execute(update(Product.__table__)
+                       .where(Product.__table__.c.id == product_id)
+                       .values(product_image=key))
+
+
+def _rendered(future, spool_path, key, output_dir, product_id, app):
+    """Done-callback of render_variants: point the product at the new
+    variants, or, when rendering failed, log it and leave the product with
+    the picture it had."""
+    global _executor
+    try:
+        error = None if future.cancelled() else future.exception()
+        with app.app_context():
+            if future.cancelled() or error is not None:
+                app.logger.error('Rendering product image %s failed: %r', key, error)
+                if isinstance(error, BrokenProcessPool):
+                    # A worker died; the next upload starts a new pool.
+                    _executor = None
+                # Variants written before the failure would pass for a
+                # finished render next time the same bytes are uploaded.
+                for name, _ in SIZES:
+                    for ext, _ in FORMATS:
+                        target = os.path.join(output_dir, variant_filename(key, name, ext))
+                        for path in (target, target + '.part'):
+                            if os.path.exists(path):
+                                os.remove(path)
+                return
+            _set_image(product_id, key)
+            db.session.commit()
+    finally:
+        os.remove(spool_path)
+
+
+def add_product_pic(pic_upload, product_id):
+    """Render ``pic_upload`` in the background and make it ``product_id``'s
+    picture once every variant exists. Raises ValidationError when the
+    upload is not an image."""
+    from PIL import Image, UnidentifiedImageError
+
+    output_dir = os.path.join(current_app.root_path, 'static', 'product_pics')
+    spool_dir = current_app.config['UPLOAD_SPOOL_DIR'] or tempfile.gettempdir()
+    path, key = spool_upload(pic_upload, spool_dir)
+
+    try:
+        # Only reads the header, the pixels are decoded in the worker.
+        with Image.open(path):
+            pass
+    except UnidentifiedImageError:
+        os.remove(path)
+        raise ValidationError('The uploaded file is not an image.')
+
+    if os.path.exists(os.path.join(output_dir, variant_filename(key, 'thumbnail', 'jpg'))):
+        # Rendered before: set in the caller's transaction.
+        os.remove(path)
+        _set_image(product_id, key)
+        return
+
+    os.makedirs(output_dir, exist_ok=True)
+    app = current_app._get_current_object()
+    future = _get_executor().submit(render_variants, path, key, output_dir)
+    future.add_done_callback(
+        lambda future: _rendered(future, path, key, output_dir, product_id, app))
@@ -0,0 +1,183 @@
+import base64
+import json
+import re
+
+from flask import current_app
+from sqlalchemy import DDL, and_, column, func, literal, literal_column, or_, \
+    select, table, text, union_all
+
+from app import db
+from app.database import UNMANAGED_TABLES, read_session
+from app.models import Product
+
+
+FTS_TABLE = 'product_search'
+INDEXED_COLUMNS = ('product_name', 'product_type', 'product_variety',
+                   'location', 'description')
+FILTERS = ('type', 'variety', 'location', 'min_price', 'max_price')
+
+products = Product.__table__
+fts = table(FTS_TABLE, column('rowid'), *(column(name) for name in INDEXED_COLUMNS))
+
+create_index = DDL(
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    f"{', '.join(INDEXED_COLUMNS)}, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+db.event.listen(products, 'after_create', create_index.execute_if(dialect='sqlite'))
+UNMANAGED_TABLES.add(FTS_TABLE)
+
+# Only a found index is remembered: one missing now may be built later by
+# another process.
+_has_index = {}
+
+
+def _indexed(connection):
+    """Whether this database has the FTS table; older databases get it from
+    'flask rebuild-search-index'."""
+    if connection.dialect.name != 'sqlite':
+        return False
+    key = str(connection.engine.url)
+    if not _has_index.get(key):
+        _has_index[key] = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+            {'name': FTS_TABLE}).first() is not None
+    return _has_index[key]
+
+
+def _index_product(connection, target):
+    connection.execute(text(f'DELETE FROM {FTS_TABLE} WHERE rowid = :id'),
+                       {'id': target.id})
+    connection.execute(fts.insert().values(
+        rowid=target.id,
+        **{name: getattr(target, name) for name in INDEXED_COLUMNS}))
+
+
+def product_inserted(mapper, connection, target):
+    if _indexed(connection):
+        _index_product(connection, target)
+
+
+def product_updated(mapper, connection, target):
+    state = db.inspect(target)
+    if _indexed(connection) and any(
+            state.attrs[name].history.has_changes() for name in INDEXED_COLUMNS):
+        _index_product(connection, target)
+
+
+def product_deleted(mapper, connection, target):
+    if _indexed(connection):
+        connection.execute(text(f'DELETE FROM {FTS_TABLE} WHERE rowid = :id'),
+                           {'id': target.id})
+
+
+db.event.listen(Product, 'after_insert', product_inserted)
+db.event.listen(Product, 'after_update', product_updated)
+db.event.listen(Product, 'after_delete', product_deleted)
+
+
+def rebuild_index():
+    connection = db.session.connection()
+    connection.execute(create_index)
+    connection.execute(text(f'DELETE FROM {FTS_TABLE}'))
+    connection.execute(fts.insert().from_select(
+        ['rowid'] + list(INDEXED_COLUMNS),
+        select(products.c.id, *(products.c[name] for name in INDEXED_COLUMNS))))
+    db.session.commit()
+    _has_index.clear()
+
+
+def match_expression(query):
+    """Turn free text into an FTS5 query: every word must match, as a prefix."""
+    words = re.findall(r'\w+', query or '')
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def _hits(match, filters):
+    """(product columns, rank) of listed products matching ``match``."""
+    conditions = [products.c.owner_supplier.is_(None),
+                  products.c.is_available.is_(True)]
+    if filters.get('type'):
+        conditions.append(products.c.product_type == filters['type'])
+    if filters.get('variety'):
+        conditions.append(products.c.product_variety == filters['variety'])
+    if filters.get('location'):
+        conditions.append(products.c.location == filters['location'])
+    if filters.get('min_price') is not None:
+        conditions.append(products.c.price >= filters['min_price'])
+    if filters.get('max_price') is not None:
+        conditions.append(products.c.price <= filters['max_price'])
+
+    if not match:
+        rank = literal(0.0)
+        source = products
+    elif _indexed(read_session().connection()):
+        rank = func.bm25(literal_column(FTS_TABLE))
+        source = fts.join(products, products.c.id == fts.c.rowid)
+        conditions.append(literal_column(FTS_TABLE).op('MATCH')(match))
+    else:
+        # No FTS5 (e.g. PostgreSQL): plain substring matching, unranked.
+        rank = literal(0.0)
+        source = products
+        for word in re.findall(r'\w+', match):
+            pattern = f'%{word}%'
+            conditions.append(or_(*(products.c[name].ilike(pattern)
+                                    for name in INDEXED_COLUMNS)))
+    return select(products.c.id, products.c.product_name,
+                  products.c.product_type, products.c.product_variety,
+                  products.c.location, products.c.price, products.c.timestamp,
+                  rank.label('rank')) \
+        .select_from(source).where(and_(*conditions)).subquery('hits')
+
+
+def encode_cursor(rank, product_id):
+    raw = json.dumps([rank, product_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        rank, product_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(rank), int(product_id)
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def search_page(query, filters, cursor=None, per_page=20):
+    """One page of matching products, best match first, with the cursor of
+    the next page (None on the last one)."""
+    hits = _hits(match_expression(query), filters)
+    statement = select(hits)
+    position = decode_cursor(cursor) if cursor else None
+    if position is not None:
+        rank, product_id = position
+        statement = statement.where(or_(
+            hits.c.rank > rank, and_(hits.c.rank == rank, hits.c.id > product_id)))
+    rows = read_session().execute(
+        statement.order_by(hits.c.rank, hits.c.id).limit(per_page + 1)).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1].rank, rows[-1].id)
+    return rows, next_cursor
+
+
+def facets(query, filters):
+    """Counts per type, variety, location and price bucket over all matches,
+    computed in one statement."""
+    hits = _hits(match_expression(query), filters)
+    bucket = current_app.config['SEARCH_PRICE_BUCKET']
+    price_bucket = (hits.c.price / bucket * bucket).label('value')
+    statement = union_all(*(
+        select(literal(name).label('facet'), value.label('value'),
+               func.count().label('count')).group_by(value)
+        for name, value in (('type', hits.c.product_type),
+                            ('variety', hits.c.product_variety),
+                            ('location', hits.c.location))),
+        select(literal('price').label('facet'), price_bucket,
+               func.count().label('count')).group_by(price_bucket))
+    result = {'type': [], 'variety': [], 'location': [], 'price': []}
+    for facet, value, count in read_session().execute(statement):
+        result[facet].append((value, count))
+    for values in result.values():
+        values.sort(key=lambda item: (-item[1], str(item[0])))
+    return result
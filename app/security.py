@@ -0,0 +1,127 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from passlib.context import CryptContext
+from passlib.exc import MissingBackendError
+from werkzeug.security import check_password_hash
+
+from app.exceptions import PasswordHasherBusy
+
+
+# Config scheme name -> passlib handler. bcrypt and argon2 need the optional
+# bcrypt / argon2-cffi packages.
+SCHEMES = {
+    'pbkdf2': 'pbkdf2_sha256',
+    'bcrypt': 'bcrypt',
+    'scrypt': 'scrypt',
+    'argon2': 'argon2',
+}
+
+_contexts = {}
+_executor = None
+_slots = None
+_pool_lock = threading.Lock()
+
+
+def _settings():
+    scheme = current_app.config['PASSWORD_HASH_SCHEME']
+    return scheme, current_app.config['PASSWORD_HASH_ROUNDS'].get(scheme)
+
+
+def get_context(scheme, rounds=None):
+    """CryptContext that hashes with ``scheme`` and flags every other scheme,
+    or the same scheme with other rounds, as needing a rehash."""
+    key = (scheme, rounds)
+    if key not in _contexts:
+        default = SCHEMES[scheme]
+        settings = {}
+        if rounds is not None:
+            settings[f'{default}__rounds'] = rounds
+        _contexts[key] = CryptContext(
+            schemes=[default] + [name for name in SCHEMES.values() if name != default],
+            default=default, deprecated=['auto'], **settings)
+    return _contexts[key]
+
+
+def _is_werkzeug_hash(password_hash):
+    # Hashes written by generate_password_hash look like method$salt$hash.
+    return not password_hash.startswith('$') and password_hash.count('$') == 2
+
+
+def hash_password(password, scheme=None, rounds=None):
+    if scheme is None:
+        scheme, rounds = _settings()
+    return get_context(scheme, rounds).hash(password)
+
+
+def verify_password(password, password_hash, scheme=None, rounds=None):
+    """Return ``(ok, new_hash)``; ``new_hash`` is set when the stored hash
+    was made with other parameters than the configured ones."""
+    if not password_hash:
+        return False, None
+    if scheme is None:
+        scheme, rounds = _settings()
+    if _is_werkzeug_hash(password_hash):
+        if not check_password_hash(password_hash, password):
+            return False, None
+        return True, hash_password(password, scheme, rounds)
+    return get_context(scheme, rounds).verify_and_update(password, password_hash)
+
+
+def _get_pool():
+    global _executor, _slots
+    with _pool_lock:
+        if _executor is None:
+            workers = current_app.config['PASSWORD_VERIFY_WORKERS']
+            _executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='password-hash')
+            _slots = threading.BoundedSemaphore(
+                workers + current_app.config['PASSWORD_VERIFY_QUEUE'])
+    return _executor, _slots
+
+
+def _submit(function, *args):
+    executor, slots = _get_pool()
+    if not slots.acquire(blocking=False):
+        raise PasswordHasherBusy('Too many passwords being hashed, try again.')
+    scheme, rounds = _settings()
+    future = executor.submit(function, *args, scheme, rounds)
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+def verify_async(password, password_hash):
+    """Verify on the bounded hashing pool and return a future.
+
+    The hash functions release the GIL, so at most PASSWORD_VERIFY_WORKERS
+    cores are spent on logins; when the queue is also full this raises
+    PasswordHasherBusy instead of piling up more work.
+    """
+    return _submit(verify_password, password, password_hash)
+
+
+def hash_async(password):
+    """Hash on the same bounded pool as :func:`verify_async`."""
+    return _submit(hash_password, password)
+
+
+def benchmark(settings, seconds=1.0, password='correct horse battery staple'):
+    """Hashes per second for each ``(scheme, rounds)`` in ``settings``, or
+    None for schemes whose backend is not installed."""
+    results = []
+    for scheme, rounds in settings:
+        context = get_context(scheme, rounds)
+        try:
+            context.hash(password)
+        except MissingBackendError:
+            results.append((scheme, rounds, None))
+            continue
+        count = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < seconds:
+            context.hash(password)
+            count += 1
+        results.append((scheme, rounds, count / (time.perf_counter() - started)))
+    return results
@@ -0,0 +1,159 @@
+import random
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func, insert, select
+
+from app import aggregation, analytics, counters, db, geo, search, security, sync
+from app.models import Comment, Cooperative, Forum, Place, Post, Product, Role, User, \
+    cooperative_members, registered_farmers
+
+
+# Row counts per scale; any of them can be overridden from the command line.
+SCALES = {
+    'small': {'agents': 5, 'farmers': 200, 'buyers': 50, 'cooperatives': 10,
+              'products': 2000, 'forums': 5, 'posts': 200, 'comments': 1000},
+    'medium': {'agents': 50, 'farmers': 5000, 'buyers': 1000, 'cooperatives': 100,
+               'products': 50000, 'forums': 20, 'posts': 5000, 'comments': 25000},
+    'large': {'agents': 500, 'farmers': 50000, 'buyers': 10000, 'cooperatives': 1000,
+              'products': 500000, 'forums': 50, 'posts': 50000, 'comments': 250000},
+}
+PASSWORD = 'password'
+CHUNK_SIZE = 5000
+
+CROPS = {
+    'maize': ['yellow', 'white', 'sweet'],
+    'rice': ['ofada', 'faro 44', 'basmati'],
+    'yam': ['white', 'water', 'yellow'],
+    'cassava': ['tme 419', 'sweet', 'bitter'],
+    'sorghum': ['red', 'white'],
+    'millet': ['pearl', 'finger'],
+    'cowpea': ['brown', 'white', 'drum'],
+    'groundnut': ['samnut 24', 'kampala'],
+    'tomato': ['roma', 'uc82b'],
+    'pepper': ['tatashe', 'rodo', 'shombo'],
+}
+FIRSTNAMES = ['Adamu', 'Bola', 'Chinedu', 'Danjuma', 'Emeka', 'Funke', 'Garba', 'Halima',
+              'Ifeoma', 'Jide', 'Kemi', 'Lami', 'Musa', 'Ngozi', 'Ojo', 'Patience',
+              'Rukayat', 'Sani', 'Tunde', 'Uche', 'Yusuf', 'Zainab']
+LASTNAMES = ['Abubakar', 'Adeyemi', 'Bello', 'Eze', 'Ibrahim', 'Nwosu', 'Okafor',
+             'Olawale', 'Suleiman', 'Umar', 'Yakubu']
+WORDS = ['harvest', 'price', 'fertilizer', 'rain', 'market', 'storage', 'seed',
+         'transport', 'yield', 'irrigation', 'pest', 'weeding', 'loan', 'season']
+
+
+def _bulk(table, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(insert(table), rows[start:start + CHUNK_SIZE])
+
+
+def _ids(model, start):
+    return db.session.execute(
+        select(model.id).where(model.id > start).order_by(model.id)).scalars().all()
+
+
+def _max_id(model):
+    return db.session.execute(select(func.max(model.id))).scalar() or 0
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def seed(scale='small', random_seed=42, **counts):
+    """Add a synthetic marketplace of ``scale`` to the database with bulk
+    inserts. Every seeded user has the password ``PASSWORD``. Returns the
+    number of rows written per table."""
+    counts = dict(SCALES[scale], **{key: value for key, value in counts.items()
+                                    if value is not None})
+    rng = random.Random(random_seed)
+    now = datetime.utcnow()
+    Role.insert_roles()
+    if not Place.query.first():
+        geo.load_gazetteer()
+    places = [(place.name, place.id) for place in Place.query.all()]
+    roles = {role.name: role.id for role in Role.query.all()}
+    # One hash for everyone: realistic verify cost at login, no cost per row.
+    password_hash = security.hash_password(PASSWORD)
+    run = _max_id(User) + 1
+
+    first_cooperative = _max_id(Cooperative)
+    _bulk(Cooperative.__table__, [
+        {'name': f'Cooperative {run}-{n}', 'purpose': f'Pooled sales {run}-{n}',
+         'products': f'{rng.choice(list(CROPS))} {run}-{n}',
+         'location': rng.choice(places)[0]}
+        for n in range(counts['cooperatives'])])
+    cooperative_ids = _ids(Cooperative, first_cooperative)
+
+    first_user = _max_id(User)
+    users = []
+    for kind, role in (('agent', 'Agent'), ('farmer', 'User'), ('buyer', 'User')):
+        for n in range(counts[kind + 's']):
+            location, place_id = rng.choice(places)
+            users.append({
+                'email': f'{kind}{n}.{run}@seed.tingo', 'password_hash': password_hash,
+                'role_id': roles[role], 'firstname': f'{rng.choice(FIRSTNAMES)}{run}{kind[0]}{n}',
+                'lastname': rng.choice(LASTNAMES), 'mobile_no': 600000000 + first_user + len(users),
+                'location': location, 'place_id': place_id,
+                'cooperative': rng.choice(cooperative_ids) if kind == 'farmer' and cooperative_ids else None,
+                'member_since': now - timedelta(days=rng.randrange(720))})
+    _bulk(User.__table__, users)
+    user_ids = _ids(User, first_user)
+    agent_ids = user_ids[:counts['agents']]
+    farmer_ids = user_ids[counts['agents']:counts['agents'] + counts['farmers']]
+
+    _bulk(cooperative_members, [{'cooperative_id': user['cooperative'], 'user_id': user_id}
+                                for user, user_id in zip(users, user_ids)
+                                if user['cooperative'] is not None])
+    if agent_ids:
+        _bulk(registered_farmers, [{'agent_id': rng.choice(agent_ids), 'farmer_id': farmer_id}
+                                   for farmer_id in farmer_ids])
+
+    products = []
+    for n in range(counts['products']):
+        crop = rng.choice(list(CROPS))
+        location, place_id = rng.choice(places)
+        products.append({
+            'product_name': f'{crop.title()} {n}', 'product_type': crop,
+            'product_variety': rng.choice(CROPS[crop]), 'location': location,
+            'place_id': place_id, 'price': rng.randrange(50, 1000, 10),
+            'description': _text(rng, 12),
+            'timestamp': now - timedelta(minutes=rng.randrange(60 * 24 * 90)),
+            # Most produce is listed on the market; the rest is already owned.
+            'owner_supplier': rng.choice(farmer_ids) if farmer_ids and rng.random() < 0.2 else None})
+    first_product = _max_id(Product)
+    _bulk(Product.__table__, products)
+
+    first_forum, first_post = _max_id(Forum), _max_id(Post)
+    _bulk(Forum.__table__, [{'name': f'Forum {run}-{n}', 'description': _text(rng, 8)}
+                            for n in range(counts['forums'])])
+    forum_ids = _ids(Forum, first_forum)
+    if forum_ids:
+        _bulk(Post.__table__, [
+            {'body': _text(rng, 40), 'author_id': rng.choice(user_ids),
+             'forum_id': rng.choice(forum_ids),
+             'timestamp': now - timedelta(minutes=rng.randrange(60 * 24 * 90))}
+            for _ in range(counts['posts'])])
+    post_ids = _ids(Post, first_post)
+    if post_ids:
+        _bulk(Comment.__table__, [
+            {'body': _text(rng, 15), 'author_id': rng.choice(user_ids),
+             'general_post_id': rng.choice(post_ids), 'disabled': False,
+             'timestamp': now - timedelta(minutes=rng.randrange(60 * 24 * 90))}
+            for _ in range(counts['comments'])])
+    db.session.commit()
+
+    # Core inserts skip the mapper events that maintain these.
+    counters.recompute()
+    search.rebuild_index()
+    sync.backfill(first_user, first_product)
+    aggregation.rebuild_lots()
+    try:
+        analytics.rebuild_price_rollups()
+        analytics.rebuild_cooperative_supply()
+    except RuntimeError as e:
+        current_app.logger.warning('Analytics rollups not rebuilt: %s', e)
+    return {'cooperatives': len(cooperative_ids), 'users': len(user_ids),
+            'registered_farmers': len(farmer_ids) if agent_ids else 0,
+            'products': len(products), 'forums': len(forum_ids),
+            'posts': len(post_ids), 'comments': counts['comments'] if post_ids else 0}
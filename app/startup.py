@@ -0,0 +1,42 @@
+import sys
+import time
+from contextlib import contextmanager
+
+
+# Modules a serving worker should not need until a request uses them.
+HEAVY_MODULES = ('bleach', 'markdown', 'PIL', 'numpy', 'pandas', 'scipy',
+                 'matplotlib', 'seaborn')
+
+
+class StartupReport:
+    """Wall-clock time spent in each phase of create_app."""
+
+    def __init__(self):
+        self.phases = []
+        self.total = None
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def finish(self, app):
+        self.total = time.perf_counter() - self._started
+        app.extensions['startup_report'] = self
+        app.logger.debug('create_app took %.1f ms (%s)', self.total * 1000,
+                         ', '.join(f'{name} {seconds * 1000:.1f} ms'
+                                   for name, seconds in self.phases))
+
+    @staticmethod
+    def heavy_modules():
+        return [name for name in HEAVY_MODULES if name in sys.modules]
+
+    def lines(self):
+        for name, seconds in self.phases:
+            yield f'{name:12} {seconds * 1000:8.1f} ms'
+        yield f'{"total":12} {self.total * 1000:8.1f} ms'
+        yield f'heavy modules loaded: {", ".join(self.heavy_modules()) or "none"}'
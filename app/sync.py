@@ -0,0 +1,363 @@
+import json
+
+from flask import current_app
+from sqlalchemy import and_, event, func, insert, literal, or_, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+
+from app import db, importer, security
+from app.exceptions import ValidationError
+from app.market import LISTING_COLUMNS
+from app.models import ChangeLog, Permission, Product, SyncReceipt, User, \
+    registered_farmers
+
+
+UPSERT, DELETE = 'upsert', 'delete'
+PENDING_KEY = 'sync_change_log'
+# Key of the PostgreSQL advisory lock that orders change log commits.
+LOG_LOCK = 22022
+
+# The columns a client replica holds per table.
+SYNCED_COLUMNS = {
+    'users': ('id', 'firstname', 'lastname', 'email', 'mobile_no', 'location',
+              'cooperative', 'place_id'),
+    'products': LISTING_COLUMNS + ('description', 'is_available', 'owner_supplier',
+                                   'product_image', 'place_id'),
+}
+EDITABLE_PRODUCT_COLUMNS = ('product_name', 'product_type', 'product_variety',
+                            'location', 'price', 'description')
+
+change_log = ChangeLog.__table__
+receipts = SyncReceipt.__table__
+products = Product.__table__
+tables = {'users': User.__table__, 'products': products}
+
+
+def record(connection, table_name, row_ids, owner_id, op=UPSERT):
+    """Log ``op`` on ``row_ids`` for the replica of ``owner_id``. Core
+    writes call this themselves; ORM writes are logged by the events below."""
+    if row_ids:
+        _log(connection, [
+            {'table_name': table_name, 'row_id': row_id, 'owner_id': owner_id, 'op': op}
+            for row_id in row_ids])
+
+
+def record_users(connection, user_ids):
+    # Each user is the owner of their own row.
+    if user_ids:
+        _log(connection, [
+            {'table_name': 'users', 'row_id': user_id, 'owner_id': user_id, 'op': UPSERT}
+            for user_id in user_ids])
+
+
+# Clients pull by sequence number, so a number must never become visible
+# after a higher one has been pulled. Entries are held until their
+# transaction commits and then written under a lock held only through the
+# commit, so sequence numbers are taken and committed in order. SQLite
+# already runs one writer at a time.
+
+def _lock(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(select(func.pg_advisory_xact_lock(LOG_LOCK)))
+
+
+def _insert(connection, entries):
+    _lock(connection)
+    # Nothing cached is built from the change log.
+    connection.execute(insert(change_log).execution_options(cache_invalidate=False), entries)
+
+
+def _log(connection, entries):
+    if connection.in_transaction():
+        connection.info.setdefault(PENDING_KEY, []).extend(entries)
+    else:
+        _insert(connection, entries)
+
+
+@event.listens_for(Engine, 'commit')
+def _write_log(connection):
+    entries = connection.info.pop(PENDING_KEY, None)
+    if entries:
+        _insert(connection, entries)
+
+
+@event.listens_for(Engine, 'rollback')
+def _discard_log(connection):
+    connection.info.pop(PENDING_KEY, None)
+
+
+def backfill(after_user=0, after_product=0):
+    """Log every user, and every owned product, with an id above the given
+    ones: rows written before the change log existed or by bulk loaders."""
+    _lock(db.session.connection())
+    db.session.execute(insert(change_log).from_select(
+        ['table_name', 'row_id', 'owner_id', 'op'],
+        select(literal('users'), User.id, User.id, literal(UPSERT))
+        .where(User.id > after_user).order_by(User.id)))
+    db.session.execute(insert(change_log).from_select(
+        ['table_name', 'row_id', 'owner_id', 'op'],
+        select(literal('products'), Product.id, Product.owner_supplier, literal(UPSERT))
+        .where(Product.id > after_product, Product.owner_supplier.isnot(None))
+        .order_by(Product.id)))
+    db.session.commit()
+
+
+def _changed(target, columns):
+    attrs = db.inspect(target).attrs
+    return any(attrs[column].history.has_changes() for column in columns)
+
+
+@event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, target):
+    record_users(connection, [target.id])
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    if _changed(target, SYNCED_COLUMNS['users']):
+        record_users(connection, [target.id])
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    record(connection, 'users', [target.id], target.id, DELETE)
+
+
+@event.listens_for(Product, 'after_insert')
+def _product_inserted(mapper, connection, target):
+    if target.owner_supplier is not None:
+        record(connection, 'products', [target.id], target.owner_supplier)
+
+
+@event.listens_for(Product, 'after_update')
+def _product_updated(mapper, connection, target):
+    history = db.inspect(target).attrs.owner_supplier.history
+    for owner_id in history.deleted or ():
+        if owner_id is not None and owner_id != target.owner_supplier:
+            record(connection, 'products', [target.id], owner_id, DELETE)
+    if target.owner_supplier is not None and _changed(target, SYNCED_COLUMNS['products']):
+        record(connection, 'products', [target.id], target.owner_supplier)
+
+
+@event.listens_for(Product, 'after_delete')
+def _product_deleted(mapper, connection, target):
+    if target.owner_supplier is not None:
+        record(connection, 'products', [target.id], target.owner_supplier, DELETE)
+
+
+# Pull: the rows in a user's replica that changed after ``since``.
+
+def _scope(user):
+    """Owners whose rows ``user`` replicates: themselves and, for agents,
+    their registered farmers."""
+    if not user.can(Permission.REGISTER):
+        return change_log.c.owner_id == user.id
+    return or_(change_log.c.owner_id == user.id, change_log.c.owner_id.in_(
+        select(registered_farmers.c.farmer_id)
+        .where(registered_farmers.c.agent_id == user.id)))
+
+
+def pull(user, since=0, limit=None):
+    """Changes after sequence number ``since``, collapsed to the latest
+    state of each row and sent column-wise:
+
+        {'seq': n, 'more': bool,
+         'tables': {'products': {'columns': [...], 'rows': [[...]], 'deleted': [id]}}}
+
+    The client stores ``seq`` and sends it back as ``since`` next time."""
+    limit = limit or current_app.config['SYNC_PULL_LIMIT']
+    entries = db.session.execute(
+        select(change_log.c.id, change_log.c.table_name, change_log.c.row_id,
+               change_log.c.op)
+        .where(change_log.c.id > since, _scope(user))
+        .order_by(change_log.c.id).limit(limit + 1)).all()
+    more = len(entries) > limit
+    entries = entries[:limit]
+    latest = {}
+    for _, table_name, row_id, op in entries:
+        latest[table_name, row_id] = op
+
+    result = {}
+    for table_name, table in tables.items():
+        upserted = [row_id for (name, row_id), op in latest.items()
+                    if name == table_name and op == UPSERT]
+        deleted = {row_id for (name, row_id), op in latest.items()
+                   if name == table_name and op == DELETE}
+        columns = SYNCED_COLUMNS[table_name]
+        rows = []
+        if upserted:
+            rows = [list(row) for row in db.session.execute(
+                select(*[table.c[column] for column in columns])
+                .where(table.c.id.in_(upserted)).order_by(table.c.id))]
+            # Gone since it was logged; its delete is further on in the log.
+            deleted.update(set(upserted) - {row[0] for row in rows})
+        if rows or deleted:
+            result[table_name] = {'columns': list(columns), 'rows': rows,
+                                  'deleted': sorted(deleted)}
+    return {'seq': entries[-1].id if entries else since, 'more': more, 'tables': result}
+
+
+# Push: client operations applied in one transaction.
+
+def _manages(user, owner_id):
+    if owner_id == user.id:
+        return True
+    return user.can(Permission.REGISTER) and db.session.execute(
+        select(registered_farmers.c.farmer_id).where(and_(
+            registered_farmers.c.agent_id == user.id,
+            registered_farmers.c.farmer_id == owner_id))).first() is not None
+
+
+def _id(data, field):
+    # bool is an int too, but never a row id.
+    value = data.get(field)
+    if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+        raise ValidationError(f'{field} must be an integer id.')
+    return value
+
+
+def _ref(data, field, refs):
+    value = data.get(field)
+    if not isinstance(value, str) or value not in refs:
+        raise ValidationError(f'{field} does not name an earlier operation.')
+    return refs[value]
+
+
+def _owner(user, data, refs):
+    # An operation earlier in the batch can be referred to by its key, so
+    # a farmer registered offline can be given products in the same upload.
+    if data.get('owner_ref') is not None:
+        return _ref(data, 'owner_ref', refs)
+    return _id(data, 'owner') or user.id
+
+
+def _register_farmer(user, data, refs):
+    if not user.can(Permission.REGISTER):
+        raise ValidationError('Only agents can register farmers.')
+    try:
+        row = importer.clean_record(data)
+    except ValueError as e:
+        raise ValidationError(str(e))
+    if User.query.filter(or_(User.email == row['email'],
+                             User.mobile_no == row['mobile_no'])).first() is not None:
+        raise ValidationError('Email or mobile number already registered.')
+    # Hashed on the login pool, so an upload of registrations waits its
+    # turn there instead of spending a core per request.
+    row['password_hash'] = security.hash_async(row.pop('password')).result(
+        timeout=current_app.config['PASSWORD_VERIFY_TIMEOUT'])
+    farmer = User(**row)
+    db.session.add(farmer)
+    db.session.flush()
+    db.session.execute(insert(registered_farmers).values(
+        agent_id=user.id, farmer_id=farmer.id))
+    return {'id': farmer.id}
+
+
+def _product_values(data, required):
+    values = {column: data[column] for column in EDITABLE_PRODUCT_COLUMNS if column in data}
+    missing = [column for column in required if values.get(column) in (None, '')]
+    if missing:
+        raise ValidationError(f'Missing {", ".join(missing)}.')
+    for column, value in values.items():
+        if column == 'price':
+            continue
+        length = products.c[column].type.length
+        if value is not None and (not isinstance(value, str) or len(value) > length):
+            raise ValidationError(f'{column} must be text of up to {length} characters.')
+    if 'price' in values:
+        try:
+            values['price'] = int(values['price'])
+        except (TypeError, ValueError):
+            raise ValidationError('Invalid price.')
+        if values['price'] <= 0:
+            raise ValidationError('Invalid price.')
+    return values
+
+
+def _add_product(user, data, refs):
+    owner_id = _owner(user, data, refs)
+    if not _manages(user, owner_id):
+        raise ValidationError('You cannot add products for this user.')
+    product = Product(owner_supplier=owner_id, **_product_values(
+        data, ('product_name', 'product_type', 'product_variety', 'location', 'price')))
+    db.session.add(product)
+    db.session.flush()
+    return {'id': product.id}
+
+
+def _update_product(user, data, refs):
+    product_id = _ref(data, 'ref', refs) if data.get('ref') is not None else _id(data, 'id')
+    product = Product.query.get(product_id) if product_id is not None else None
+    if product is None:
+        raise ValidationError('No such product.')
+    if product.owner_supplier is None or not _manages(user, product.owner_supplier):
+        raise ValidationError('You cannot update this product.')
+    for column, value in _product_values(data, ()).items():
+        setattr(product, column, value)
+    db.session.flush()
+    return {'id': product.id}
+
+
+OPERATIONS = {
+    'register_farmer': _register_farmer,
+    'add_product': _add_product,
+    'update_product': _update_product,
+}
+
+
+def _check(operations):
+    if not isinstance(operations, list):
+        raise ValidationError('operations must be a list.')
+    if len(operations) > current_app.config['SYNC_MAX_OPERATIONS']:
+        raise ValidationError('Too many operations in one upload.')
+    if sum(isinstance(operation, dict) and operation.get('op') == 'register_farmer'
+           for operation in operations) > current_app.config['SYNC_MAX_REGISTRATIONS']:
+        raise ValidationError('Too many farmer registrations in one upload.')
+    keys = set()
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+            raise ValidationError('Every operation needs a known op.')
+        key = operation.get('key')
+        if not isinstance(key, str) or not 0 < len(key) <= 64 or key in keys:
+            raise ValidationError('Every operation needs a unique key of up to 64 characters.')
+        if not isinstance(operation.get('data'), dict):
+            raise ValidationError(f'Operation {key}: data must be an object.')
+        keys.add(key)
+    return keys
+
+
+def push(user, operations):
+    """Apply ``operations``, ``[{'key': ..., 'op': ..., 'data': {...}}]``,
+    all or nothing. A key already applied for ``user`` returns its stored
+    result instead of applying again, so an upload can be retried safely.
+    Returns one ``{'key': ..., 'id': ...}`` per operation."""
+    keys = _check(operations)
+    applied = dict(db.session.execute(
+        select(receipts.c.key, receipts.c.result)
+        .where(receipts.c.user_id == user.id, receipts.c.key.in_(keys))).all())
+    results, refs, new_receipts = [], {}, []
+    try:
+        for operation in operations:
+            key = operation['key']
+            if key in applied:
+                result = json.loads(applied[key])
+            else:
+                try:
+                    result = OPERATIONS[operation['op']](user, operation['data'], refs)
+                except ValidationError as e:
+                    raise ValidationError(f'Operation {key}: {e}')
+                new_receipts.append({'user_id': user.id, 'key': key,
+                                     'result': json.dumps(result)})
+            refs[key] = result.get('id')
+            results.append(dict(result, key=key))
+        if new_receipts:
+            db.session.execute(insert(receipts), new_receipts)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        # The same keys were uploaded concurrently; the retry sees receipts.
+        raise ValidationError('Conflicting upload in progress, try again.')
+    except Exception:
+        db.session.rollback()
+        raise
+    return results
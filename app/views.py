@@ -1,66 +1,159 @@
 #from bcrypt import methods
-import email
-from unicodedata import category
-from app import app, db
-from flask import render_template, redirect, flash, request, url_for
+from concurrent import futures
+from app import analytics, cache, db, geo, graph, importer, orders, search, security
+from flask import Blueprint, render_template, redirect, flash, request, url_for, abort, jsonify, \
+    current_app
 from flask_login import current_user, login_user, login_required, logout_user
-from app.models import User, Role, Permission, Product, Cooperative, Post, Comment
+from app.models import User, Role, Permission, Product, Cooperative, Post, Comment, Place
+from app.exceptions import OrderError, PasswordHasherBusy, ValidationError
 from app.picture_handler import add_product_pic
+from app.assets import product_image_url
+from app.market import listing_page, owned_products
 from app.forms import LoginForm, RegistrationForm, EditUserForm, EditAgentForm, \
     ProductForm, UpdateProductForm, CooperativeForm, PurchaseForm, SellingForm, PostForm, CommentForm
 
 
+main = Blueprint('main', __name__)
 
-@app.route('/')
+# Static files and metrics scrapes are not user activity.
+UNTRACKED_ENDPOINTS = frozenset({'static', 'assets.asset', 'instrumentation.metrics'})
+
+
+@main.before_app_request
+def before_request():
+    if request.endpoint not in UNTRACKED_ENDPOINTS and current_user.is_authenticated:
+        current_user.ping()
+
+@main.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/market', methods=['POST', 'GET'])
+@main.route('/market', methods=['POST', 'GET'])
 @login_required
+@cache.conditional('products')
 def market():
 
-    products = Product.query.all()
-
     purchase_form = PurchaseForm()
     selling_form = SellingForm()
 
     if request.method == 'POST':
 
-        purchased_product = request.purchase_form.get('purchased_product')
-        purchased_object = Product.query.filter_by(product_name=purchased_product).first()
-
-        if purchased_object:
-            if current_user.can_purchase(purchased_object):
-                purchased_object.buy(current_user)               
-                current_user.points = current_user.add_points(purchased_object)
+        purchased_id = request.form.get('purchased_product', type=int)
+        if purchased_id is not None:
+            purchased_object = Product.query.get_or_404(purchased_id)
+            try:
+                orders.purchase(current_user, purchased_id)
                 flash(f'Success! You purchased {purchased_object.product_name} for \
                       {purchased_object.price}NGN', category='success')
-            else:
-                flash(f'You do not have enough funds to purchase {purchased_object}', category='danger')
-
-        sold_product = request.selling_form.get('sold_product')
-        sold_object = Product.query.filter_by(product_name=sold_product).first()
-        if sold_object:
-            if current_user.can_sell(sold_object):
-                sold_object.sell(current_user)
-                current_user.points = current_user.add_points(sold_object)
+            except OrderError as e:
+                flash(f'Could not purchase {purchased_object.product_name}: {e}', category='danger')
+
+        sold_id = request.form.get('sold_product', type=int)
+        if sold_id is not None:
+            sold_object = Product.query.get_or_404(sold_id)
+            try:
+                orders.sell(current_user, sold_id)
                 flash(f'You have successfully sold {sold_object.product_name} for \
                      {sold_object.price}NGN', category='success')
-            else:
-                flash(f'Something is wrong with selling {sold_object.product_name}', category='danger')
-        
-        return redirect(url_for('market'))
+            except OrderError as e:
+                flash(f'Something is wrong with selling {sold_object.product_name}: {e}', category='danger')
+
+        return redirect(url_for('.market'))
 
     if request.method == 'GET':
-        products = Product.query.filter_by(owner_supplier=None)
-        owned_products = Product.query.filter_by(owner_supplier=current_user.id)
-        return render_template('market.html', products=products, 
+        cursor = request.args.get('cursor')
+        per_page = current_app.config['TINGO_PRODUCTS_PER_PAGE']
+        query = request.args.get('q', '').strip()
+        filters = {'type': request.args.get('type'),
+                   'variety': request.args.get('variety'),
+                   'location': request.args.get('location'),
+                   'min_price': request.args.get('min_price', type=int),
+                   'max_price': request.args.get('max_price', type=int)}
+        search_args = {key: value for key, value in dict(filters, q=query).items()
+                       if value not in (None, '')}
+        listing = cache.Deferred(_market_listing, query, filters, search_args,
+                                 cursor, per_page)
+        return render_template('market.html', listing=listing,
                                 purchase_form=purchase_form,
-                                selling_form=selling_form, 
-                                owned_products=owned_products)
+                                selling_form=selling_form,
+                                owned_products=owned_products(current_user),
+                                cursor=cursor, search_args=search_args)
+
+
+def _market_listing(query, filters, search_args, cursor, per_page):
+    if search_args:
+        products, next_cursor = search.search_page(query, filters, cursor, per_page)
+        return products, next_cursor, search.facets(query, filters)
+    products, next_cursor = listing_page(cursor, per_page=per_page)
+    return products, next_cursor, None
+
+
+@main.route('/market/nearby')
+@login_required
+def market_nearby():
+    radius = min(request.args.get('km', 50, type=float), current_app.config['NEARBY_MAX_KM'])
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    if latitude is None or longitude is None:
+        place = Place.query.get(geo.resolve(request.args.get('place', '')) or 0)
+        if place is None:
+            return jsonify(error='Give lat and lon or a known place.'), 400
+        latitude, longitude = place.latitude, place.longitude
+    filters = {}
+    if request.args.get('type'):
+        filters['product_type'] = request.args['type']
+    results = geo.nearby('products', latitude, longitude, radius,
+                         limit=current_app.config['TINGO_PRODUCTS_PER_PAGE'], **filters)
+    return jsonify(products=[
+        {'id': product.id, 'product_name': product.product_name,
+         'product_type': product.product_type,
+         'product_variety': product.product_variety,
+         'location': product.location, 'price': product.price,
+         'distance_km': round(distance, 1)}
+        for product, distance in results])
+
+
+@main.route('/market/prices')
+@login_required
+def market_prices():
+    product_type = request.args.get('type')
+    if not product_type:
+        return jsonify(error='Give a product type.'), 400
+    days = min(request.args.get('days', 30, type=int), 366)
+    return jsonify(product_type=product_type, days=analytics.price_trend(
+        product_type, request.args.get('variety'), request.args.get('location'), days))
+
 
+@main.route('/cooperative/<int:id>/supply')
+@login_required
+def cooperative_supply(id):
+    cooperative = Cooperative.query.get_or_404(id)
+    return jsonify(cooperative=cooperative.name,
+                   supply=analytics.cooperative_supply(cooperative.id))
+
+
+@main.route('/market/checkout', methods=['POST'])
+@login_required
+def checkout():
+    product_ids = request.form.getlist('product_id', type=int)
+    try:
+        purchased = orders.checkout(current_user, product_ids)
+        flash(f'Success! You purchased {len(purchased)} items.', category='success')
+    except OrderError as e:
+        flash(f'Checkout failed: {e}', category='danger')
+    return redirect(url_for('.market'))
 
-@app.route('/register', methods=['POST', 'GET'])
+
+@main.route('/market/product/<int:id>')
+@login_required
+@cache.conditional('products')
+def market_product(id):
+    product = Product.query.get_or_404(id)
+    return render_template('includes/products_modal.html', product=product,
+                           purchase_form=PurchaseForm())
+
+
+@main.route('/register', methods=['POST', 'GET'])
 def register():
 
     form = RegistrationForm()
@@ -74,7 +167,7 @@ def register():
         db.session.add(user)
         db.session.commit()
         flash(f'Congratulations! You have successfully registered with TingoApp.', category='success')
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
 
     if form.errors != {}:
         for err_msg in form.errors.values():
@@ -83,18 +176,30 @@ def register():
     return render_template('register.html', form=form)
 
 
-@app.route('/login', methods=['POSt', 'GET'])
+@main.route('/login', methods=['POSt', 'GET'])
 def login():
 
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        if user and user.verify_password(form.password.data):
+        verified = False
+        if user:
+            try:
+                verified, new_hash = security.verify_async(
+                    form.password.data, user.password_hash).result(
+                        timeout=current_app.config['PASSWORD_VERIFY_TIMEOUT'])
+            except (PasswordHasherBusy, futures.TimeoutError):
+                flash('The server is busy, please try logging in again.', category='danger')
+                return render_template('login.html', form=form), 503
+            if verified and new_hash is not None:
+                user.password_hash = new_hash
+                db.session.commit()
+        if verified:
             login_user(user)
             flash(f'Success! You are logged in as {user.firstname}', category='success')
             next = request.args.get('next')
             if next is None or not next.startswith('/'):
-                next = url_for('index')
+                next = url_for('.index')
             return redirect(next)
         else:
             flash('Invalid email or password.', category='danger')
@@ -102,15 +207,35 @@ def login():
 
 #, form.remember_me.data
 
-@app.route('/logout')
+@main.route('/agent/import', methods=['POST'])
+@login_required
+def import_farmers():
+    if not current_user.is_agent():
+        abort(403)
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify(error='No file uploaded.'), 400
+    fmt = request.form.get('format') or upload.filename.rsplit('.', 1)[-1].lower()
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify(error='Upload a .csv or .jsonl file.'), 400
+    # Bigger files go through flask import-farmers.
+    try:
+        return jsonify(importer.import_farmers(
+            upload.stream, fmt, current_user,
+            max_rows=current_app.config['IMPORT_REQUEST_MAX_ROWS']))
+    except (PasswordHasherBusy, futures.TimeoutError):
+        return jsonify(error='The server is busy, please upload the file again.'), 503
+
+
+@main.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash('You have been logged out!', category='info')
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
 
 
-@app.route('/add_product', methods=['GET','POST'])
+@main.route('/add_product', methods=['GET','POST'])
 @login_required
 def add_product():
 
@@ -142,7 +267,7 @@ def add_product():
 
 
 @login_required
-@app.route('/product/<int:id>', methods=['GET','POST'])
+@main.route('/product/<int:id>', methods=['GET','POST'])
 def update_product(id):
 
     product = Product.query.get_or_404(id)
@@ -150,9 +275,11 @@ def update_product(id):
     if form.validate_on_submit():
 
         if form.picture.data:
-            product_name = product.product_name
-            pic = add_product_pic(form.picture.data,product_name)
-            product.product_image = pic
+            try:
+                add_product_pic(form.picture.data, product.id)
+            except ValidationError as e:
+                flash(str(e), category='danger')
+                return redirect(url_for('.update_product', id=product.id))
 
         product.product_name = form.product_name.data
         product.product_type = form.product_type.data
@@ -163,13 +290,13 @@ def update_product(id):
 
         db.session.commit()
         flash('Product Information Updated!')
-        return redirect(url_for('user'))
+        return redirect(url_for('.user'))
 
-    product_image = url_for('static',filename='product_pics/'+product.product_image)
+    product_image = product_image_url(product.product_image)
     return render_template('edit_product.html',product_image=product_image,form=form)
 
 
-@app.route('/delete_product/<int:id>', methods=['GET','POST'])
+@main.route('/delete_product/<int:id>', methods=['GET','POST'])
 @login_required
 def delete_product(id):
 
@@ -181,23 +308,32 @@ def delete_product(id):
     return redirect(url_for('.user', id=product.id))
 
 
-@app.route('/user/<firstname>')
+@main.route('/user/<firstname>')
+@login_required
+@cache.conditional('users', 'products', 'cooperatives', 'registered_farmers')
 def user(firstname):
     user = User.query.filter_by(firstname=firstname).first_or_404()
     page = request.args.get('page', 1, type=int)
-    products_pagination = user.products.order_by(Product.timestamp.desc()).paginate(
+    products_pagination = Product.query.filter_by(owner_supplier=user.id).order_by(
+        Product.timestamp.desc()).paginate(
         page, per_page=20, error_out=False) #current_app.config['PRODUCTS_PER_PAGE']
     products = products_pagination.items
-    users_pagination = user.farmers.order_by(User.id.asc()).paginate(
-        page, per_page=20, error_out=False) #current_app.config['FARMERS_PER_PAGE'
-    if current_user.can(Permission.REGISTER):
-        farmers = users_pagination.items
+    farmers_page, farmers = None, None
+    if current_user.can(Permission.REGISTER) and user.is_agent():
+        farmers_page = request.args.get('farmers_page', 1, type=int)
+        farmers = cache.Deferred(_agent_farmers, user, farmers_page)
     return render_template('user.html', user=user, products=products, farmers=farmers,
-                           products_pagination=products_pagination,
-                           users_pagination=users_pagination)
+                           farmers_page=farmers_page,
+                           products_pagination=products_pagination)
+
+
+def _agent_farmers(agent, page):
+    pagination = graph.farmers_page(
+        agent, page, per_page=20) #current_app.config['FARMERS_PER_PAGE']
+    return pagination, graph.agent_totals([agent.id]).get(agent.id, (0, 0, 0))
 
 
-@app.route('/edit-profile', methods=['GET', 'POST'])
+@main.route('/edit-profile', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
     form = EditUserForm()
@@ -226,7 +362,7 @@ def edit_profile():
     return render_template('edit_profile.html', form=form)
 
 
-@app.route('/edit-profile/<int:id>', methods=['GET', 'POST'])
+@main.route('/edit-profile/<int:id>', methods=['GET', 'POST'])
 @login_required
 def edit_profile_user(id):
     agent = User.query.get_or_404(id)
@@ -262,17 +398,17 @@ def edit_profile_user(id):
 
 
 @login_required
-@app.route('/admin', methods=['POST', 'GET'])
+@main.route('/admin', methods=['POST', 'GET'])
 def admin():
     pass
 
 
-@app.route('/forum', methods=['POST', 'GET'])
+@main.route('/forum', methods=['POST', 'GET'])
 def forum():
     pass
 
 
-@app.route('/post', methods=['POST', 'GET'])
+@main.route('/post', methods=['POST', 'GET'])
 def post():
     pass
 
@@ -0,0 +1,114 @@
+import atexit
+import os
+import threading
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import bindparam, or_, update
+
+from app import db
+from app.models import User
+
+
+users = User.__table__
+
+
+class WriteBehind:
+    """Buffers last_seen stamps per worker and writes them in batches, so
+    requests never take a row lock on users for them.
+
+    Repeated stamps for a user collapse to the latest one. A failed flush
+    puts them back to retry. Points are not buffered: checkout and sell
+    write them in the same transaction as the wallet and the ledger."""
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['WRITE_BEHIND_INTERVAL']
+        self.max_pending = app.config['WRITE_BEHIND_MAX_PENDING']
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        self._last_seen = {}
+        self._thread = None
+
+    def _ensure_thread(self):
+        # Started on first use in each process: a thread started before a
+        # pre-forking server forks would not exist in the workers.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._reset()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def touch(self, user_id, when=None):
+        when = when or datetime.utcnow()
+        with self._lock:
+            self._ensure_thread()
+            if self._last_seen.get(user_id, when) <= when:
+                self._last_seen[user_id] = when
+            self._check_size()
+
+    def _check_size(self):
+        if len(self._last_seen) >= self.max_pending:
+            self._wake.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._last_seen)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Write-behind flush failed; will retry.')
+
+    def flush(self):
+        with self._lock:
+            last_seen, self._last_seen = self._last_seen, {}
+        if not last_seen:
+            return
+        try:
+            with self.app.app_context():
+                self._write(last_seen)
+        except Exception:
+            with self._lock:
+                for user_id, when in last_seen.items():
+                    if self._last_seen.get(user_id, when) <= when:
+                        self._last_seen[user_id] = when
+            raise
+
+    @staticmethod
+    def _write(last_seen):
+        with db.engine.begin() as connection:
+            # last_seen is not shown in cached fragments.
+            connection.execute(
+                update(users).execution_options(cache_invalidate=False)
+                .where(users.c.id == bindparam('user_id'))
+                .where(or_(users.c.last_seen.is_(None),
+                           users.c.last_seen < bindparam('seen')))
+                .values(last_seen=bindparam('seen')),
+                [{'user_id': user_id, 'seen': when}
+                 for user_id, when in last_seen.items()])
+
+
+def init_app(app):
+    write_behind = app.extensions['write_behind'] = WriteBehind(app)
+    atexit.register(_drain, write_behind)
+
+
+def _drain(write_behind):
+    try:
+        write_behind.flush()
+    except Exception:
+        write_behind.app.logger.exception('Write-behind drain at exit failed.')
+
+
+def buffer():
+    return current_app.extensions['write_behind']
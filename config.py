@@ -0,0 +1,131 @@
+import os
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+
+class Config:
+    SECRET_KEY = os.environ.get('SECRET_KEY') or 'gfshfskljh89yr9whbbhyr6t7aabzbh'
+    # Cross-site POSTs, which carry no CSRF token to the JSON API, are sent
+    # without the login cookies.
+    SESSION_COOKIE_SAMESITE = 'Lax'
+    REMEMBER_COOKIE_SAMESITE = 'Lax'
+
+    # Relative SQLite paths are resolved against the app package.
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///tingo-app.db'
+    # Optional read replica used by the listing pages.
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 20))
+    DATABASE_POOL_TIMEOUT = 30
+    DATABASE_POOL_RECYCLE = 1800
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+    }
+
+    TINGO_PRODUCTS_PER_PAGE = 20
+    IMAGE_WORKERS = 2
+    UPLOAD_SPOOL_DIR = None
+    ASSETS_X_ACCEL_REDIRECT = None
+    USE_X_SENDFILE = False
+    MARKDOWN_LAZY_RENDER = False
+    # Seconds a worker trusts a verified identity without checking its
+    # version. forget() only reaches the worker it runs in, so other workers
+    # can see a stale identity for this long; off unless set.
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL', 0))
+    # 'lru' keeps fragments in each worker; 'redis' shares them through
+    # FRAGMENT_CACHE_URL, e.g. redis://localhost:6379/0.
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND') or 'lru'
+    FRAGMENT_CACHE_URL = os.environ.get('FRAGMENT_CACHE_URL')
+    FRAGMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+    FRAGMENT_CACHE_TTL = 300
+    # last_seen stamps are batched per worker and written every interval,
+    # or sooner once this many users are pending.
+    WRITE_BEHIND_INTERVAL = 5
+    WRITE_BEHIND_MAX_PENDING = 1000
+    INSTRUMENTATION_ENABLED = True
+    # Adds X-Query-Count and Server-Timing headers to every response.
+    INSTRUMENTATION_HEADERS = False
+    # /metrics is served only when METRICS_ENDPOINT=1; with a METRICS_TOKEN
+    # scrapers must send "Authorization: Bearer <token>".
+    METRICS_ENDPOINT = os.environ.get('METRICS_ENDPOINT') == '1'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    N_PLUS_ONE_THRESHOLD = 5
+    # Endpoints to sample, e.g. PROFILE_ENDPOINTS=main.market; one
+    # collapsed-stack file per request is written to PROFILE_DIR.
+    PROFILE_ENDPOINTS = frozenset(filter(None, (os.environ.get('PROFILE_ENDPOINTS') or '').split(',')))
+    PROFILE_INTERVAL = 0.005
+    PROFILE_DIR = os.path.join(basedir, 'profiles')
+    PASSWORD_HASH_SCHEME = 'pbkdf2'
+    PASSWORD_HASH_ROUNDS = {'pbkdf2': 260000, 'bcrypt': 12,
+                            'scrypt': 16, 'argon2': 3}
+    PASSWORD_VERIFY_WORKERS = 2
+    PASSWORD_VERIFY_QUEUE = 32
+    PASSWORD_VERIFY_TIMEOUT = 10
+    IMPORT_CHUNK_SIZE = 500
+    IMPORT_HASH_WORKERS = None
+    # Rows accepted by the /agent/import upload; larger files are imported
+    # with flask import-farmers. The upload hashes one password at a time on
+    # the login pool, about 0.2s a row at the default pbkdf2 rounds.
+    IMPORT_REQUEST_MAX_ROWS = 20
+    SEARCH_PRICE_BUCKET = 1000
+    NEARBY_MAX_KM = 500
+    ANALYTICS_CHUNK_SIZE = 50000
+    API_PER_PAGE = 50
+    API_MAX_PER_PAGE = 200
+    # Rows per query when a collection is streamed as JSON Lines.
+    API_STREAM_CHUNK = 1000
+    # Offline sync: log entries per pull, operations, farmer registrations
+    # (a password hash each) and decompressed bytes per upload, and the
+    # smallest response worth gzipping.
+    SYNC_PULL_LIMIT = 1000
+    SYNC_MAX_OPERATIONS = 500
+    SYNC_MAX_REGISTRATIONS = 20
+    SYNC_MAX_BYTES = 5 * 1024 * 1024
+    SYNC_GZIP_MIN_BYTES = 512
+    # Queue listing and bid changes for the matcher. Set ORDER_BOOK_ENABLED=1
+    # only where one flask match-orders process runs: it drains the queue.
+    ORDER_BOOK_ENABLED = os.environ.get('ORDER_BOOK_ENABLED') == '1'
+    # Seconds the matcher waits when its queue is empty, the most listings
+    # one fill buys in a single transaction, and changes read per pass.
+    ORDER_BOOK_INTERVAL = 1.0
+    ORDER_BOOK_MAX_FILL = 500
+    ORDER_BOOK_BATCH = 1000
+    # Feeds: audiences above the limit are pulled from a timeline on read
+    # instead of pushed, and each feed keeps its newest FEED_MAX_ENTRIES.
+    FEED_FANOUT_LIMIT = 1000
+    FEED_MAX_ENTRIES = 500
+    GAZETTEER_PATH = os.path.join(basedir, 'app', 'data', 'gazetteer.csv')
+    # Seconds each process keeps its location -> place lookup.
+    GEO_KEYS_TTL = 300
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    INSTRUMENTATION_HEADERS = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    # Point this at a local PostgreSQL server to run against the
+    # production dialect.
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or 'sqlite://'
+    PASSWORD_HASH_ROUNDS = {'pbkdf2': 1000, 'bcrypt': 4,
+                            'scrypt': 10, 'argon2': 1}
+
+
+class ProductionConfig(Config):
+    ASSETS_X_ACCEL_REDIRECT = os.environ.get('ASSETS_X_ACCEL_REDIRECT')
+
+
+config = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+
+    'default': DevelopmentConfig,
+}
@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from app import create_app, db
+from app.models import Product, Role, User
+from config import TestingConfig
+
+
+# TEST_DATABASE_URL runs the suite against that database, e.g. PostgreSQL;
+# its tables are dropped after every test. Otherwise each test gets a
+# fresh SQLite file.
+DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+sqlite_only = pytest.mark.skipif(
+    DATABASE_URL is not None and not DATABASE_URL.startswith('sqlite'),
+    reason='exercises SQLite-only features')
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    """Build an app on a fresh database. Keyword arguments override
+    TestingConfig before the app is created, since engine options are read
+    once at startup."""
+    apps = []
+
+    def make_app(**settings):
+        settings.setdefault('SQLALCHEMY_DATABASE_URI',
+                            DATABASE_URL or f'sqlite:///{tmp_path / "app.db"}')
+        for name, value in settings.items():
+            monkeypatch.setattr(TestingConfig, name, value, raising=False)
+        app = create_app('testing')
+        with app.app_context():
+            db.create_all()
+            Role.insert_roles()
+        apps.append(app)
+        return app
+
+    yield make_app
+    for app in apps:
+        app.extensions['write_behind'].flush()
+    for app in apps:
+        with app.app_context():
+            db.session.remove()
+            if DATABASE_URL is not None:
+                db.drop_all()
+            db.engine.dispose()
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app()
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def make_user(app):
+    count = 0
+
+    def make_user(**fields):
+        nonlocal count
+        count += 1
+        fields = dict({'email': f'user{count}@example.com', 'password': 'password',
+                       'firstname': 'Test', 'lastname': f'User{count}',
+                       'mobile_no': 8000000 + count, 'location': 'Kaduna'}, **fields)
+        user = User(**fields)
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    return make_user
+
+
+@pytest.fixture
+def make_products(app):
+    def make_products(count, price=10, **fields):
+        fields = dict({'product_type': 'maize', 'product_variety': 'yellow',
+                       'location': 'Kaduna'}, **fields)
+        products = [Product(product_name=f'Product {n}', price=price + n, **fields)
+                    for n in range(count)]
+        db.session.add_all(products)
+        db.session.commit()
+        return [product.id for product in products]
+
+    return make_products
+
+
+def login(client, user):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
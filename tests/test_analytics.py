@@ -0,0 +1,41 @@
+import pytest
+
+from app import analytics, db, orders, seed
+from app.models import CooperativeSupply, PriceRollup
+
+
+def _trend():
+    return analytics.price_trend('maize', 'yellow', 'Kaduna')
+
+
+def test_listings_are_counted_as_they_are_made(make_products):
+    make_products(3, price=100)
+    [day] = _trend()
+    assert (day['listings'], day['price_min'], day['price_max']) == (3, 100, 102)
+    assert day['price_median'] is None
+
+
+def test_a_new_listing_clears_the_batch_median(make_user, make_products):
+    pytest.importorskip('pandas')
+    buyer = make_user()
+    product_ids = make_products(3, price=100)
+    analytics.rebuild_price_rollups()
+    assert _trend()[0]['price_median'] == 101
+
+    orders.checkout(buyer, product_ids[:1])
+    [day] = _trend()
+    assert (day['sales'], day['price_median']) == (1, 101)
+
+    make_products(1, price=500)
+    [day] = _trend()
+    assert (day['listings'], day['price_median']) == (4, None)
+
+
+def test_seeding_rebuilds_the_rollups(app):
+    pytest.importorskip('pandas')
+    written = seed.seed(agents=1, farmers=20, buyers=1, cooperatives=2, products=200,
+                        forums=0, posts=0, comments=0)
+    rollups = PriceRollup.query.all()
+    assert sum(rollup.listings for rollup in rollups) == written['products']
+    assert all(rollup.price_median is not None for rollup in rollups)
+    assert CooperativeSupply.query.count() > 0
@@ -0,0 +1,38 @@
+import gzip
+
+import pytest
+
+
+@pytest.fixture
+def static(app, tmp_path):
+    app.static_folder = str(tmp_path / 'static')
+    (tmp_path / 'static' / 'product_pics').mkdir(parents=True)
+    (tmp_path / 'secret-file.txt').write_text('secret')
+    return tmp_path / 'static'
+
+
+@pytest.mark.parametrize('accel', [None, '/protected'])
+def test_paths_outside_the_static_folder_are_not_found(app, static, accel):
+    app.config['ASSETS_X_ACCEL_REDIRECT'] = accel
+    response = app.test_client().get('/assets/secret/product_pics/../../secret-file.txt')
+    assert response.status_code == 404
+    assert 'X-Accel-Redirect' not in response.headers
+
+
+def test_each_encoding_gets_its_own_etag(app, static):
+    body = b'body { color: green; }' * 10
+    (static / 'site.css').write_bytes(body)
+    (static / 'site.css.gz').write_bytes(gzip.compress(body))
+    client = app.test_client()
+    url = client.get('/assets/x/site.css').headers['Location']
+
+    plain = client.get(url, headers={'Accept-Encoding': 'identity'})
+    gzipped = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in plain.headers
+    assert gzipped.headers['Content-Encoding'] == 'gzip'
+    assert plain.headers['ETag'] != gzipped.headers['ETag']
+
+    revalidated = client.get(url, headers={'Accept-Encoding': 'identity',
+                                           'If-None-Match': gzipped.headers['ETag']})
+    assert revalidated.status_code == 200
+    assert revalidated.data == body
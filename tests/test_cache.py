@@ -0,0 +1,48 @@
+from sqlalchemy import insert
+
+from app import cache, db, feed
+from app.models import CacheVersion, Forum, Product, Transaction
+from tests.conftest import login
+
+
+def test_a_write_in_another_worker_changes_the_etag(make_app, make_user, make_products):
+    # Two apps on one database stand in for two workers, each with its own
+    # in-process fragment cache.
+    first, second = make_app(), make_app()
+    with first.app_context():
+        user = make_user()
+        product_id = make_products(3)[0]
+        client = login(first.test_client(), user)
+        etag = client.get('/market').headers['ETag']
+        assert client.get('/market', headers={'If-None-Match': etag}).status_code == 304
+
+    with second.app_context():
+        db.session.get(Product, product_id).price = 999
+        db.session.commit()
+
+    with first.app_context():
+        response = client.get('/market', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+
+def test_following_a_forum_changes_the_feed_etag(app, make_user):
+    user = make_user()
+    forum = Forum(name='Maize')
+    db.session.add(forum)
+    db.session.commit()
+    client = login(app.test_client(), user)
+    etag = client.get('/api/v1/feed').headers['ETag']
+
+    feed.subscribe(db.session.connection(), forum.id, user.id)
+    db.session.commit()
+    assert client.get('/api/v1/feed', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_only_watched_tables_are_versioned(app, make_user):
+    user = make_user()
+    db.session.execute(insert(Transaction.__table__).values(seller_id=user.id, amount=5))
+    db.session.commit()
+    versioned = {row.table_name for row in CacheVersion.query}
+    assert 'users' in versioned and 'transactions' not in versioned
+    assert versioned <= cache.WATCHED_TABLES
@@ -0,0 +1,48 @@
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from sqlalchemy import event, func, insert, select
+from sqlalchemy.engine import Engine
+
+from app import db
+from app.database import include_object, read_session
+from app.models import Product
+
+
+def test_read_session_queries_the_replica(make_app, tmp_path):
+    primary, replica = tmp_path / 'primary.db', tmp_path / 'replica.db'
+    app = make_app(SQLALCHEMY_DATABASE_URI=f'sqlite:///{primary}',
+                   DATABASE_REPLICA_URL=f'sqlite:///{replica}')
+    with app.app_context():
+        replica_engine = db.get_engine(bind='replica')
+        db.Model.metadata.create_all(replica_engine)
+        with replica_engine.begin() as connection:
+            connection.execute(insert(Product.__table__).values(
+                product_name='Replica only', product_type='maize', product_variety='yellow',
+                location='Kaduna', price=10))
+
+        databases = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            databases.append(conn.engine.url.database)
+
+        event.listen(Engine, 'before_cursor_execute', record)
+        try:
+            assert read_session().query(Product).count() == 1
+            assert read_session().execute(
+                select(func.count()).select_from(Product.__table__)).scalar() == 1
+            assert set(databases) == {str(replica)}
+            del databases[:]
+            assert db.session.query(Product).count() == 0
+            assert set(databases) == {str(primary)}
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+
+
+def test_read_session_is_the_session_without_a_replica(app):
+    assert read_session() is db.session
+
+
+def test_autogenerate_keeps_the_virtual_tables(app):
+    with db.engine.connect() as connection:
+        context = MigrationContext.configure(connection, opts={'include_object': include_object})
+        assert compare_metadata(context, db.metadata) == []
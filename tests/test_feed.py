@@ -0,0 +1,41 @@
+from app import db, feed
+from app.database import upsert
+from app.models import Forum, Post
+
+
+def test_subscribe_reports_an_existing_subscription(app, make_user):
+    user = make_user()
+    forum = Forum(name='Maize')
+    db.session.add(forum)
+    db.session.commit()
+    assert feed.subscribe(db.session.connection(), forum.id, user.id)
+    assert not feed.subscribe(db.session.connection(), forum.id, user.id)
+
+
+def test_a_wide_source_stored_meanwhile_is_kept(app):
+    row = {'source_type': 'cooperative', 'source_id': 1}
+    with db.engine.begin() as connection:
+        assert upsert(connection, feed.sources, row, ['source_type', 'source_id']).rowcount == 1
+        assert upsert(connection, feed.sources, row, ['source_type', 'source_id']).rowcount == 0
+
+
+def test_pages_are_full_despite_own_and_retracted_events(make_app, make_user):
+    app = make_app(FEED_FANOUT_LIMIT=0)
+    with app.app_context():
+        reader, writer = make_user(), make_user()
+        forum = Forum(name='Maize')
+        db.session.add(forum)
+        db.session.commit()
+        feed.subscribe(db.session.connection(), forum.id, reader.id)
+        posts = [Post(body=f'Post {n}', forum_id=forum.id,
+                      author_id=writer.id if n % 2 else reader.id) for n in range(8)]
+        db.session.add_all(posts)
+        db.session.commit()
+        db.session.delete(posts[7])
+        db.session.commit()
+
+        page, before = feed.read(db.session, reader.id, limit=2)
+        assert [event.subject_id for event in page] == [posts[5].id, posts[3].id]
+        page, before = feed.read(db.session, reader.id, before=before, limit=2)
+        assert [event.subject_id for event in page] == [posts[1].id]
+        assert before is None
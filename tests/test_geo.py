@@ -0,0 +1,12 @@
+from app import db, geo
+
+
+def test_places_loaded_later_are_found(app, monkeypatch):
+    monkeypatch.setattr(geo, 'EMPTY_KEYS_TTL', 0)
+    assert geo.resolve('Zaria') is None
+    db.session.rollback()
+    # Loaded by another process, so this one's lookup is not reset.
+    with db.engine.begin() as connection:
+        connection.execute(geo.places.insert().values(
+            name='Zaria', state='Kaduna', key='zaria', latitude=11.1, longitude=7.7))
+    assert geo.resolve('Zaria, Kaduna State') is not None
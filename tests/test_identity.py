@@ -0,0 +1,42 @@
+import secrets
+
+from sqlalchemy import event
+
+from app import db, identity
+from app.models import Permission
+
+
+def test_session_keeps_only_what_authorization_needs(app, make_user):
+    user = make_user(about_me=secrets.token_hex(3000))
+    client = app.test_client()
+    response = client.post('/login', data={'email': user.email, 'password': 'password'})
+    with client.session_transaction() as stored:
+        cached = stored[identity.SESSION_KEY]
+    assert cached == {'id': user.id, 'identity_version': user.identity_version,
+                      'permissions': user.role.permissions, 'firstname': user.firstname,
+                      'points': user.points, 'wallet': user.wallet}
+    cookie = response.headers['Set-Cookie']
+    assert len(cookie) < 1024
+
+
+def test_restored_user_loads_its_profile_on_use(app, make_user):
+    user = make_user(firstname='Ada')
+    user_id, email = user.id, user.email
+    with app.test_request_context():
+        identity.remember(user)
+        db.session.remove()
+        restored = identity.load_user(str(user_id))
+        assert restored.can(Permission.COMMENT)
+        assert (restored.firstname, restored.email) == ('Ada', email)
+
+
+def test_page_header_needs_only_the_version_check(app, make_user):
+    user = make_user(firstname='Ada')
+    client = app.test_client()
+    client.post('/login', data={'email': user.email, 'password': 'password'})
+    statements = []
+    event.listen(db.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    response = client.get('/')
+    assert b'Welcome, Ada' in response.data
+    assert len(statements) == 1 and 'identity_version' in statements[0]
@@ -0,0 +1,45 @@
+import io
+
+from app import db, importer
+from app.models import User
+
+HEADER = b'email,password,firstname,lastname,mobile_no,location\n'
+
+
+def _row(n):
+    return f'farmer{n}@example.com,secret,Farmer,{n},{9000000 + n},Kaduna\n'.encode()
+
+
+def test_invalid_utf8_row_is_reported(app, make_user):
+    agent = make_user()
+    stream = io.BytesIO(HEADER + _row(1) + b'\xff\xfe,secret,A,B,1,Kano\n' + _row(2))
+    report = importer.import_farmers(stream, 'csv', agent, max_rows=10)
+    assert report['imported'] == 2
+    assert report['errors'] == [{'row': 2, 'error': 'Row is not valid UTF-8.'}]
+
+
+def test_rows_past_max_rows_are_skipped(app, make_user):
+    agent = make_user()
+    stream = io.BytesIO(HEADER + b''.join(_row(n) for n in range(3)))
+    report = importer.import_farmers(stream, 'csv', agent, max_rows=2)
+    assert report['imported'] == 2
+    assert [error['row'] for error in report['errors']] == [3]
+
+
+def test_chunk_registered_meanwhile_is_reported(app, make_user, monkeypatch):
+    agent = make_user()
+    hash_all = importer._hash
+
+    def register_first(pool, passwords, scheme, rounds):
+        with db.engine.begin() as connection:
+            connection.execute(importer.users.insert().values(
+                email='farmer1@example.com', mobile_no=1, firstname='Other',
+                lastname='Farmer', location='Kano'))
+        return hash_all(pool, passwords, scheme, rounds)
+
+    monkeypatch.setattr(importer, '_hash', register_first)
+    stream = io.BytesIO(HEADER + _row(1) + _row(2))
+    report = importer.import_farmers(stream, 'csv', agent, max_rows=10)
+    assert report['imported'] == 0
+    assert [error['row'] for error in report['errors']] == [1, 2]
+    assert User.query.filter_by(email='farmer2@example.com').first() is None
@@ -0,0 +1,12 @@
+def test_metrics_are_off_by_default(app):
+    assert app.test_client().get('/metrics').status_code == 404
+
+
+def test_metrics_require_the_token(make_app):
+    app = make_app(METRICS_ENDPOINT=True, METRICS_TOKEN='secret')
+    client = app.test_client()
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert b'requests_total' in response.data
@@ -0,0 +1,59 @@
+from sqlalchemy import update
+
+from app import db, ledger, orders
+from app.models import OPENING_BALANCE, User
+
+
+def _set_wallet(user, wallet):
+    db.session.execute(update(User.__table__).where(User.id == user.id).values(wallet=wallet))
+    db.session.commit()
+
+
+def test_reconcile_finds_and_repairs_drift(make_user, make_products):
+    buyer = make_user()
+    product_ids = make_products(2, price=100)
+    orders.checkout(buyer, product_ids)
+    assert ledger.reconcile() == []
+
+    _set_wallet(buyer, 5)
+    drifts = ledger.reconcile()
+    assert [(drift.user_id, drift.expected_wallet) for drift in drifts] == \
+        [(buyer.id, OPENING_BALANCE - 201)]
+    assert ledger.repair(drifts) == [buyer.id]
+    assert ledger.reconcile() == []
+
+
+def test_repair_keeps_a_purchase_made_after_the_check(make_user, make_products):
+    buyer = make_user()
+    first, second = make_products(2, price=100)
+    _set_wallet(buyer, 900)
+    drifts = ledger.reconcile()
+    assert len(drifts) == 1
+
+    # Committed between the check and the repair.
+    orders.checkout(buyer, [first])
+    assert ledger.repair(drifts) == []
+    db.session.expire_all()
+    assert db.session.get(User, buyer.id).wallet == 800
+
+    # The next run still sees only the original drift, and repairs it.
+    drifts = ledger.reconcile()
+    assert [(drift.wallet, drift.expected_wallet) for drift in drifts] == \
+        [(800, OPENING_BALANCE - 100)]
+    assert ledger.repair(drifts) == [buyer.id]
+    assert ledger.reconcile() == []
+
+
+def test_a_null_wallet_counts_as_the_opening_balance(app, make_user, make_products):
+    buyer = make_user()
+    _set_wallet(buyer, None)
+    db.session.expire_all()
+    assert buyer.styled_wallet == f'{OPENING_BALANCE:,}NGN'
+    assert ledger.reconcile() == []
+    orders.checkout(buyer, make_products(1, price=100))
+    assert ledger.reconcile() == []
+
+    _set_wallet(buyer, None)
+    assert ledger.backfill_wallets() == [buyer.id]
+    db.session.expire_all()
+    assert buyer.wallet == OPENING_BALANCE
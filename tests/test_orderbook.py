@@ -0,0 +1,91 @@
+from sqlalchemy import update
+
+from app import db, orderbook
+from app.models import BuyOrder, Product, User
+
+KEY = ('maize', 'yellow', 'Kaduna')
+
+
+def _bid(buyer, max_price, quantity):
+    return orderbook.place(buyer, *KEY, max_price, quantity).id
+
+
+def _owned(user):
+    return Product.query.filter_by(owner_supplier=user.id).count()
+
+
+def test_queued_bids_and_listings_are_matched(app, make_user, make_products):
+    app.config['ORDER_BOOK_ENABLED'] = True
+    buyer = make_user()
+    make_products(3, price=10)
+    books = orderbook.OrderBooks(app)
+    books.run_once()
+    order_id = _bid(buyer, 11, 2)
+    assert len(books.run_once()) == 1
+    order = db.session.get(BuyOrder, order_id)
+    assert (order.filled, order.status) == (2, 'filled')
+    assert _owned(buyer) == 2
+
+
+def test_a_bid_cancelled_elsewhere_buys_nothing(app, make_user, make_products):
+    buyer = make_user()
+    make_products(3, price=10)
+    order_id = _bid(buyer, 15, 3)
+    books = orderbook.OrderBooks(app)
+    books.rebuild()
+    db.session.execute(update(BuyOrder.__table__).where(BuyOrder.id == order_id)
+                       .values(status='cancelled'))
+    db.session.commit()
+
+    assert books.settle(list(books.books)) == []
+    assert _owned(buyer) == 0
+    assert order_id not in books.books[KEY].open_bids
+    assert len(books.books[KEY].ask_prices) == 3
+
+
+def test_a_bid_filled_elsewhere_is_not_overfilled(app, make_user, make_products):
+    buyer = make_user()
+    make_products(3, price=10)
+    order_id = _bid(buyer, 15, 3)
+    books = orderbook.OrderBooks(app)
+    books.rebuild()
+    db.session.execute(update(BuyOrder.__table__).where(BuyOrder.id == order_id)
+                       .values(filled=2))
+    db.session.commit()
+
+    books.settle(list(books.books))
+    order = db.session.get(BuyOrder, order_id)
+    db.session.refresh(order)
+    assert (order.filled, order.status) == (3, 'filled')
+    assert _owned(buyer) == 1
+
+
+def test_a_buyer_who_can_pay_for_part_gets_that_part(app, make_user, make_products):
+    buyer = make_user()
+    make_products(5, price=100)
+    order_id = _bid(buyer, 200, 5)
+    db.session.execute(update(User.__table__).where(User.id == buyer.id).values(wallet=250))
+    db.session.commit()
+    books = orderbook.OrderBooks(app)
+    books.rebuild()
+
+    fills = books.settle(list(books.books))
+    assert [len(fill.product_ids) for fill in fills] == [2]
+    order = db.session.get(BuyOrder, order_id)
+    db.session.refresh(order)
+    assert (order.filled, order.status) == (2, 'unfunded')
+    assert _owned(buyer) == 2
+    assert len(books.books[KEY].ask_prices) == 3
+
+
+def test_changed_listings_move_between_books(app, make_user, make_products):
+    app.config['ORDER_BOOK_ENABLED'] = True
+    product_id = make_products(1)[0]
+    books = orderbook.OrderBooks(app)
+    books.run_once()
+    product = db.session.get(Product, product_id)
+    product.location = 'Kano'
+    db.session.commit()
+    books.run_once()
+    assert product_id not in books.books[KEY].ask_prices
+    assert product_id in books.books[('maize', 'yellow', 'Kano')].ask_prices
@@ -0,0 +1,42 @@
+import pytest
+from sqlalchemy import update
+
+from app import db, orders
+from app.exceptions import OrderError
+from app.models import OPENING_BALANCE, Product, User
+
+
+def test_a_product_is_sold_once(make_user, make_products):
+    first, second = make_user(), make_user()
+    product_id = make_products(1, price=100)[0]
+    orders.checkout(first, [product_id])
+    with pytest.raises(OrderError):
+        orders.checkout(second, [product_id])
+    db.session.expire_all()
+    assert db.session.get(Product, product_id).owner_supplier == first.id
+    assert db.session.get(User, second.id).wallet == OPENING_BALANCE
+
+
+def test_a_cart_is_bought_whole_or_not_at_all(make_user, make_products):
+    buyer, other = make_user(), make_user()
+    product_ids = make_products(3, price=100)
+    orders.checkout(other, product_ids[-1:])
+    with pytest.raises(OrderError):
+        orders.checkout(buyer, product_ids)
+    db.session.expire_all()
+    assert [db.session.get(Product, id).owner_supplier for id in product_ids] == \
+        [None, None, other.id]
+    assert db.session.get(User, buyer.id).wallet == OPENING_BALANCE
+
+
+def test_a_cart_over_the_wallet_is_refused(make_user, make_products):
+    buyer = make_user()
+    product_ids = make_products(2, price=100)
+    # The wallet drops after the buyer object was loaded.
+    db.session.execute(update(User.__table__).where(User.id == buyer.id).values(wallet=150))
+    db.session.commit()
+    with pytest.raises(OrderError):
+        orders.checkout(buyer, product_ids)
+    db.session.expire_all()
+    assert db.session.get(User, buyer.id).wallet == 150
+    assert Product.query.filter_by(owner_supplier=buyer.id).count() == 0
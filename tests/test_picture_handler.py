@@ -0,0 +1,43 @@
+import io
+import os
+import time
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from app import db, picture_handler
+from app.models import Product
+
+
+def _upload(app, tmp_path, data):
+    app.root_path = str(tmp_path)
+    product_id = Product.query.first().id
+    picture_handler.add_product_pic(FileStorage(io.BytesIO(data), filename='x.png'), product_id)
+    # Let the render and its callback finish.
+    picture_handler._executor.shutdown(wait=True)
+    picture_handler._executor = None
+    time.sleep(0.1)
+    db.session.expire_all()
+    return db.session.get(Product, product_id)
+
+
+def _png():
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), 'green').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def test_the_image_is_set_once_its_variants_exist(app, tmp_path, make_products):
+    make_products(1)
+    product = _upload(app, tmp_path, _png())
+    assert product.product_image != 'default.JPG'
+    rendered = sorted(os.listdir(tmp_path / 'static' / 'product_pics'))
+    assert len(rendered) == 6 and all(name.startswith(product.product_image) for name in rendered)
+
+
+def test_an_image_that_fails_to_render_is_not_used(app, tmp_path, make_products):
+    make_products(1)
+    # The header is readable but decoding the pixels fails.
+    product = _upload(app, tmp_path, _png()[:60])
+    assert product.product_image == 'default.JPG'
+    assert os.listdir(tmp_path / 'static' / 'product_pics') == []
@@ -0,0 +1,16 @@
+from sqlalchemy import text
+
+from app import db, search
+from tests.conftest import sqlite_only
+
+
+@sqlite_only
+def test_index_built_by_another_process_is_found(app):
+    with db.engine.begin() as connection:
+        connection.execute(text(f'DROP TABLE {search.FTS_TABLE}'))
+        search._has_index.clear()
+        assert not search._indexed(connection)
+        # Built by flask rebuild-search-index elsewhere; this process's
+        # _has_index is not cleared.
+        connection.execute(search.create_index)
+        assert search._indexed(connection)
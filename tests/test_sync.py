@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+from app import db, sync
+from app.exceptions import ValidationError
+from app.models import Product, Role, User
+from tests.conftest import login
+
+
+def _listing(key, **data):
+    return {'key': key, 'op': 'add_product',
+            'data': dict({'product_name': 'Maize', 'product_type': 'maize',
+                          'product_variety': 'yellow', 'location': 'Kaduna',
+                          'price': 50}, **data)}
+
+
+def _registration(n):
+    return {'key': f'farmer-{n}', 'op': 'register_farmer',
+            'data': {'email': f'farmer{n}@example.com', 'password': 'secret',
+                     'firstname': 'Farmer', 'lastname': str(n),
+                     'mobile_no': 9000000 + n, 'location': 'Kaduna'}}
+
+
+def test_a_cross_site_text_upload_is_refused(app, make_user):
+    farmer = make_user()
+    client = login(app.test_client(), farmer)
+    body = json.dumps({'operations': [_listing('listing-1')], 'pad': '='})
+    response = client.post('/api/v1/sync', data=body, content_type='text/plain')
+    assert response.status_code == 415
+    assert Product.query.filter_by(owner_supplier=farmer.id).count() == 0
+    assert app.config['SESSION_COOKIE_SAMESITE'] == 'Lax'
+
+
+@pytest.mark.parametrize('data', [
+    {'product_name': {'a': 1}},
+    {'product_name': 'x' * 31},
+    {'price': -5},
+    {'owner': 'someone'},
+])
+def test_malformed_product_values_are_refused(app, make_user, data):
+    with pytest.raises(ValidationError):
+        sync.push(make_user(), [_listing('listing-1', **data)])
+
+
+def test_registered_farmers_get_a_password_hash(app, make_user):
+    agent = make_user(role=Role.query.filter_by(name='Agent').first())
+    [result] = sync.push(agent, [_registration(1)])
+    assert User.query.get(result['id']).verify_password('secret')
+
+    app.config['SYNC_MAX_REGISTRATIONS'] = 2
+    with pytest.raises(ValidationError):
+        sync.push(agent, [_registration(n) for n in range(2, 5)])
+
+
+def test_sequence_numbers_follow_commit_order(app, make_user):
+    farmer = make_user()
+    since = sync.pull(farmer)['seq']
+    db.session.rollback()
+
+    with db.engine.connect() as slow:
+        transaction = slow.begin()
+        sync.record(slow, 'products', [101], farmer.id)
+        # A later writer commits first; its entry must not be numbered
+        # after one that is still to come.
+        with db.engine.begin() as fast:
+            sync.record(fast, 'products', [102], farmer.id)
+        first = sync.pull(farmer, since)
+        db.session.rollback()
+        transaction.commit()
+
+    assert first['tables']['products']['deleted'] == [102]
+    second = sync.pull(farmer, first['seq'])
+    assert second['tables']['products']['deleted'] == [101]
+    assert second['seq'] > first['seq']
+
+
+def test_rolled_back_changes_are_not_logged(app, make_user):
+    farmer = make_user()
+    since = sync.pull(farmer)['seq']
+    db.session.rollback()
+    with db.engine.connect() as connection:
+        transaction = connection.begin()
+        sync.record(connection, 'products', [103], farmer.id)
+        transaction.rollback()
+    assert sync.pull(farmer, since)['tables'] == {}
+
+
+def test_a_retried_upload_is_applied_once(app, make_user):
+    farmer = make_user()
+    operations = [_listing('listing-1')]
+    first = sync.push(farmer, operations)
+    # The response was lost and the client uploads the same queue again.
+    assert sync.push(farmer, operations) == first
+    assert Product.query.filter_by(owner_supplier=farmer.id).count() == 1
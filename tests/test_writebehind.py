@@ -0,0 +1,12 @@
+from app import writebehind
+from tests.conftest import login
+
+
+def test_static_files_do_not_count_as_activity(app, make_user):
+    client = login(app.test_client(), make_user())
+    buffer = writebehind.buffer()
+    buffer.flush()
+    client.get('/static/nonexistent.css')
+    assert buffer.pending() == 0
+    client.get('/')
+    assert buffer.pending() == 1